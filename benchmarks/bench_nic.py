@@ -0,0 +1,41 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License. You may
+# obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+from rejviz import nic
+from rejviz import utils
+
+
+def bench_process_args_upload(benchmark, nic_args, tmpdir):
+    benchmark(nic.process_args, nic_args, str(tmpdir))
+
+
+def bench_process_args_copy_in(benchmark, nic_args, tmpdir):
+    dirs = iter(range(1000000))
+    benchmark(lambda: nic.process_args(
+        nic_args + ['--nic-injection', 'copy-in'],
+        str(tmpdir.mkdir('run%d' % next(dirs)))))
+
+
+def bench_process_args_write(benchmark, nic_args):
+    benchmark(nic.process_args, nic_args + ['--nic-injection', 'write'],
+              '/nonexistent')
+
+
+def bench_render_nic_template(benchmark, nics):
+    nic_vars = dict(nics[0], network='10.0.0.0',
+                    broadcast='10.0.0.255', gateway='10.0.0.1')
+    benchmark(nic._render_nic_template, nic_vars)
+
+
+def bench_parse_keyvals(benchmark, nic_args):
+    nic_strings = nic_args[4::2]
+    benchmark(lambda: [utils.parse_keyvals(s) for s in nic_strings])
@@ -0,0 +1,65 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License. You may
+# obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+from rejviz import inspection
+from rejviz import nic_mappings
+
+
+def bench_parse_nics_output(benchmark, guestfish_output):
+    nics = benchmark(inspection.parse_nics_output, guestfish_output)
+    assert len(nics) == len(guestfish_output.split('@-----')) - 1
+
+
+def bench_map_nics_auto(benchmark, nics, networks):
+    nic_collection = nic_mappings.NicCollection.from_dicts(nics)
+    mapped = benchmark(nic_mappings._map_nics_auto, nic_collection, networks)
+    assert all(nic.libvirt_network for nic in mapped)
+
+
+def bench_map_nics_manual(benchmark, nics):
+    nic_collection = nic_mappings.NicCollection.from_dicts(nics)
+    mappings = dict((nic['name'], 'net%d' % i) for i, nic in enumerate(nics))
+    benchmark(nic_mappings._map_nics_manual, nic_collection, mappings)
+
+
+def bench_convert_nic_mappings_args(benchmark, nics):
+    mapped_nics = nic_mappings.NicCollection.from_dicts(
+        dict(nic, libvirt_network='net0') for nic in nics)
+    half = len(nics) // 2
+    args = ['--name', 'vm', '--nic-mappings',
+            ','.join('%s=net0' % nic['name'] for nic in nics[:half]),
+            '--auto-nic-mappings']
+    benchmark(nic_mappings._convert_nic_mappings_args, args, mapped_nics)
+
+
+def bench_convert_nic_mappings_args_many_options(benchmark, nics):
+    # generated command lines with one option per NIC
+    mapped_nics = nic_mappings.NicCollection.from_dicts(
+        dict(nic, libvirt_network='net0') for nic in nics)
+    args = ['--name', 'vm', '--disk', '/image']
+    for nic in nics:
+        args += ['--nic-mappings', '%s=net0' % nic['name'], '--graphics',
+                 'none']
+    converted = benchmark(nic_mappings._convert_nic_mappings_args, args,
+                          mapped_nics)
+    assert converted.count('--network') == len(nics)
+
+
+def bench_process_nic_mappings(benchmark, nics, networks):
+    # the whole pipeline, from inspected NIC dicts to virt-install args
+    half = len(nics) // 2
+    args = ['--name', 'vm', '--disk', '/image', '--nic-mappings',
+            ','.join('%s=net0' % nic['name'] for nic in nics[:half]),
+            '--auto-nic-mappings']
+    converted = benchmark(nic_mappings.process_nic_mappings, args,
+                          nics=nics, networks=networks, use_daemon=False)
+    assert converted.count('--network') == len(nics)
@@ -0,0 +1,70 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License. You may
+# obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+import subprocess
+import sys
+
+import pytest
+
+
+# modules which pass-through invocations must not load
+HEAVY_MODULES = ['jinja2', 'libvirt', 'guestfs', 'yaml', 'multiprocessing',
+                 'cProfile']
+# cumulative import time of a command module, as reported by
+# `python -X importtime`
+IMPORT_TIME_BUDGET_US = 100000
+
+# import the command and process pass-through args, like main() does
+PASS_THROUGH_CODE = {
+    'builder': ("from rejviz.cmd import builder; "
+                "builder._process_args(['centos-7.0', '-o', 'a.img'], "
+                "'/nonexistent')"),
+    'install': ("from rejviz.cmd import install; "
+                "install._process_args(['--name', 'vm', '--import'])"),
+}
+
+
+def _run_python(args):
+    process = subprocess.Popen([sys.executable] + args,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               universal_newlines=True)
+    stdout, stderr = process.communicate()
+    assert process.returncode == 0, stderr
+    return stdout, stderr
+
+
+def _import_times(code):
+    _, stderr = _run_python(['-X', 'importtime', '-c', code])
+    times = {}
+    for line in stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if line.startswith('import time:') and '|' in line:
+            _, cumulative, name = line.split('|')
+            if cumulative.strip().isdigit():
+                times[name.strip()] = int(cumulative)
+    return times
+
+
+@pytest.mark.parametrize('command', sorted(PASS_THROUGH_CODE))
+def bench_pass_through_startup(benchmark, command):
+    if sys.version_info < (3, 7):
+        pytest.skip('-X importtime needs Python 3.7+')
+
+    times = _import_times(PASS_THROUGH_CODE[command])
+    loaded_heavy = [m for m in HEAVY_MODULES if m in times]
+    assert not loaded_heavy, 'pass-through loads %s' % loaded_heavy
+    module = 'rejviz.cmd.' + command
+    assert times[module] < IMPORT_TIME_BUDGET_US, \
+        '%s imports in %dus, over budget' % (module, times[module])
+
+    benchmark.pedantic(_run_python, args=(['-c', PASS_THROUGH_CODE[command]],),
+                       rounds=10)
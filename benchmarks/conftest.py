@@ -0,0 +1,79 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License. You may
+# obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""Synthetic inputs for the benchmarks, sized like large deployments."""
+
+import os
+
+import pytest
+
+from rejviz import render
+
+
+NIC_COUNT = 1000
+NETWORK_COUNT = 10000
+# roughly 3 MB of guestfish output
+GUESTFISH_NIC_COUNT = 25000
+
+
+def network_address(i):
+    return '10.%d.%d.0' % (i // 256, i % 256)
+
+
+def nic_ipaddr(i):
+    return '10.%d.%d.%d' % ((i * 7) // 256 % 40, (i * 7) % 256, 10 + i % 200)
+
+
+@pytest.fixture(autouse=True)
+def isolated_home(tmpdir, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir.join('cache')))
+    monkeypatch.setenv('XDG_DATA_HOME', str(tmpdir.join('data')))
+    monkeypatch.setattr(render, '_environment', None)
+
+
+@pytest.fixture
+def nics():
+    return [{'name': 'eth%d' % i, 'type': 'Ethernet',
+             'hwaddr': '52:54:00:00:%02x:%02x' % (i >> 8, i & 0xff),
+             'bootproto': 'static', 'ipaddr': nic_ipaddr(i),
+             'network': None, 'netmask': '255.255.255.0'}
+            for i in range(NIC_COUNT)]
+
+
+@pytest.fixture
+def networks():
+    return [{'name': 'net%d' % i, 'dhcp': False,
+             'address': network_address(i)[:-1] + '1',
+             'network': network_address(i), 'netmask': '255.255.255.0',
+             'dhcp_ranges': [], 'dhcp_hosts': []}
+            for i in range(NETWORK_COUNT)]
+
+
+@pytest.fixture
+def nic_args(nics):
+    args = ['centos-7.0', '-o', 'out.qcow2']
+    for nic in nics:
+        args += ['--nic', 'name=%(name)s,hwaddr=%(hwaddr)s,ipaddr=%(ipaddr)s'
+                 % nic]
+    return args
+
+
+@pytest.fixture
+def guestfish_output():
+    lines = []
+    for i in range(GUESTFISH_NIC_COUNT):
+        lines += ['@name', 'eth%d' % i, '@type', 'Ethernet',
+                  '@hwaddr', '52:54:00:00:%02x:%02x' % (i >> 8 & 0xff,
+                                                        i & 0xff),
+                  '@bootproto', 'dhcp', '@ipaddr', '@network', '@netmask',
+                  '@-----']
+    return os.linesep.join(lines)
@@ -0,0 +1,249 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License. You may
+# obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+"""End-to-end latency of rejviz commands, without real images or VMs.
+
+Stub virt-builder, virt-install, virt-ls and guestfish executables with
+configurable delays and canned output are put on PATH, and libvirt is
+pointed at the test:///default driver. Each command is then run
+`--invocations` times, `--concurrency` at a time, as separate processes
+(the way users run them), and latency percentiles and failure rates
+are reported.
+
+    python benchmarks/e2e_latency.py --invocations 50 --concurrency 8 \\
+        --delay virt-builder=0.5 --delay guestfish=0.2
+"""
+
+import argparse
+import json
+from multiprocessing import pool
+import os
+from os import path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+COMMANDS = ['builder', 'install']
+STUBS = ['virt-builder', 'virt-install', 'virt-ls', 'guestfish']
+NIC_CONFIG_DIR = 'network-scripts'
+
+STUB_SCRIPT = '''#!%(python)s
+import json
+import os
+from os import path
+import sys
+import tarfile
+import time
+
+name = path.basename(sys.argv[0])
+stub_dir = path.dirname(path.abspath(sys.argv[0]))
+with open(path.join(stub_dir, 'config.json')) as config_file:
+    config = json.load(config_file).get(name, {})
+time.sleep(config.get('delay', 0))
+args = sys.argv[1:]
+nic_config_dir = path.join(stub_dir, '%(nic_config_dir)s')
+
+if name == 'virt-builder' and '-o' in args:
+    open(args[args.index('-o') + 1], 'w').close()
+elif name == 'virt-ls':
+    for file_name in sorted(os.listdir(nic_config_dir)):
+        print(file_name)
+elif name == 'guestfish' and 'tar-out' in args:
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+    with tarfile.open(fileobj=stdout, mode='w|') as tar:
+        tar.add(nic_config_dir, arcname='.')
+elif name == 'guestfish':
+    sys.stdin.read()
+    with open(path.join(stub_dir, 'guestfish.out')) as output:
+        sys.stdout.write(output.read())
+sys.exit(config.get('exit_code', 0))
+'''
+
+# the guestfs bindings would bypass the stubs, so they're hidden
+COMMAND_CODE = ("import sys; sys.modules['guestfs'] = None; "
+                "from rejviz.cmd import %s; %s.main()")
+
+
+def main():
+    options = _parse_args()
+    work_dir = tempfile.mkdtemp(prefix='rejviz-e2e-')
+    try:
+        stub_dir = _create_stubs(work_dir, options)
+        env = _command_env(work_dir, stub_dir)
+        report = {}
+        for command in options.commands:
+            results = _run_invocations(command, work_dir, env, options)
+            report[command] = _summarize(results)
+            _print_summary(command, report[command])
+        if options.json:
+            with open(options.json, 'w') as json_file:
+                json.dump(report, json_file, indent=2, sort_keys=True)
+    finally:
+        if options.keep:
+            print('Work directory kept: %s' % work_dir)
+        else:
+            shutil.rmtree(work_dir)
+    return 1 if any(r['failed'] for r in report.values()) else 0
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--command', dest='commands', action='append',
+                        choices=COMMANDS,
+                        help='Command to measure (default: all).')
+    parser.add_argument('--invocations', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--nics', type=int, default=4,
+                        help='Number of NICs in the canned image.')
+    parser.add_argument('--delay', action='append', default=[],
+                        metavar='STUB=SECONDS',
+                        help='Delay of a stub executable, e.g. '
+                             'virt-builder=0.5.')
+    parser.add_argument('--fail', action='append', default=[],
+                        metavar='STUB=EXIT_CODE',
+                        help='Exit code of a stub executable.')
+    parser.add_argument('--json', help='Write the report as JSON.')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep the work directory with command logs.')
+    options = parser.parse_args()
+    options.commands = options.commands or COMMANDS
+    return options
+
+
+def _create_stubs(work_dir, options):
+    stub_dir = path.join(work_dir, 'bin')
+    os.mkdir(stub_dir)
+    config = dict((name, {}) for name in STUBS)
+    for setting, key, convert in [(options.delay, 'delay', float),
+                                  (options.fail, 'exit_code', int)]:
+        for item in setting:
+            name, value = item.split('=', 1)
+            config[name][key] = convert(value)
+    with open(path.join(stub_dir, 'config.json'), 'w') as config_file:
+        json.dump(config, config_file)
+
+    script = STUB_SCRIPT % {'python': sys.executable,
+                            'nic_config_dir': NIC_CONFIG_DIR}
+    for name in STUBS:
+        stub_path = path.join(stub_dir, name)
+        with open(stub_path, 'w') as stub_file:
+            stub_file.write(script)
+        os.chmod(stub_path, 0o755)
+
+    # canned image contents: NICs in the libvirt test driver's network
+    nic_config_dir = path.join(stub_dir, NIC_CONFIG_DIR)
+    os.mkdir(nic_config_dir)
+    fish_output = []
+    for i in range(options.nics):
+        nic = {'name': 'eth%d' % i, 'hwaddr': '52:54:00:ee:00:%02x' % i,
+               'ipaddr': '192.168.122.%d' % (10 + i)}
+        with open(path.join(nic_config_dir, 'ifcfg-' + nic['name']),
+                  'w') as ifcfg:
+            ifcfg.write('DEVICE=%(name)s\nTYPE=Ethernet\nHWADDR=%(hwaddr)s\n'
+                        'BOOTPROTO=static\nIPADDR=%(ipaddr)s\n'
+                        'NETMASK=255.255.255.0\n' % nic)
+        fish_output += ['@name', nic['name'], '@type', 'Ethernet',
+                        '@hwaddr', nic['hwaddr'], '@bootproto', 'static',
+                        '@ipaddr', nic['ipaddr'], '@network',
+                        '@netmask', '255.255.255.0', '@-----']
+    with open(path.join(stub_dir, 'guestfish.out'), 'w') as output:
+        output.write('\n'.join(fish_output) + '\n')
+    with open(path.join(work_dir, 'image.qcow2'), 'w') as image:
+        image.write('not a real image')
+    return stub_dir
+
+
+def _command_env(work_dir, stub_dir):
+    env = dict(os.environ)
+    env['PATH'] = stub_dir + os.pathsep + env.get('PATH', '')
+    env['LIBVIRT_DEFAULT_URI'] = 'test:///default'
+    env['XDG_CACHE_HOME'] = path.join(work_dir, 'cache')
+    env['XDG_DATA_HOME'] = path.join(work_dir, 'data')
+    source_dir = path.dirname(path.dirname(path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(
+        [source_dir] + [p for p in [env.get('PYTHONPATH')] if p])
+    return env
+
+
+def _command_args(command, work_dir, i):
+    if command == 'builder':
+        return ['centos-7.0', '-o', path.join(work_dir, 'out-%d.img' % i),
+                '--nic', 'name=eth0',
+                '--nic', 'name=eth1,ipaddr=auto,libvirt_network=default']
+    return ['--name', 'vm%d' % i, '--disk',
+            'path=%s' % path.join(work_dir, 'image.qcow2'),
+            '--no-inspection-cache', '--auto-nic-mappings']
+
+
+def _run_invocations(command, work_dir, env, options):
+    log_dir = path.join(work_dir, 'logs')
+    if not path.isdir(log_dir):
+        os.mkdir(log_dir)
+
+    def run(i):
+        command_line = ([sys.executable, '-c',
+                         COMMAND_CODE % (command, command)] +
+                        _command_args(command, work_dir, i))
+        log_path = path.join(log_dir, '%s-%d.log' % (command, i))
+        started = time.time()
+        with open(log_path, 'w') as log_file:
+            exit_code = subprocess.call(command_line, env=env,
+                                        stdout=log_file,
+                                        stderr=subprocess.STDOUT)
+        return {'latency': time.time() - started, 'exit_code': exit_code,
+                'log': log_path}
+
+    worker_pool = pool.ThreadPool(max(1, options.concurrency))
+    try:
+        return worker_pool.map(run, range(options.invocations), chunksize=1)
+    finally:
+        worker_pool.close()
+        worker_pool.join()
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of `values`."""
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    rank = max(1, int(-(-percent * len(ordered) // 100)))
+    return ordered[rank - 1]
+
+
+def _summarize(results):
+    latencies = [r['latency'] for r in results]
+    failed = [r for r in results if r['exit_code'] != 0]
+    return {
+        'invocations': len(results),
+        'failed': len(failed),
+        'failure_rate': float(len(failed)) / len(results) if results else 0,
+        'p50': percentile(latencies, 50),
+        'p90': percentile(latencies, 90),
+        'p99': percentile(latencies, 99),
+        'max': max(latencies) if latencies else None,
+        'failed_logs': [r['log'] for r in failed],
+    }
+
+
+def _print_summary(command, summary):
+    print('rejviz-%s: %d invocations, %d failed (%.1f%%), '
+          'p50 %.3fs, p90 %.3fs, p99 %.3fs, max %.3fs'
+          % (command, summary['invocations'], summary['failed'],
+             summary['failure_rate'] * 100, summary['p50'], summary['p90'],
+             summary['p99'], summary['max']))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
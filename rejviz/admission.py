@@ -0,0 +1,318 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License. You may
+# obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+import contextlib
+import errno
+import fcntl
+import logging
+import os
+from os import path
+import stat
+import threading
+import time
+
+from rejviz import trace
+from rejviz import utils
+
+
+LOG = logging.getLogger(__file__)
+DIR_ENV = 'REJVIZ_ADMISSION_DIR'
+MAX_LAUNCHES_ENV = 'REJVIZ_MAX_APPLIANCES'
+MIN_FREE_ENV = 'REJVIZ_APPLIANCE_MIN_FREE_MB'
+DEFAULT_MIN_FREE_MB = 0
+QUEUE_PREFIX = 'queue-'
+QUEUE_LOCK = 'queue.lock'
+TICKET_COUNTER = 'ticket'
+SLOT_PREFIX = 'slot-'
+POLL_INTERVAL = 0.2
+MEMINFO = '/proc/meminfo'
+
+_default_controller = None
+_default_controller_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def appliance_slot(launch):
+    """Hold a host-wide appliance slot for the `with` block.
+
+    `launch` names what is being launched, for logs and traces.
+    """
+    controller = default_controller()
+    if not controller.enabled:
+        yield None
+        return
+
+    with trace.span('admission.wait', launch=launch) as span_args:
+        slot = controller.acquire()
+        span_args['slot'] = slot.index
+        span_args['waited'] = round(slot.waited, 3)
+    try:
+        yield slot
+    finally:
+        slot.release()
+
+
+def default_controller():
+    global _default_controller
+    with _default_controller_lock:
+        if _default_controller is None:
+            _default_controller = AdmissionController()
+        return _default_controller
+
+
+class AdmissionController(object):
+    """Cross-process limit on simultaneous libguestfs appliance launches.
+
+    A counting semaphore made of `max_launches` slot files in a run
+    dir, a slot is held by flock-ing its file, so slots of killed
+    processes are freed by the kernel. Waiters take numbered tickets
+    and only the first live ticket in the queue may take a free slot,
+    which makes the queue FIFO. With `min_free_bytes`, the first waiter
+    also waits until the host has that much available memory.
+
+    The run dir is private to the user by default. To share the limit
+    between users, it must be a root-owned dir, sticky if writable by
+    others (like /tmp).
+    """
+
+    def __init__(self, run_dir=None, max_launches=None, min_free_bytes=None):
+        self.run_dir = run_dir or os.environ.get(DIR_ENV)
+        if max_launches is None:
+            max_launches = int(os.environ.get(MAX_LAUNCHES_ENV) or
+                               _cpu_count())
+        self.max_launches = max_launches
+        if min_free_bytes is None:
+            min_free_mb = os.environ.get(MIN_FREE_ENV)
+            min_free_bytes = int(min_free_mb if min_free_mb is not None
+                                 else DEFAULT_MIN_FREE_MB) * 1024 ** 2
+        self.min_free_bytes = min_free_bytes
+        self._ticket_seq = 0
+        self._ticket_seq_lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_launches > 0
+
+    def acquire(self, timeout=None):
+        """Wait for a free slot and take it, returns a `Slot`.
+
+        Raises RuntimeError if `timeout` seconds pass first.
+        """
+        started = time.time()
+        shared = self._prepare_run_dir()
+        ticket_path, ticket_fd = self._enqueue(shared)
+        reported = None
+        try:
+            while True:
+                ahead = self._live_tickets_ahead(ticket_path)
+                available = None if ahead else self._memory_shortage()
+                if not ahead and available is None:
+                    slot = self._take_free_slot(shared)
+                    if slot:
+                        break
+                if available is not None:
+                    waiting_for = (
+                        '%d MiB of available memory, only %d MiB is '
+                        'available (see $%s)' % (
+                            self.min_free_bytes // 1024 ** 2,
+                            available // 1024 ** 2, MIN_FREE_ENV))
+                else:
+                    waiting_for = ('an appliance slot, %d launches queued '
+                                   'ahead' % ahead)
+                if reported != (available is None):
+                    LOG.info('Waiting for %s', waiting_for)
+                    reported = available is None
+                if timeout is not None and time.time() - started > timeout:
+                    raise RuntimeError('Gave up waiting for %s after %ss.'
+                                       % (waiting_for, timeout))
+                time.sleep(POLL_INTERVAL)
+        finally:
+            _unlink(ticket_path)
+            os.close(ticket_fd)
+
+        slot.waited = time.time() - started
+        log = LOG.info if reported is not None else LOG.debug
+        log('Got appliance slot %d after waiting %.1fs', slot.index,
+            slot.waited)
+        return slot
+
+    def _prepare_run_dir(self):
+        """Create or check the run dir, returns whether it is shared."""
+        if not self.run_dir:
+            self.run_dir = utils.runtime_dir('admission')
+            return False
+        try:
+            os.mkdir(self.run_dir, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        return _check_run_dir(self.run_dir)
+
+    def _enqueue(self, shared):
+        with self._ticket_seq_lock:
+            self._ticket_seq += 1
+            new_path = path.join(self.run_dir, '.new-%d-%d' % (
+                os.getpid(), self._ticket_seq))
+
+        queue_lock_fd = _open_lock_file(
+            path.join(self.run_dir, QUEUE_LOCK), shared)
+        try:
+            fcntl.flock(queue_lock_fd, fcntl.LOCK_EX)
+            counter_fd = _open_lock_file(
+                path.join(self.run_dir, TICKET_COUNTER), shared)
+            try:
+                try:
+                    ticket = int(os.read(counter_fd, 32) or 0) + 1
+                except ValueError:
+                    LOG.warning('Resetting corrupt admission ticket counter '
+                                'in %s', self.run_dir)
+                    ticket = 1
+                os.lseek(counter_fd, 0, os.SEEK_SET)
+                os.ftruncate(counter_fd, 0)
+                os.write(counter_fd, str(ticket).encode('ascii'))
+            finally:
+                os.close(counter_fd)
+            # the ticket appears in the queue already locked, so nobody
+            # mistakes it for a ticket of a dead process
+            ticket_fd = os.open(new_path, os.O_WRONLY | os.O_CREAT |
+                                os.O_EXCL | os.O_NOFOLLOW, 0o644)
+            fcntl.flock(ticket_fd, fcntl.LOCK_EX)
+            ticket_path = path.join(self.run_dir, '%s%016d-%d' % (
+                QUEUE_PREFIX, ticket, os.getpid()))
+            os.rename(new_path, ticket_path)
+        finally:
+            os.close(queue_lock_fd)
+        return ticket_path, ticket_fd
+
+    def _live_tickets_ahead(self, ticket_path):
+        own_ticket = path.basename(ticket_path)
+        ahead = 0
+        tickets = sorted(name for name in os.listdir(self.run_dir)
+                         if name.startswith(QUEUE_PREFIX))
+        for ticket in tickets:
+            if ticket >= own_ticket:
+                break
+            other_path = path.join(self.run_dir, ticket)
+            try:
+                other_fd = os.open(other_path, os.O_RDONLY | os.O_NOFOLLOW)
+            except OSError:
+                continue
+            try:
+                fcntl.flock(other_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                # the waiter died without cleaning up
+                _unlink(other_path)
+            except (IOError, OSError):
+                ahead += 1
+            finally:
+                os.close(other_fd)
+        return ahead
+
+    def _take_free_slot(self, shared):
+        for index in range(self.max_launches):
+            slot_fd = _open_lock_file(
+                path.join(self.run_dir, '%s%d' % (SLOT_PREFIX, index)),
+                shared)
+            try:
+                fcntl.flock(slot_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return Slot(index, slot_fd)
+            except (IOError, OSError):
+                os.close(slot_fd)
+        return None
+
+    def _memory_shortage(self):
+        """Bytes of available memory if less than `min_free_bytes`."""
+        if not self.min_free_bytes:
+            return None
+        available = _available_memory()
+        if available is None or available >= self.min_free_bytes:
+            return None
+        return available
+
+
+class Slot(object):
+
+    def __init__(self, index, fd):
+        self.index = index
+        self.fd = fd
+        self.waited = 0
+
+    def release(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def keep_locked_across_exec(self):
+        # Python 2 fds are always inherited
+        if self.fd is not None and hasattr(os, 'set_inheritable'):
+            os.set_inheritable(self.fd, True)
+
+
+def _available_memory():
+    try:
+        with open(MEMINFO) as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 4
+
+
+def _check_run_dir(dir_path):
+    """Raise RuntimeError for an unsafe run dir, returns if it is shared.
+
+    Only dirs of the user or root are trusted, and other users may
+    write to them only if they are root's and sticky.
+    """
+    dir_stat = os.lstat(dir_path)
+    if not stat.S_ISDIR(dir_stat.st_mode):
+        raise RuntimeError("Admission dir '%s' is not a directory."
+                           % dir_path)
+    if dir_stat.st_uid not in (os.getuid(), 0):
+        raise RuntimeError("Admission dir '%s' is owned by uid %d, expected "
+                           "uid %d or root." % (dir_path, dir_stat.st_uid,
+                                                os.getuid()))
+    shared = bool(dir_stat.st_mode & 0o022)
+    if shared and (dir_stat.st_uid != 0 or
+                   not dir_stat.st_mode & stat.S_ISVTX):
+        raise RuntimeError("Admission dir '%s' is writable by others, it "
+                           "must be owned by root and sticky." % dir_path)
+    return shared
+
+
+def _open_lock_file(file_path, shared):
+    flags = os.O_RDWR | os.O_NOFOLLOW
+    try:
+        fd = os.open(file_path, flags | os.O_CREAT | os.O_EXCL, 0o600)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+        return os.open(file_path, flags)
+    if shared:
+        # only files created here are opened up, never existing ones
+        os.fchmod(fd, 0o666)
+    return fd
+
+
+def _unlink(file_path):
+    try:
+        os.unlink(file_path)
+    except OSError:
+        pass
@@ -0,0 +1,141 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License. You may
+# obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+import collections
+
+
+# options interpreted by rejviz, everything else is passed through
+VALUE_OPTIONS = frozenset(['--nic', '--nic-injection', '--nic-mappings',
+                           '--disk', '--trace', '--profile', '--batch',
+                           '--batch-jobs', '--batch-log-dir',
+                           '--batch-summary', '--build-cache-max-gib'])
+FLAG_OPTIONS = frozenset(['--auto-nic-mappings', '--no-inspection-cache',
+                          '--refresh-inspection', '--exec',
+                          '--build-cache'])
+# image selection of libguestfs tools, not to be confused with e.g.
+# virt-install's -d (--debug)
+IMAGE_OPTIONS = frozenset(['-a', '-d'])
+# virt-builder options rejviz reads, they are passed through as well
+VIRT_BUILDER_OPTIONS = frozenset(['-o', '--output', '--format'])
+
+# `option` is None for args passed through, `start` and `end` delimit
+# the token in the original args
+Token = collections.namedtuple('Token', ['option', 'value', 'start', 'end'])
+
+
+def tokenize(args, value_options=VALUE_OPTIONS, flag_options=FLAG_OPTIONS):
+    """Tokenize `args`, unless they already are such an ArgList."""
+    if isinstance(args, ArgList) and \
+            args.value_options == frozenset(value_options) and \
+            args.flag_options == frozenset(flag_options):
+        return args
+    return ArgList(args, value_options, flag_options)
+
+
+class ArgList(object):
+    """Command line args, tokenized in a single pass.
+
+    Both '--option value' and '--option=value' forms are recognized.
+    Tokens of every option are indexed, so lookups don't rescan the
+    args, and `rebuild` creates a new command line in one pass.
+    """
+
+    def __init__(self, args, value_options=VALUE_OPTIONS,
+                 flag_options=FLAG_OPTIONS):
+        self.args = list(args)
+        self.value_options = frozenset(value_options)
+        self.flag_options = frozenset(flag_options)
+        self.tokens = []
+        self._indexes = {}
+
+        arg_count = len(self.args)
+        start = 0
+        while start < arg_count:
+            arg = self.args[start]
+            option, value, end = None, arg, start + 1
+            if arg in value_options:
+                if end >= arg_count:
+                    raise ValueError("Option '%s' requires a value." % arg)
+                option, value, end = arg, self.args[end], end + 1
+            elif arg in flag_options:
+                option, value = arg, None
+            elif arg.startswith('--') and '=' in arg:
+                name, _, inline_value = arg.partition('=')
+                if name in value_options:
+                    option, value = name, inline_value
+
+            self._append(Token(option, value, start, end))
+            start = end
+
+    def _append(self, token):
+        if token.option is not None:
+            self._indexes.setdefault(token.option, []).append(
+                len(self.tokens))
+        self.tokens.append(token)
+
+    def __iter__(self):
+        return iter(self.args)
+
+    def has(self, option):
+        return option in self._indexes
+
+    def token_indexes(self, option):
+        return self._indexes.get(option, [])
+
+    def positions(self, option):
+        """Indexes in `args` where occurrences of `option` start."""
+        return [self.tokens[i].start for i in self.token_indexes(option)]
+
+    def values(self, option):
+        return [self.tokens[i].value for i in self.token_indexes(option)]
+
+    def first(self, option, default=None):
+        indexes = self.token_indexes(option)
+        return self.tokens[indexes[0]].value if indexes else default
+
+    def last(self, option, default=None):
+        indexes = self.token_indexes(option)
+        return self.tokens[indexes[-1]].value if indexes else default
+
+    def rebuild(self, replacements):
+        """New args with tokens replaced.
+
+        `replacements` maps token indexes to lists of args put in place
+        of the token (empty to drop it).
+        """
+        rebuilt = []
+        for index, token in enumerate(self.tokens):
+            replacement = replacements.get(index)
+            if replacement is None:
+                rebuilt.extend(self.args[token.start:token.end])
+            else:
+                rebuilt.extend(replacement)
+        return rebuilt
+
+    def without(self, *options):
+        """New ArgList without any occurrences of `options`.
+
+        The remaining tokens are reused, the args aren't parsed again.
+        """
+        dropped = set(index for option in options
+                      for index in self.token_indexes(option))
+        if not dropped:
+            return self
+        remaining = ArgList([], self.value_options, self.flag_options)
+        for index, token in enumerate(self.tokens):
+            if index in dropped:
+                continue
+            start = len(remaining.args)
+            remaining.args.extend(self.args[token.start:token.end])
+            remaining._append(token._replace(start=start,
+                                             end=len(remaining.args)))
+        return remaining
@@ -0,0 +1,142 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License. You may
+# obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+import json
+import logging
+import os
+from os import path
+import re
+import sys
+import time
+
+from rejviz import arguments
+
+
+LOG = logging.getLogger(__file__)
+DEFAULT_CONCURRENCY = 4
+DEFAULT_LOG_DIR = 'rejviz-batch-logs'
+UNSAFE_NAME_CHARS_RE = re.compile(r'[^A-Za-z0-9_.-]')
+
+
+def is_batch(args):
+    return arguments.tokenize(args).has('--batch')
+
+
+def load_manifest(manifest_path):
+    """Load batch jobs from a JSON (or YAML, if PyYAML is installed) file.
+
+    The manifest is either a list of jobs or a mapping with a 'jobs'
+    list. Each job is a mapping with 'args' (list of strings) and
+    optionally 'name'.
+    """
+    with open(manifest_path) as manifest_file:
+        if manifest_path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError("PyYAML is needed to read manifest '%s'."
+                                 % manifest_path)
+            manifest = yaml.safe_load(manifest_file)
+        else:
+            manifest = json.load(manifest_file)
+
+    jobs = manifest.get('jobs') if isinstance(manifest, dict) else manifest
+    if not isinstance(jobs, list):
+        raise ValueError("Manifest '%s' does not contain a list of jobs."
+                         % manifest_path)
+
+    names = set()
+    for i, job in enumerate(jobs):
+        if not isinstance(job, dict) or \
+                not isinstance(job.get('args', []), list):
+            raise ValueError("Invalid job #%d in manifest '%s': %s"
+                             % (i, manifest_path, job))
+        job.setdefault('args', [])
+        job['name'] = str(job.get('name') or 'job-%d' % i)
+        if job['name'] in names:
+            raise ValueError("Duplicate job name '%s' in manifest '%s'."
+                             % (job['name'], manifest_path))
+        names.add(job['name'])
+    return jobs
+
+
+def run_jobs(jobs, run_job, concurrency=DEFAULT_CONCURRENCY,
+             log_dir=DEFAULT_LOG_DIR):
+    """Run `run_job(job, log_path)` for each job on a worker pool.
+
+    `run_job` returns the job's exit code. Returns one result per job,
+    in the order of `jobs`, with exit code, duration and log path.
+    """
+    if not path.isdir(log_dir):
+        os.makedirs(log_dir)
+
+    def run_one(job):
+        log_path = path.join(
+            log_dir, UNSAFE_NAME_CHARS_RE.sub('_', job['name']) + '.log')
+        result = {'name': job['name'], 'log': log_path}
+        started = time.time()
+        try:
+            result['exit_code'] = run_job(job, log_path)
+        except Exception as e:
+            LOG.exception("Batch job '%s' failed", job['name'])
+            result['exit_code'] = None
+            result['error'] = str(e)
+        result['duration'] = round(time.time() - started, 3)
+        LOG.info("Batch job '%s' finished with exit code %s in %.1fs",
+                 job['name'], result['exit_code'], result['duration'])
+        return result
+
+    from multiprocessing import pool
+    worker_pool = pool.ThreadPool(max(1, concurrency))
+    try:
+        return worker_pool.map(run_one, jobs, chunksize=1)
+    finally:
+        worker_pool.close()
+        worker_pool.join()
+
+
+def job_failed(result):
+    return result.get('exit_code') != 0
+
+
+def write_summary(results, summary_path=None):
+    summary = {
+        'jobs': results,
+        'total': len(results),
+        'failed': len([r for r in results if job_failed(r)]),
+    }
+    if summary_path:
+        with open(summary_path, 'w') as summary_file:
+            json.dump(summary, summary_file, indent=2, sort_keys=True)
+    else:
+        json.dump(summary, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    return summary
+
+
+def pop_batch_options(args):
+    """Remove common batch mode options from `args`.
+
+    Returns a tuple (options, remaining_args), remaining_args being an
+    arguments.ArgList.
+    """
+    args = arguments.tokenize(args)
+    concurrency = args.last('--batch-jobs')
+    options = {
+        'manifest': args.last('--batch'),
+        'concurrency': (int(concurrency) if concurrency
+                        else DEFAULT_CONCURRENCY),
+        'log_dir': args.last('--batch-log-dir', DEFAULT_LOG_DIR),
+        'summary': args.last('--batch-summary'),
+    }
+    return options, args.without('--batch', '--batch-jobs',
+                                 '--batch-log-dir', '--batch-summary')
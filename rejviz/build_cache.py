@@ -0,0 +1,319 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License. You may
+# obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+import hashlib
+import json
+import logging
+import os
+from os import path
+import stat
+import subprocess
+
+from rejviz import arguments
+from rejviz import inspection_cache
+from rejviz import utils
+
+
+LOG = logging.getLogger(__file__)
+DIR_ENV = 'REJVIZ_BUILD_CACHE_DIR'
+CACHE_VERSION = 1
+DEFAULT_MAX_BYTES = 20 * 1024 ** 3
+IMAGE_SUFFIX = '.img'
+META_SUFFIX = '.json'
+OUTPUT_OPTIONS = ['-o', '--output']
+# options which don't change the built image
+IGNORED_FLAGS = ['-v', '--verbose', '-x', '-q', '--quiet',
+                 '--no-progress-bars']
+# options whose values refer to local files, which are hashed by contents
+LOCAL_FILE_OPTIONS = ['--upload', '--copy-in', '--run', '--firstboot']
+# options taking a password or key SELECTOR, which may be 'file:FILENAME'
+SELECTOR_OPTIONS = ['--root-password', '--password', '--ssh-inject',
+                    '--sm-credentials']
+# options whose SELECTOR is preceded by 'USER:'
+USER_SELECTOR_OPTIONS = ['--password', '--ssh-inject']
+COMMANDS_FILE_OPTION = '--commands-from-file'
+
+
+class BuildCache(object):
+    """Content-addressed cache of images built by virt-builder.
+
+    An image is stored once per distinct set of virt-builder args (with
+    local files, like the rendered NIC configs, identified by contents).
+    Outputs are created from the cached image as qcow2 overlays (when
+    building qcow2 and the cache is readable by the qemu of the system
+    libvirt) or reflink copies. Least recently used images are evicted
+    when the cache grows over `max_bytes`, except images which are
+    still backing some overlay.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir or os.environ.get(DIR_ENV)
+        if not self.cache_dir:
+            self.cache_dir = utils.cache_dir('builds')
+        elif not path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self.max_bytes = max_bytes
+
+    def build(self, args, build_image):
+        """Create the output image requested in `args`.
+
+        `build_image(args)` is called with the output redirected into
+        the cache on a cache miss, and returns the exit code of the
+        build. Returns the exit code.
+        """
+        args = arguments.tokenize(args, arguments.VIRT_BUILDER_OPTIONS,
+                                  flag_options=())
+        output_path = args.last('--output', args.last('-o'))
+        build_args = args.without(*OUTPUT_OPTIONS)
+        key = cache_key(build_args.args)
+        if not output_path or not key:
+            LOG.info('Build cannot be cached, building without cache')
+            return build_image(args.args)
+
+        with utils.locked(self._path(key, '.lock')):
+            if not path.exists(self._path(key, IMAGE_SUFFIX)):
+                LOG.info('Build cache miss, building image %s', key)
+                exit_code = self._build_into_cache(key, build_args,
+                                                   build_image)
+                if exit_code != 0:
+                    return exit_code
+            else:
+                LOG.info('Build cache hit, reusing image %s', key)
+            self._create_output(key, output_path, args.last('--format'))
+        self.evict()
+        return 0
+
+    def evict(self):
+        entries = []
+        for file_name in os.listdir(self.cache_dir):
+            if not file_name.endswith(IMAGE_SUFFIX):
+                continue
+            key = file_name[:-len(IMAGE_SUFFIX)]
+            try:
+                image_stat = os.stat(self._path(key, IMAGE_SUFFIX))
+            except OSError:
+                continue
+            entries.append((image_stat.st_mtime, image_stat.st_size, key))
+
+        entries.sort()
+        total_bytes = sum(entry[1] for entry in entries)
+        for _, size, key in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            with utils.locked(self._path(key, '.lock')):
+                if self._live_overlays(key):
+                    LOG.debug('Not evicting image %s, it backs overlays', key)
+                    continue
+                for suffix in (IMAGE_SUFFIX, META_SUFFIX):
+                    try:
+                        os.unlink(self._path(key, suffix))
+                    except OSError:
+                        pass
+            total_bytes -= size
+            LOG.debug('Evicted cached image %s', key)
+
+    def _build_into_cache(self, key, args, build_image):
+        image_path = self._path(key, IMAGE_SUFFIX)
+        tmp_path = self._path('.tmp-%s-%d' % (key, os.getpid()), '.tmp')
+        try:
+            exit_code = build_image(['-o', tmp_path] + args.args)
+            if exit_code == 0:
+                os.chmod(tmp_path, 0o444)
+                self._write_meta(key, {'format': args.last('--format', 'raw'),
+                                       'overlays': []})
+                os.rename(tmp_path, image_path)
+            return exit_code
+        finally:
+            if path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    def _create_output(self, key, output_path, output_format):
+        image_path = self._path(key, IMAGE_SUFFIX)
+        meta = self._read_meta(key)
+        if output_format == 'qcow2' and _readable_by_others(image_path):
+            subprocess.check_call(
+                ['qemu-img', 'create', '-q', '-f', 'qcow2',
+                 '-F', meta['format'], '-b', image_path, output_path])
+            meta['overlays'].append(path.abspath(output_path))
+            self._write_meta(key, meta)
+        else:
+            if output_format == 'qcow2':
+                LOG.info('The build cache is private, creating a copy '
+                         'instead of an overlay, which qemu could not open '
+                         '(see $%s)', DIR_ENV)
+            subprocess.check_call(
+                ['cp', '--reflink=auto', image_path, output_path])
+            os.chmod(output_path, 0o644)
+        # mark as recently used
+        os.utime(image_path, None)
+
+    def _live_overlays(self, key):
+        image_path = path.realpath(self._path(key, IMAGE_SUFFIX))
+        meta = self._read_meta(key)
+        live = []
+        for overlay_path in meta['overlays']:
+            try:
+                with open(overlay_path, 'rb') as overlay_file:
+                    header = overlay_file.read(
+                        inspection_cache.HEADER_FINGERPRINT_SIZE)
+                backing_file = inspection_cache.qcow2_backing_file(
+                    overlay_path, header)
+            except (IOError, OSError, ValueError):
+                continue
+            if backing_file and path.realpath(backing_file) == image_path:
+                live.append(overlay_path)
+        if live != meta['overlays']:
+            meta['overlays'] = live
+            self._write_meta(key, meta)
+        return live
+
+    def _read_meta(self, key):
+        try:
+            with open(self._path(key, META_SUFFIX)) as meta_file:
+                return json.load(meta_file)
+        except (IOError, OSError, ValueError):
+            return {'format': 'raw', 'overlays': []}
+
+    def _write_meta(self, key, meta):
+        utils.write_file_atomic(self._path(key, META_SUFFIX),
+                                json.dumps(meta, sort_keys=True))
+
+    def _path(self, key, suffix):
+        return path.join(self.cache_dir, key + suffix)
+
+
+def cache_key(args):
+    """Hash of normalized virt-builder `args` (without the output path).
+
+    Returns None if the args refer to local files which can't be read,
+    or ask for something which must not be reused (random passwords).
+    """
+    try:
+        normalized = [CACHE_VERSION] + _normalize_args(args)
+    except (IOError, OSError, ValueError) as e:
+        LOG.debug('Build cannot be cached: %s', e)
+        return None
+
+    serialized = json.dumps(normalized)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+
+def _normalize_args(args, in_commands_file=False):
+    normalized = []
+    args_iter = iter(_split_long_options(args))
+    for arg in args_iter:
+        if arg in OUTPUT_OPTIONS:
+            next(args_iter, None)
+        elif arg in IGNORED_FLAGS:
+            continue
+        elif arg in LOCAL_FILE_OPTIONS:
+            value = next(args_iter, '')
+            local_path, sep, remote_path = value.partition(':')
+            normalized += [arg, _hash_path(local_path), sep, remote_path]
+        elif arg in SELECTOR_OPTIONS:
+            normalized += [arg, _normalize_selector(arg,
+                                                    next(args_iter, ''))]
+        elif arg == COMMANDS_FILE_OPTION:
+            if in_commands_file:
+                raise ValueError('Nested %s' % COMMANDS_FILE_OPTION)
+            normalized += [arg, _normalize_args(
+                _read_commands_file(next(args_iter, '')),
+                in_commands_file=True)]
+        else:
+            normalized.append(arg)
+    return normalized
+
+
+def _normalize_selector(option, value):
+    """`value` of a SELECTOR_OPTIONS option, with files hashed."""
+    parts = value.split(':')
+    if option in USER_SELECTOR_OPTIONS:
+        if len(parts) == 1:
+            # the user's default ssh key on this host
+            raise ValueError("'%s %s' reads a key of the local user"
+                             % (option, value))
+        first_selector_part = 1
+    else:
+        first_selector_part = 0
+
+    for i in range(first_selector_part, len(parts)):
+        if parts[i] in ('password', 'string'):
+            # the rest is a literal
+            break
+        if parts[i] == 'random':
+            raise ValueError("'%s %s' must not be reused" % (option, value))
+        if parts[i] == 'file':
+            file_path = ':'.join(parts[i + 1:])
+            return ':'.join(parts[:i + 1] + [_hash_path(file_path)])
+    return value
+
+
+def _read_commands_file(file_path):
+    """Args for the commands in a virt-builder --commands-from-file."""
+    args = []
+    with open(file_path) as commands_file:
+        command = ''
+        for line in commands_file:
+            line = line.strip()
+            if line.endswith('\\'):
+                command += line[:-1]
+                continue
+            command += line
+            if command and not command.startswith('#'):
+                option, _, value = command.partition(' ')
+                args += ['--' + option] + ([value] if value else [])
+            command = ''
+    return args
+
+
+def _split_long_options(args):
+    split = []
+    for arg in args:
+        if arg.startswith('--') and '=' in arg:
+            split += arg.split('=', 1)
+        else:
+            split.append(arg)
+    return split
+
+
+def _hash_path(local_path):
+    digest = hashlib.sha256()
+    if path.isdir(local_path):
+        for root, dirs, files in os.walk(local_path):
+            dirs.sort()
+            for file_name in sorted(files):
+                file_path = path.join(root, file_name)
+                digest.update(path.relpath(file_path, local_path)
+                              .encode('utf-8'))
+                digest.update(_hash_path(file_path).encode('utf-8'))
+    else:
+        digest.update(oct(os.stat(local_path).st_mode & 0o777)
+                      .encode('utf-8'))
+        with open(local_path, 'rb') as local_file:
+            for chunk in iter(lambda: local_file.read(1024 * 1024), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _readable_by_others(file_path):
+    """Whether users other than the owner (like qemu) can read a file."""
+    file_path = path.realpath(file_path)
+    if not os.stat(file_path).st_mode & stat.S_IROTH:
+        return False
+    dir_path = path.dirname(file_path)
+    while True:
+        if not os.stat(dir_path).st_mode & stat.S_IXOTH:
+            return False
+        parent = path.dirname(dir_path)
+        if parent == dir_path:
+            return True
+        dir_path = parent
@@ -11,34 +11,142 @@
 # permissions and limitations under the License.
 
 import logging
+import os
+from os import path
 import subprocess
 import sys
 
-from rejviz import nic
+from rejviz import admission
+from rejviz import arguments
+from rejviz import batch
 from rejviz import tmp
+from rejviz import trace
 
 
-logging.basicConfig(level=logging.INFO)
 LOG = logging.getLogger(__name__)
 
 
 def main():
+    logging.basicConfig(level=logging.INFO)
+    # tokenized once here, the ArgList is passed down to the processing
+    args = trace.start(sys.argv[1:])
+    exec_mode = args.has('--exec')
+    args = args.without('--exec')
     try:
-        tmp_dir = tmp.create_dir()
-        LOG.debug('Created tmp directory %s', tmp_dir)
-        virt_builder_args = _process_args(sys.argv[1:], tmp_dir)
-        _run_virt_builder(virt_builder_args)
+        with trace.span('rejviz-builder'):
+            if batch.is_batch(args):
+                if exec_mode:
+                    LOG.warning('--exec is ignored in batch mode')
+                sys.exit(_main_batch(args))
+            _main(args, exec_mode)
+    finally:
+        trace.finish()
+
+
+def _main(args, exec_mode=False):
+    tmp_dir = tmp.create_dir()
+    LOG.debug('Created tmp directory %s', tmp_dir)
+    try:
+        _build(args, tmp_dir, exec_mode)
     finally:
         tmp.remove_dir(tmp_dir)
         LOG.debug('Removed tmp directory %s', tmp_dir)
 
 
+def _main_batch(args):
+    options, common_args = batch.pop_batch_options(args)
+    jobs = batch.load_manifest(options['manifest'])
+    LOG.info('Building %d images, %d at a time', len(jobs),
+             options['concurrency'])
+
+    def run_job(job, log_path):
+        return _run_batch_job(job, common_args, log_path)
+
+    results = batch.run_jobs(jobs, run_job, options['concurrency'],
+                             options['log_dir'])
+    summary = batch.write_summary(results, options['summary'])
+    return 1 if summary['failed'] else 0
+
+
+def _run_batch_job(job, common_args, log_path):
+    job_args = common_args.args + job['args']
+    for nic_values in job.get('nics', []):
+        job_args += ['--nic', nic_values]
+
+    tmp_dir = tmp.create_dir()
+    try:
+        with open(log_path, 'w') as log_file:
+            return _build(job_args, tmp_dir, stdout=log_file,
+                          stderr=subprocess.STDOUT)
+    finally:
+        tmp.remove_dir(tmp_dir)
+
+
+def _build(args, tmp_dir, exec_mode=False, **call_kwargs):
+    args = arguments.tokenize(args)
+    use_cache = args.has('--build-cache')
+    max_gib = args.last('--build-cache-max-gib')
+    args = args.without('--build-cache', '--build-cache-max-gib')
+    with trace.span('nic.process_args'):
+        virt_builder_args = _process_args(args, tmp_dir)
+
+    if exec_mode:
+        if use_cache:
+            LOG.warning('--exec is ignored with --build-cache, the cache '
+                        'needs to store the built image')
+        else:
+            _exec_virt_builder(virt_builder_args, tmp_dir)
+
+    def build_image(build_args):
+        return _run_virt_builder(build_args, **call_kwargs)
+
+    if not use_cache:
+        return build_image(virt_builder_args)
+
+    from rejviz import build_cache
+    max_bytes = (int(max_gib) * 1024 ** 3 if max_gib
+                 else build_cache.DEFAULT_MAX_BYTES)
+    cache = build_cache.BuildCache(max_bytes=max_bytes)
+    with trace.span('build_cache.build'):
+        return cache.build(virt_builder_args, build_image)
+
+
 def _process_args(args, tmp_dir):
+    # pass-through invocations don't need the NIC machinery (jinja2,
+    # libvirt) loaded at all
+    args = arguments.tokenize(args)
+    if not (args.has('--nic') or args.has('--nic-injection')):
+        return args.args
+
+    from rejviz import nic
     processed = nic.process_args(args, tmp_dir)
     return processed
 
 
-def _run_virt_builder(args):
+def _exec_virt_builder(args, tmp_dir):
+    """Replace this process with virt-builder, does not return."""
+    command_line = ["virt-builder"] + args
+    LOG.info("Executing virt-builder: %s" % " ".join(command_line))
+    tmp.remove_dir_after_exit(tmp_dir)
+    # virt-builder inherits the slot, it's freed when virt-builder exits
+    if admission.default_controller().enabled:
+        admission.default_controller().acquire().keep_locked_across_exec()
+    trace.finish()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.execvp(command_line[0], command_line)
+
+
+def _run_virt_builder(args, **call_kwargs):
     command_line = ["virt-builder"] + args
     LOG.info("Calling virt-builder: %s" % " ".join(command_line))
-    subprocess.call(command_line)
+    with admission.appliance_slot('virt-builder'), \
+            trace.span('virt-builder', args=len(args)) as span_args:
+        exit_code = subprocess.call(command_line, **call_kwargs)
+        span_args['exit_code'] = exit_code
+        output_args = arguments.tokenize(
+            args, arguments.VIRT_BUILDER_OPTIONS, flag_options=())
+        output_path = output_args.last('--output', output_args.last('-o'))
+        if output_path and path.exists(output_path):
+            span_args['output_bytes'] = path.getsize(output_path)
+    return exit_code
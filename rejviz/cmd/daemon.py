@@ -0,0 +1,99 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License. You may
+# obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+import logging
+from os import path
+import signal
+import sys
+import threading
+
+from rejviz import arguments
+from rejviz import daemon
+from rejviz import inspection
+from rejviz import libvirt_nets
+from rejviz import nic
+from rejviz import nic_mappings
+from rejviz import render
+from rejviz import utils
+
+
+LOG = logging.getLogger(__name__)
+WARM_TEMPLATES = ['ifcfg-eth.j2', inspection.FETCH_SCRIPT_TEMPLATE]
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = arguments.tokenize(sys.argv[1:], value_options=['--socket'],
+                              flag_options=())
+    sock_path = args.last('--socket', daemon.socket_path())
+    unknown_args = args.without('--socket').args
+    if unknown_args:
+        raise ValueError('Unknown arguments: %s' % ' '.join(unknown_args))
+    if not sock_path:
+        raise ValueError('No socket path, $%s is empty.' % daemon.SOCKET_ENV)
+
+    server = daemon.listen(sock_path, methods())
+    # SystemExit unwinds serve_forever, so that the socket gets removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    warmer = threading.Thread(target=warm_up, name='rejvizd-warm-up')
+    warmer.daemon = True
+    warmer.start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def methods():
+    return {
+        'nic.process_args': _process_nic_args,
+        'nic_mappings.process_nic_mappings': _process_nic_mappings,
+    }
+
+
+def warm_up():
+    """Pay the one-time costs before the first client comes."""
+    for template in WARM_TEMPLATES:
+        render.get_environment().get_template(template)
+    try:
+        libvirt_nets.default_index()
+    except Exception as e:
+        LOG.warning('Could not connect to libvirt yet: %s', e)
+    try:
+        inspection.warm_appliance()
+    except Exception as e:
+        LOG.warning('Could not warm up the libguestfs appliance: %s', e)
+    LOG.info('rejvizd warmed up')
+
+
+def _process_nic_args(args, tmp_dir):
+    return nic.process_args(args, tmp_dir, use_daemon=False)
+
+
+def _process_nic_mappings(args, cwd):
+    nics = networks = None
+    arg_list = arguments.tokenize(args)
+    if nic_mappings.has_nic_mapping_args(arg_list):
+        no_cache = arg_list.has('--no-inspection-cache')
+        refresh_cache = arg_list.has('--refresh-inspection')
+        # the image path is relative to the client, not to rejvizd
+        image_path = utils.extract_image_args_from_disks(arg_list)[1]
+        # networks first, so that NICs are mapped as they are inspected
+        networks = libvirt_nets.get_libvirt_networks()
+        nics = nic_mappings.iter_nics_from_image(
+            ['--disk', path.join(cwd, image_path)],
+            use_cache=not no_cache, refresh_cache=refresh_cache)
+    return nic_mappings.process_nic_mappings(args, nics=nics,
+                                             networks=networks,
+                                             use_daemon=False)
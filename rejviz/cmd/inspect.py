@@ -0,0 +1,140 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License. You may
+# obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+import argparse
+import functools
+import json
+import logging
+import multiprocessing
+import os
+from os import path
+import sys
+import time
+
+from rejviz import inspection
+from rejviz import inspection_cache
+from rejviz import trace
+
+
+LOG = logging.getLogger(__name__)
+IMAGE_SUFFIXES = ('.qcow2', '.img', '.raw', '.vmdk', '.vdi', '.vhd',
+                  '.vhdx')
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = trace.start(sys.argv[1:])
+    try:
+        with trace.span('rejviz-inspect'):
+            sys.exit(_main(_parse_args(args)))
+    finally:
+        trace.finish()
+
+
+def _parse_args(args):
+    parser = argparse.ArgumentParser(
+        prog='rejviz-inspect',
+        description='Inspect NIC configs of images and libvirt domains, '
+                    'writing one JSON record per line as each finishes.')
+    parser.add_argument('paths', nargs='*', metavar='PATH',
+                        help='Image, or directory searched for images '
+                             '(%s).' % ', '.join(IMAGE_SUFFIXES))
+    parser.add_argument('-d', '--domain', dest='domains', action='append',
+                        default=[], help='libvirt domain to inspect.')
+    parser.add_argument('-j', '--jobs', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='Images inspected at once (default: number '
+                             'of CPUs).')
+    parser.add_argument('--mode', default=inspection.MODE_RAW,
+                        choices=[inspection.MODE_RAW,
+                                 inspection.MODE_AUGEAS])
+    parser.add_argument('--no-inspection-cache', dest='use_cache',
+                        action='store_false')
+    parser.add_argument('--refresh-inspection', action='store_true')
+    options = parser.parse_args(args)
+    if not options.paths and not options.domains:
+        parser.error('no images or domains given')
+    return options
+
+
+def _main(options):
+    targets = _find_images(options.paths) + [
+        ['-d', domain] for domain in options.domains]
+    LOG.info('Inspecting %d images, %d at a time', len(targets),
+             options.jobs)
+
+    inspect = functools.partial(_inspect_traced, mode=options.mode,
+                                use_cache=options.use_cache,
+                                refresh_cache=options.refresh_inspection)
+    worker_pool = multiprocessing.Pool(max(1, options.jobs))
+    failed = 0
+    try:
+        # records are written in the order the images finish
+        for record, trace_events in worker_pool.imap_unordered(
+                inspect, targets, chunksize=1):
+            trace.add_events(trace_events)
+            sys.stdout.write(json.dumps(record, sort_keys=True) + '\n')
+            sys.stdout.flush()
+            if 'error' in record:
+                failed += 1
+        worker_pool.close()
+    finally:
+        worker_pool.terminate()
+        worker_pool.join()
+    if failed:
+        LOG.error('Inspecting %d of %d images failed', failed, len(targets))
+        return 1
+    return 0
+
+
+def _find_images(paths):
+    """Image args for `paths`, with directories searched recursively."""
+    images = []
+    for image_path in paths:
+        if not path.isdir(image_path):
+            images.append(['-a', image_path])
+            continue
+        for root, dirs, files in os.walk(image_path):
+            dirs.sort()
+            images += [['-a', path.join(root, file_name)]
+                       for file_name in sorted(files)
+                       if file_name.endswith(IMAGE_SUFFIXES)]
+    return images
+
+
+def _inspect_traced(image_args, **kwargs):
+    """_inspect, returns its record and the spans it recorded."""
+    with trace.span('rejviz-inspect.image', image_args=image_args):
+        record = _inspect(image_args, **kwargs)
+    return record, trace.take_events()
+
+
+def _inspect(image_args, mode=inspection.MODE_RAW, use_cache=True,
+             refresh_cache=False):
+    """Inspect one image in a worker process, returns its record."""
+    started = time.time()
+    record = {'image' if image_args[0] == '-a' else 'domain': image_args[1]}
+    try:
+        cache = inspection_cache.InspectionCache() if use_cache else None
+        nics = None
+        if cache and not refresh_cache:
+            nics = cache.get(image_args, mode=mode)
+        record['cached'] = nics is not None
+        if nics is None:
+            nics = inspection.fetch_nics(image_args, mode=mode)
+            if cache:
+                cache.put(image_args, nics, mode=mode)
+        record['nics'] = nics
+    except Exception as e:
+        record['error'] = str(e) or type(e).__name__
+    record['seconds'] = round(time.time() - started, 3)
+    return record
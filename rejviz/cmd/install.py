@@ -11,25 +11,151 @@
 # permissions and limitations under the License.
 
 import logging
+import os
+from os import path
 import subprocess
 import sys
 
+from rejviz import batch
 from rejviz import nic_mappings
+from rejviz import trace
+from rejviz import utils
+
 
-logging.basicConfig(level=logging.INFO)
 LOG = logging.getLogger(__name__)
 
 
 def main():
-    virt_install_args = _process_args(sys.argv[1:])
-    _run_virt_install(virt_install_args)
+    logging.basicConfig(level=logging.INFO)
+    args = trace.start(sys.argv[1:])
+    exec_mode = args.has('--exec')
+    args = args.without('--exec')
+    try:
+        with trace.span('rejviz-install'):
+            if batch.is_batch(args):
+                if exec_mode:
+                    LOG.warning('--exec is ignored in batch mode')
+                sys.exit(_main_batch(args))
+            virt_install_args = _process_args(args)
+            if exec_mode:
+                _exec_virt_install(virt_install_args)
+            _run_virt_install(virt_install_args)
+    finally:
+        trace.finish()
+
+
+def _main_batch(args):
+    options, common_args = batch.pop_batch_options(args)
+    no_cache = common_args.has('--no-inspection-cache')
+    refresh_cache = common_args.has('--refresh-inspection')
+    common_args = common_args.without('--no-inspection-cache',
+                                      '--refresh-inspection')
+    jobs = batch.load_manifest(options['manifest'])
+    for job in jobs:
+        job['args'] = common_args.args + job['args']
+
+    # every distinct image is inspected once, and one snapshot of
+    # libvirt networks is used for all VMs
+    nics_by_image = _inspect_images(
+        [job['args'] for job in jobs], options['concurrency'],
+        use_cache=not no_cache, refresh_cache=refresh_cache)
+    networks = None
+    if nics_by_image:
+        from rejviz import libvirt_nets
+        networks = libvirt_nets.get_libvirt_networks()
+
+    def run_job(job, log_path):
+        nics = None
+        if nic_mappings.has_nic_mapping_args(job['args']):
+            nics = nics_by_image[_image_key(job['args'])]
+            if isinstance(nics, Exception):
+                raise nics
+        virt_install_args = nic_mappings.process_nic_mappings(
+            job['args'], nics=nics, networks=networks)
+        with open(log_path, 'w') as log_file:
+            return _run_virt_install(virt_install_args, stdout=log_file,
+                                     stderr=subprocess.STDOUT)
+
+    LOG.info('Installing %d VMs, %d at a time', len(jobs),
+             options['concurrency'])
+    results = batch.run_jobs(jobs, run_job, options['concurrency'],
+                             options['log_dir'])
+    summary = batch.write_summary(results, options['summary'])
+    return 1 if summary['failed'] else 0
+
+
+def _inspect_images(jobs_args, concurrency, use_cache=True,
+                    refresh_cache=False):
+    """Fetch NICs of every distinct image used with NIC mappings.
+
+    Returns a dict of image key => NIC list, or the exception raised
+    while inspecting the image, so that only VMs using that image fail.
+    """
+    images = {}
+    for args in jobs_args:
+        if not nic_mappings.has_nic_mapping_args(args):
+            continue
+        try:
+            images.setdefault(_image_key(args), args)
+        except ValueError:
+            # reported as the VM's failure when processing its args
+            continue
+
+    # images are inspected in chunks sharing one appliance, as many
+    # chunks at a time as the concurrency allows
+    from rejviz import inspection
+    image_keys = list(images)
+    chunk_size = max(1, min(inspection.MAX_DRIVES,
+                            -(-len(image_keys) // max(1, concurrency))))
+    chunks = [image_keys[i:i + chunk_size]
+              for i in range(0, len(image_keys), chunk_size)]
+
+    def inspect(chunk):
+        results = nic_mappings.fetch_nics_from_images(
+            [images[image_key] for image_key in chunk],
+            use_cache=use_cache, refresh_cache=refresh_cache)
+        for image_key, nics in zip(chunk, results):
+            if isinstance(nics, Exception):
+                LOG.error('Inspecting %s failed: %s', image_key[-1], nics)
+        return zip(chunk, results)
+
+    LOG.info('Inspecting %d distinct images', len(images))
+    from multiprocessing import pool
+    worker_pool = pool.ThreadPool(max(1, concurrency))
+    try:
+        nics_by_image = {}
+        for chunk_results in worker_pool.map(inspect, chunks, chunksize=1):
+            nics_by_image.update(chunk_results)
+        return nics_by_image
+    finally:
+        worker_pool.close()
+        worker_pool.join()
+
+
+def _image_key(args):
+    image_args = utils.extract_image_args_from_disks(args)
+    return tuple(path.realpath(arg) if i % 2 else arg
+                 for i, arg in enumerate(image_args))
 
 
 def _process_args(unprocessed_args):
-    return nic_mappings.process_nic_mappings(unprocessed_args)
+    with trace.span('nic_mappings.process_nic_mappings'):
+        return nic_mappings.process_nic_mappings(unprocessed_args)
+
+
+def _exec_virt_install(args):
+    """Replace this process with virt-install, does not return."""
+    command_line = ["virt-install"] + args
+    LOG.info("Executing virt-install: %s" % " ".join(command_line))
+    trace.finish()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.execvp(command_line[0], command_line)
 
 
-def _run_virt_install(args):
+def _run_virt_install(args, **call_kwargs):
     command_line = ["virt-install"] + args
     LOG.info("Calling virt-install: %s" % " ".join(command_line))
-    subprocess.call(command_line)
+    with trace.span('virt-install', args=len(args)) as span_args:
+        span_args['exit_code'] = subprocess.call(command_line, **call_kwargs)
+    return span_args['exit_code']
@@ -0,0 +1,213 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License. You may
+# obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+import errno
+import json
+import logging
+import os
+from os import path
+import socket
+import stat
+import struct
+import tempfile
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from rejviz import trace
+from rejviz import utils
+
+
+LOG = logging.getLogger(__file__)
+SOCKET_ENV = 'REJVIZ_SOCKET'
+SOCKET_NAME = 'rejvizd.sock'
+# errors which are re-raised as the same type in the client
+FORWARDED_ERRORS = {'ValueError': ValueError, 'RuntimeError': RuntimeError}
+# not exported by the socket module of Python 2
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17)
+
+
+class DaemonUnavailable(RuntimeError):
+    pass
+
+
+def socket_path():
+    """Path of the rejvizd socket, or None when disabled.
+
+    $REJVIZ_SOCKET overrides the default path in the user's runtime
+    dir, setting it empty disables the daemon.
+    """
+    env_path = os.environ.get(SOCKET_ENV)
+    if env_path is not None:
+        return env_path or None
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return path.join(runtime_dir, 'rejviz', SOCKET_NAME)
+    return path.join(tempfile.gettempdir(), 'rejviz-%d' % os.getuid(),
+                     SOCKET_NAME)
+
+
+def call(method, **params):
+    """Call `method` in a running rejvizd, returns its result.
+
+    Raises DaemonUnavailable when no daemon of the user is listening,
+    so that the caller can do the work in-process instead.
+    """
+    sock_path = socket_path()
+    if not sock_path or not path.exists(sock_path):
+        raise DaemonUnavailable('rejvizd is not running')
+    _check_socket(sock_path)
+
+    with trace.span('rejvizd.call', method=method):
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            try:
+                client.connect(sock_path)
+            except (IOError, OSError) as e:
+                # a socket left behind by a daemon that is gone
+                raise DaemonUnavailable('Cannot connect to rejvizd: %s' % e)
+            server_uid = _peer_uid(client)
+            if server_uid != os.getuid():
+                LOG.warning('Not using rejvizd on %s, it runs as uid %d',
+                            sock_path, server_uid)
+                raise DaemonUnavailable('rejvizd runs as another user')
+            request = json.dumps({'method': method, 'params': params})
+            client.sendall(request.encode('utf-8') + b'\n')
+            client.shutdown(socket.SHUT_WR)
+            response = _read_all(client)
+        finally:
+            client.close()
+
+    if not response:
+        raise RuntimeError("rejvizd closed the connection during '%s'."
+                           % method)
+    response = json.loads(response.decode('utf-8'))
+    if 'error' in response:
+        error_class = FORWARDED_ERRORS.get(response['error']['type'],
+                                           RuntimeError)
+        raise error_class(response['error']['message'])
+    return response['result']
+
+
+def listen(sock_path, methods):
+    """Create a Server serving `methods` (name => function) on `sock_path`.
+
+    The caller runs `serve_forever()` and `server_close()`.
+    """
+    _ensure_socket_dir(path.dirname(sock_path))
+    _remove_stale_socket(sock_path)
+    server = Server(sock_path, methods)
+    LOG.info('rejvizd listening on %s', sock_path)
+    return server
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serves one JSON request per connection, each in its own thread."""
+
+    daemon_threads = True
+
+    def __init__(self, sock_path, methods):
+        self.methods = methods
+        socketserver.UnixStreamServer.__init__(self, sock_path,
+                                               RequestHandler)
+        os.chmod(sock_path, 0o600)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        request_line = self.rfile.readline()
+        if _peer_uid(self.request) != os.getuid():
+            self._respond({'error': {'type': 'RuntimeError',
+                                     'message': 'Permission denied'}})
+            return
+        try:
+            request = json.loads(request_line.decode('utf-8'))
+            method = self.server.methods[request['method']]
+        except (ValueError, KeyError, TypeError) as e:
+            self._respond({'error': {'type': 'ValueError',
+                                     'message': 'Bad request: %s' % e}})
+            return
+
+        LOG.debug('Calling %s', request['method'])
+        try:
+            result = method(**request.get('params', {}))
+        except Exception as e:
+            LOG.warning('%s failed: %s', request['method'], e)
+            self._respond({'error': {'type': type(e).__name__,
+                                     'message': str(e)}})
+            return
+        self._respond({'result': result})
+
+    def _respond(self, response):
+        try:
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+        except (IOError, OSError) as e:
+            LOG.debug('Client went away: %s', e)
+
+
+def _read_all(client):
+    chunks = []
+    for chunk in iter(lambda: client.recv(65536), b''):
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+def _peer_uid(sock):
+    """Uid of the process on the other end of a Unix socket."""
+    creds = sock.getsockopt(socket.SOL_SOCKET, SO_PEERCRED,
+                            struct.calcsize('3i'))
+    return struct.unpack('3i', creds)[1]
+
+
+def _check_socket(sock_path):
+    """Refuse sockets which other users could have planted."""
+    try:
+        utils.check_private_dir(path.dirname(sock_path))
+        sock_stat = os.lstat(sock_path)
+        if (not stat.S_ISSOCK(sock_stat.st_mode) or
+                sock_stat.st_uid != os.getuid()):
+            raise RuntimeError("'%s' is not a socket of uid %d."
+                               % (sock_path, os.getuid()))
+    except (RuntimeError, OSError) as e:
+        LOG.warning('Not using rejvizd: %s', e)
+        raise DaemonUnavailable(str(e))
+
+
+def _ensure_socket_dir(dir_path):
+    if not path.lexists(dir_path):
+        os.makedirs(dir_path, 0o700)
+    utils.check_private_dir(dir_path)
+
+
+def _remove_stale_socket(sock_path):
+    if not path.exists(sock_path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(sock_path)
+    except (IOError, OSError) as e:
+        if e.errno not in (errno.ECONNREFUSED, errno.ENOENT):
+            raise
+        LOG.info('Removing stale socket %s', sock_path)
+        os.unlink(sock_path)
+        return
+    finally:
+        probe.close()
+    raise RuntimeError('rejvizd is already running on %s' % sock_path)
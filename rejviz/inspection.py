@@ -0,0 +1,559 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License. You may
+# obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+import logging
+import os
+from os import path
+import re
+import shlex
+import subprocess
+import tarfile
+import tempfile
+import threading
+
+try:
+    import guestfs
+except ImportError:
+    guestfs = None
+
+from rejviz import admission
+from rejviz import render
+from rejviz import trace
+
+
+LOG = logging.getLogger(__file__)
+NIC_CONFIG_DIR = '/etc/sysconfig/network-scripts'
+NIC_CONFIG_PREFIX = 'ifcfg-'
+NIC_KEYS = ['type', 'hwaddr', 'bootproto', 'ipaddr', 'network', 'netmask']
+FETCH_SCRIPT_TEMPLATE = 'fetch_nic.guestfish.j2'
+GUESTFISH_PID_RE = re.compile(r'GUESTFISH_PID=(\d+)')
+MODE_RAW = 'raw'
+MODE_AUGEAS = 'augeas'
+# images attached to one appliance, well below the libguestfs limit
+MAX_DRIVES = 16
+
+
+def fetch_nics(image_args, mode=MODE_RAW):
+    """Fetch NIC configs from an image, booting the appliance only once.
+
+    In 'raw' mode the whole network-scripts directory is transferred
+    from the image as a single tarball and the ifcfg files are parsed
+    here. In 'augeas' mode the files are listed and read through augeas
+    in one session. Both use libguestfs Python bindings when they are
+    installed, otherwise guestfish. If that fails, falls back to the
+    virt-ls + guestfish pair, which boots the appliance twice. Returns
+    the NICs sorted by name.
+    """
+    return sorted(iter_nics(image_args, mode), key=lambda nic: nic['name'])
+
+
+def iter_nics(image_args, mode=MODE_RAW):
+    """Like fetch_nics, but yields NICs as they are read from the image.
+
+    With guestfish, NICs are yielded while the appliance is still
+    reading the rest. If the single-session inspection fails after
+    yielding some NICs, the fallback only yields the remaining ones.
+    """
+    if mode == MODE_RAW:
+        fetch = _fetch_nics_raw
+    elif mode == MODE_AUGEAS:
+        fetch = _fetch_nics_in_session
+    else:
+        raise ValueError("Unknown NIC discovery mode '%s'" % mode)
+
+    # the appliances of the fallback are launched one after another, so
+    # a single slot covers them too
+    with admission.appliance_slot('inspection'), \
+            trace.span('inspection.fetch_nics', mode=mode) as span_args:
+        yielded = set()
+        try:
+            for nic in fetch(image_args):
+                yielded.add(nic['name'])
+                yield nic
+        except (RuntimeError, OSError, subprocess.CalledProcessError,
+                tarfile.TarError) as e:
+            LOG.warning('Single-session NIC inspection failed (%s), falling '
+                        'back to virt-ls and guestfish.', e)
+            span_args['fallback'] = str(e)
+            for nic in _fetch_nics_legacy(image_args):
+                if nic['name'] not in yielded:
+                    yielded.add(nic['name'])
+                    yield nic
+        span_args['nics'] = len(yielded)
+
+
+def fetch_nics_multi(image_args_list, max_drives=MAX_DRIVES):
+    """Fetch NIC configs from many images, sharing appliance launches.
+
+    Up to `max_drives` single-drive images ('-a') are attached read-only
+    to one appliance, and the root of each is mounted in turn. Images
+    which can't be inspected that way (domains, roots not found, e.g.
+    due to clashing LVM volume groups, or errors) are inspected one by
+    one with fetch_nics. Returns a list with the NICs of each image, or
+    the exception raised while inspecting it.
+    """
+    results = [None] * len(image_args_list)
+    shared = [i for i, image_args in enumerate(image_args_list)
+              if len(image_args) == 2 and image_args[0] == '-a']
+    for chunk_start in range(0, len(shared), max(1, max_drives)):
+        chunk = shared[chunk_start:chunk_start + max(1, max_drives)]
+        image_paths = [image_args_list[i][1] for i in chunk]
+        try:
+            chunk_nics = _fetch_nics_shared(image_paths)
+        except (RuntimeError, OSError, subprocess.CalledProcessError) as e:
+            LOG.warning('Inspecting %d images in one appliance failed (%s), '
+                        'inspecting them one by one.', len(chunk), e)
+            chunk_nics = {}
+        for drive_index, nics in chunk_nics.items():
+            results[chunk[drive_index]] = nics
+
+    for i, image_args in enumerate(image_args_list):
+        if results[i] is not None:
+            continue
+        try:
+            results[i] = fetch_nics(image_args)
+        except Exception as e:
+            results[i] = e
+    return results
+
+
+def warm_appliance():
+    """Launch an appliance without any image and shut it down.
+
+    The first launch builds the cached appliance and pulls its files
+    into the page cache, which long-running processes can do ahead of
+    the first real inspection.
+    """
+    with admission.appliance_slot('warm-up'), trace.span(
+            'inspection.warm_appliance'):
+        if guestfs is not None:
+            handle = guestfs.GuestFS(python_return_dict=True)
+            try:
+                handle.add_drive_opts('/dev/null', readonly=1)
+                handle.launch()
+            finally:
+                handle.close()
+        else:
+            with open(os.devnull, 'w') as devnull:
+                subprocess.check_call(
+                    ['guestfish', '--ro', '-a', '/dev/null', 'run'],
+                    stdout=devnull)
+
+
+def parse_nics_output(output):
+    return list(iter_nics_output(output.splitlines()))
+
+
+def iter_nics_output(lines):
+    """Parse guestfish NIC output incrementally.
+
+    Each NIC is yielded as soon as its separator line has been read, so
+    `lines` can be a pipe that is still being written to.
+    """
+    current_nic = {}
+    current_key = None
+    for line in lines:
+        if current_key is not None:
+            if line and not line.startswith('@'):
+                current_nic[current_key] = line
+                current_key = None
+                continue
+            # if next line is a key again, assign None to the current key
+            current_nic[current_key] = None
+            current_key = None
+
+        # if line is a separator, start a new NIC
+        if line == '@-----':
+            yield current_nic
+            current_nic = {}
+        # if line is a key, its value is on the next line
+        elif line.startswith('@'):
+            current_key = line[1:]
+
+
+def parse_ifcfg(contents):
+    """Parse shell variable assignments from an ifcfg file."""
+    variables = {}
+    for line in contents.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            tokens = shlex.split(line, comments=True)
+        except ValueError:
+            LOG.debug('Skipping unparsable ifcfg line: %s', line)
+            continue
+        for token in tokens:
+            if '=' in token:
+                key, value = token.split('=', 1)
+                variables[key] = value
+    return variables
+
+
+def render_fetch_script(nic_names):
+    return render.render(
+        FETCH_SCRIPT_TEMPLATE,
+        nic_config_dir=NIC_CONFIG_DIR,
+        nic_config_prefix=NIC_CONFIG_PREFIX,
+        nic_names=nic_names)
+
+
+def _fetch_nics_raw(image_args):
+    if guestfs is not None:
+        return _fetch_nics_raw_guestfs(image_args)
+    return _fetch_nics_raw_guestfish(image_args)
+
+
+def _fetch_nics_raw_guestfs(image_args):
+    handle = _launch_guestfs(image_args)
+    try:
+        with tempfile.NamedTemporaryFile() as tar_file:
+            handle.tar_out(NIC_CONFIG_DIR, tar_file.name)
+            for nic in _iter_nic_configs_tar(tar_file):
+                yield nic
+    finally:
+        handle.close()
+
+
+def _fetch_nics_raw_guestfish(image_args):
+    command = (['guestfish', '-i', '--ro'] + image_args +
+               ['tar-out', NIC_CONFIG_DIR, '-'])
+    LOG.debug('Running guestfish to fetch NIC configs: %s', str(command))
+    with trace.span('guestfish tar-out') as span_args:
+        fetcher = subprocess.Popen(command, stdout=subprocess.PIPE)
+        try:
+            for nic in _iter_nic_configs_tar(fetcher.stdout):
+                yield nic
+            # guestfish pads the archive after the end-of-archive marker,
+            # closing the pipe before that would kill it with SIGPIPE
+            fetcher.stdout.read()
+        finally:
+            fetcher.stdout.close()
+            returncode = fetcher.wait()
+            span_args['exit_code'] = returncode
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command)
+
+
+def _iter_nic_configs_tar(tar_stream):
+    # stream mode, members are parsed as they arrive
+    with tarfile.open(fileobj=tar_stream, mode='r|') as tar:
+        for member in tar:
+            file_name = path.basename(member.name)
+            if not member.isfile() or \
+                    not file_name.startswith(NIC_CONFIG_PREFIX):
+                continue
+            contents = tar.extractfile(member).read().decode('utf-8',
+                                                             'replace')
+            yield _nic_from_ifcfg(file_name[len(NIC_CONFIG_PREFIX):],
+                                  parse_ifcfg(contents))
+
+
+def _nic_from_ifcfg(nic_name, variables):
+    nic = {'name': nic_name}
+    for key in NIC_KEYS:
+        nic[key] = variables.get(key.upper()) or None
+    return nic
+
+
+def _fetch_nics_shared(image_paths):
+    """Returns a dict of drive index => NICs for the roots found."""
+    with admission.appliance_slot('inspection'), trace.span(
+            'inspection.fetch_nics_shared',
+            images=len(image_paths)) as span_args:
+        if guestfs is not None:
+            handle = guestfs.GuestFS(python_return_dict=True)
+            try:
+                for image_path in image_paths:
+                    handle.add_drive_opts(image_path, readonly=1)
+                handle.launch()
+            except Exception:
+                handle.close()
+                raise
+        else:
+            handle = GuestfishSession(image_paths)
+
+        nics_by_drive = {}
+        try:
+            roots_by_drive = {}
+            for root in handle.inspect_os():
+                drive_index = _root_drive_index(handle, root)
+                if drive_index is not None:
+                    roots_by_drive.setdefault(drive_index, root)
+            for drive_index, root in sorted(roots_by_drive.items()):
+                handle.umount_all()
+                try:
+                    _mount_root(handle, root)
+                    with tempfile.NamedTemporaryFile() as tar_file:
+                        handle.tar_out(NIC_CONFIG_DIR, tar_file.name)
+                        nics = list(_iter_nic_configs_tar(tar_file))
+                except (RuntimeError, tarfile.TarError) as e:
+                    LOG.debug('Cannot read NIC configs of %s: %s',
+                              image_paths[drive_index], e)
+                    continue
+                nics_by_drive[drive_index] = sorted(
+                    nics, key=lambda nic: nic['name'])
+        finally:
+            handle.close()
+        span_args['inspected'] = len(nics_by_drive)
+    return nics_by_drive
+
+
+def _root_drive_index(handle, root):
+    """Index of the drive holding `root`, or None if not a single one."""
+    try:
+        if handle.is_lv(root):
+            volume_group = handle.lvm_canonical_lv_name(root).split('/')[2]
+            pv_uuids = set(handle.vgpvuuids(volume_group))
+            devices = [_whole_device(handle, pv) for pv in handle.pvs()
+                       if handle.pvuuid(pv) in pv_uuids]
+        else:
+            devices = [_whole_device(handle, root)]
+        drive_indexes = set(handle.device_index(device)
+                            for device in devices)
+    except RuntimeError as e:
+        LOG.debug('Cannot find the drive of %s: %s', root, e)
+        return None
+    if len(drive_indexes) != 1:
+        return None
+    return drive_indexes.pop()
+
+
+def _whole_device(handle, device):
+    try:
+        return handle.part_to_dev(device)
+    except RuntimeError:
+        # not a partition
+        return device
+
+
+class GuestfishSession(object):
+    """The part of the libguestfs API used here, over guestfish.
+
+    Used when the Python bindings are not installed. Drives are attached
+    read-only and the appliance is launched right away.
+    """
+
+    def __init__(self, image_paths):
+        command = ['guestfish', '--listen', '--ro']
+        for image_path in image_paths:
+            command += ['-a', image_path]
+        LOG.debug('Starting guestfish session: %s', str(command))
+        self._remote = ['guestfish', '--remote=%s' % _parse_guestfish_pid(
+            subprocess.check_output(command, universal_newlines=True))]
+        try:
+            self._call('run')
+        except Exception:
+            self.close()
+            raise
+
+    def inspect_os(self):
+        return self._call('inspect-os').split()
+
+    def inspect_get_mountpoints(self, root):
+        mountpoints = {}
+        for line in self._call('inspect-get-mountpoints', root).splitlines():
+            mountpoint, _, device = line.partition(': ')
+            mountpoints[mountpoint] = device
+        return mountpoints
+
+    def is_lv(self, device):
+        return self._call('is-lv', device).strip() == 'true'
+
+    def lvm_canonical_lv_name(self, device):
+        return self._call('lvm-canonical-lv-name', device).strip()
+
+    def vgpvuuids(self, volume_group):
+        return self._call('vgpvuuids', volume_group).split()
+
+    def pvs(self):
+        return self._call('pvs').split()
+
+    def pvuuid(self, device):
+        return self._call('pvuuid', device).strip()
+
+    def part_to_dev(self, device):
+        return self._call('part-to-dev', device).strip()
+
+    def device_index(self, device):
+        return int(self._call('device-index', device))
+
+    def mount_ro(self, device, mountpoint):
+        self._call('mount-ro', device, mountpoint)
+
+    def umount_all(self):
+        self._call('umount-all')
+
+    def tar_out(self, directory, tar_path):
+        self._call('tar-out', directory, tar_path)
+
+    def close(self):
+        subprocess.call(self._remote + ['exit'])
+
+    def _call(self, *command):
+        with open(os.devnull, 'w') as devnull:
+            try:
+                return subprocess.check_output(
+                    self._remote + list(command), stderr=devnull,
+                    universal_newlines=True)
+            except subprocess.CalledProcessError as e:
+                raise RuntimeError("guestfish '%s' failed with exit code %d"
+                                   % (' '.join(command), e.returncode))
+
+
+def _fetch_nics_in_session(image_args):
+    if guestfs is not None:
+        return _fetch_nics_guestfs(image_args)
+    return _fetch_nics_guestfish(image_args)
+
+
+def _fetch_nics_guestfs(image_args):
+    LOG.debug('Inspecting NIC configs via libguestfs bindings: %s',
+              str(image_args))
+    handle = _launch_guestfs(image_args)
+    try:
+        nic_names = _nic_names_from_listing(handle.ls(NIC_CONFIG_DIR))
+        handle.aug_init('/', 0)
+        return [_aug_get_nic(handle, name) for name in nic_names]
+    finally:
+        handle.close()
+
+
+def _launch_guestfs(image_args):
+    handle = guestfs.GuestFS(python_return_dict=True)
+    try:
+        _add_drives(handle, image_args)
+        handle.launch()
+        roots = handle.inspect_os()
+        if not roots:
+            raise RuntimeError('No operating system found in %s'
+                               % str(image_args))
+        _mount_root(handle, roots[0])
+    except Exception:
+        handle.close()
+        raise
+    return handle
+
+
+def _add_drives(handle, image_args):
+    args_iter = iter(image_args)
+    for arg in args_iter:
+        if arg == '-a':
+            handle.add_drive_opts(next(args_iter), readonly=1)
+        elif arg == '-d':
+            handle.add_domain(next(args_iter), readonly=1)
+        else:
+            raise ValueError("Unsupported image argument '%s'" % arg)
+
+
+def _mount_root(handle, root):
+    mountpoints = handle.inspect_get_mountpoints(root)
+    # mount '/' before '/boot' etc.
+    for mountpoint in sorted(mountpoints, key=len):
+        try:
+            handle.mount_ro(mountpoints[mountpoint], mountpoint)
+        except RuntimeError as e:
+            LOG.debug('Could not mount %s: %s', mountpoint, e)
+
+
+def _aug_get_nic(handle, nic_name):
+    nic = {'name': nic_name}
+    config_path = '/files%s/%s%s' % (
+        NIC_CONFIG_DIR, NIC_CONFIG_PREFIX, nic_name)
+    for key in NIC_KEYS:
+        try:
+            nic[key] = handle.aug_get('%s/%s' % (config_path, key.upper()))
+        except RuntimeError:
+            nic[key] = None
+    return nic
+
+
+def _fetch_nics_guestfish(image_args):
+    command = ['guestfish', '--listen', '-i', '--ro'] + image_args
+    LOG.debug('Starting guestfish session: %s', str(command))
+    pid = _parse_guestfish_pid(
+        subprocess.check_output(command, universal_newlines=True))
+    remote = ['guestfish', '--remote=%s' % pid]
+    try:
+        nic_names = _nic_names_from_listing(subprocess.check_output(
+            remote + ['ls', NIC_CONFIG_DIR],
+            universal_newlines=True).splitlines())
+        for nic in iter_nics_output(_stream_guestfish_script(
+                remote, render_fetch_script(nic_names))):
+            yield nic
+    finally:
+        subprocess.call(remote + ['exit'])
+
+
+def _parse_guestfish_pid(listen_output):
+    match = GUESTFISH_PID_RE.search(listen_output)
+    if not match:
+        raise RuntimeError("Could not start guestfish session: '%s'"
+                           % listen_output)
+    return match.group(1)
+
+
+def _fetch_nics_legacy(image_args):
+    nic_names = _get_nic_names_from_image(image_args)
+    command = ['guestfish', '-i', '--ro'] + image_args
+    LOG.debug('Running guestfish to get NIC config details: %s', str(command))
+    return iter_nics_output(_stream_guestfish_script(
+        command, render_fetch_script(nic_names)))
+
+
+def _stream_guestfish_script(command, script):
+    """Run a guestfish script, yielding output lines as they arrive."""
+    with open(os.devnull, 'w') as devnull:
+        fetcher = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, stderr=devnull,
+                                   universal_newlines=True)
+
+    # feed the script from a thread, guestfish may fill the stdout
+    # pipe before it has read the whole script
+    def write_script():
+        try:
+            fetcher.stdin.write(script)
+            fetcher.stdin.close()
+        except (IOError, OSError) as e:
+            LOG.debug('guestfish stopped reading the script: %s', e)
+    writer = threading.Thread(target=write_script)
+    writer.daemon = True
+    writer.start()
+
+    with trace.span('guestfish script',
+                    script_bytes=len(script)) as span_args:
+        output_bytes = 0
+        try:
+            for line in iter(fetcher.stdout.readline, ''):
+                output_bytes += len(line)
+                LOG.debug('guestfish: %s', line.rstrip('\n'))
+                yield line.rstrip('\n')
+        finally:
+            fetcher.stdout.close()
+            writer.join()
+            span_args['exit_code'] = fetcher.wait()
+            span_args['output_bytes'] = output_bytes
+
+
+def _get_nic_names_from_image(image_args):
+    command = ['virt-ls'] + image_args + [NIC_CONFIG_DIR]
+    LOG.debug('Running virt-ls to list NIC configs: %s', str(command))
+    with trace.span('virt-ls') as span_args:
+        listing = subprocess.check_output(command, universal_newlines=True)
+        span_args['output_bytes'] = len(listing)
+    return _nic_names_from_listing(listing.splitlines())
+
+
+def _nic_names_from_listing(network_scripts):
+    prefix_len = len(NIC_CONFIG_PREFIX)
+    return [s[prefix_len:] for s in network_scripts
+            if s.startswith(NIC_CONFIG_PREFIX)]
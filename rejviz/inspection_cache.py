@@ -0,0 +1,175 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License. You may
+# obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+import hashlib
+import json
+import logging
+import os
+from os import path
+import struct
+import tempfile
+
+from rejviz import utils
+
+
+LOG = logging.getLogger(__file__)
+CACHE_VERSION = 3
+# inspection.MODE_RAW, not imported to keep guestfs out of cache users
+DEFAULT_MODE = 'raw'
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+ENTRY_SUFFIX = '.json'
+HEADER_FINGERPRINT_SIZE = 4096
+QCOW2_MAGIC = b'QFI\xfb'
+MAX_BACKING_CHAIN = 16
+
+
+class InspectionCache(object):
+    """On-disk cache of NIC lists inspected from images.
+
+    Entries are keyed by image identity (path, size, mtime, inode and
+    qcow2 header / backing chain fingerprint) and the inspection mode,
+    so any change to the image or its backing files results in a cache
+    miss. Least recently
+    used entries are evicted when the cache grows over its limits.
+    """
+
+    def __init__(self, cache_dir=None, max_entries=DEFAULT_MAX_ENTRIES,
+                 max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir or utils.cache_dir('inspection')
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+    def get(self, image_args, mode=DEFAULT_MODE):
+        key = _cache_key(image_args, mode)
+        if not key:
+            return None
+
+        entry_path = self._entry_path(key)
+        try:
+            with open(entry_path) as entry_file:
+                entry = json.load(entry_file)
+            # mark as recently used
+            os.utime(entry_path, None)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if entry.get('version') != CACHE_VERSION:
+            return None
+        LOG.debug('Inspection cache hit for %s', str(image_args))
+        return entry['nics']
+
+    def put(self, image_args, nics, mode=DEFAULT_MODE):
+        key = _cache_key(image_args, mode)
+        if not key:
+            return
+
+        entry = {'version': CACHE_VERSION,
+                 'image_args': image_args,
+                 'mode': mode,
+                 'nics': nics}
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'w') as entry_file:
+                json.dump(entry, entry_file)
+            # atomic on POSIX, readers never see a partial entry
+            os.rename(tmp_path, self._entry_path(key))
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for file_name in os.listdir(self.cache_dir):
+            if not file_name.endswith(ENTRY_SUFFIX):
+                continue
+            entry_path = path.join(self.cache_dir, file_name)
+            try:
+                stat = os.stat(entry_path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry_path))
+
+        entries.sort()
+        total_bytes = sum(entry[1] for entry in entries)
+        while entries and (len(entries) > self.max_entries or
+                           total_bytes > self.max_bytes):
+            _, size, entry_path = entries.pop(0)
+            total_bytes -= size
+            try:
+                os.unlink(entry_path)
+                LOG.debug('Evicted inspection cache entry %s', entry_path)
+            except OSError:
+                # already evicted by another process
+                pass
+
+    def _entry_path(self, key):
+        return path.join(self.cache_dir, key + ENTRY_SUFFIX)
+
+
+def image_fingerprint(image_path, _depth=0):
+    real_path = path.realpath(image_path)
+    stat = os.stat(real_path)
+    with open(real_path, 'rb') as image_file:
+        header = image_file.read(HEADER_FINGERPRINT_SIZE)
+
+    fingerprint = {
+        'path': real_path,
+        'size': stat.st_size,
+        'mtime': getattr(stat, 'st_mtime_ns', stat.st_mtime),
+        'dev': stat.st_dev,
+        'ino': stat.st_ino,
+        'header': hashlib.sha256(header).hexdigest(),
+    }
+
+    backing_file = qcow2_backing_file(real_path, header)
+    if backing_file:
+        if _depth >= MAX_BACKING_CHAIN:
+            raise ValueError("Backing chain of '%s' is too long" % image_path)
+        fingerprint['backing'] = image_fingerprint(backing_file, _depth + 1)
+    return fingerprint
+
+
+def _cache_key(image_args, mode=DEFAULT_MODE):
+    image_paths = []
+    args_iter = iter(image_args)
+    for arg in args_iter:
+        # only images can be fingerprinted, libvirt domains (-d) can't
+        if arg != '-a':
+            return None
+        image_paths.append(next(args_iter))
+
+    try:
+        fingerprints = [image_fingerprint(p) for p in image_paths]
+    except (IOError, OSError, ValueError) as e:
+        LOG.debug('Cannot fingerprint %s, not caching: %s',
+                  str(image_args), e)
+        return None
+    serialized = json.dumps([mode, fingerprints], sort_keys=True)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+
+def qcow2_backing_file(image_path, header):
+    # qcow2 header: magic (4B), version (4B), backing_file_offset (8B),
+    # backing_file_size (4B), all big-endian
+    if len(header) < 20 or header[:4] != QCOW2_MAGIC:
+        return None
+    offset, size = struct.unpack('>QI', header[8:20])
+    if not offset or not size:
+        return None
+
+    with open(image_path, 'rb') as image_file:
+        image_file.seek(offset)
+        backing_file = image_file.read(size).decode('utf-8')
+    # relative backing paths are relative to the overlay's directory
+    return path.join(path.dirname(image_path), backing_file)
@@ -0,0 +1,141 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License. You may
+# obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+import logging
+import os
+from os import path
+
+from rejviz import utils
+
+
+LOG = logging.getLogger(__file__)
+RESERVATIONS_DIR = 'ip-reservations'
+
+
+def allocate_ipaddr(network):
+    return AddressAllocator().allocate(network)[0]
+
+
+def release_ipaddrs(network, ipaddrs):
+    AddressAllocator().release(network, ipaddrs)
+
+
+class AddressAllocator(object):
+    """Allocates static IPv4 addresses from libvirt networks.
+
+    Free addresses are those in the network's range except the network
+    and broadcast addresses, the libvirt gateway address, DHCP ranges,
+    DHCP static hosts and addresses reserved by earlier allocations.
+    Reservations are kept per network in a file under `reservations_dir`
+    until released. They never expire: static addresses configured
+    inside guests don't show up in libvirt, so there is nothing to tell
+    whether an address is still in use.
+    """
+
+    def __init__(self, reservations_dir=None):
+        self.reservations_dir = reservations_dir or utils.state_dir(
+            RESERVATIONS_DIR)
+
+    def allocate(self, network, count=1):
+        if not network.get('network') or not network.get('netmask'):
+            raise ValueError("libvirt network '%s' has no IPv4 address "
+                             "range." % network['name'])
+
+        reservations_path = self._reservations_path(network)
+        with utils.locked(reservations_path + '.lock'):
+            reservations = self._read_reservations(reservations_path)
+            used = NetworkBitmap(network['network'], network['netmask'])
+            used.exclude_network(network)
+            for ipaddr in reservations:
+                used.add_address(ipaddr)
+
+            allocated = [used.allocate(network['name'])
+                         for _ in range(count)]
+            self._append_reservations(reservations_path, allocated)
+
+        LOG.debug('Allocated addresses %s in network %s',
+                  ', '.join(allocated), network['name'])
+        return allocated
+
+    def release(self, network, ipaddrs):
+        reservations_path = self._reservations_path(network)
+        with utils.locked(reservations_path + '.lock'):
+            reservations = self._read_reservations(reservations_path)
+            kept = [ipaddr for ipaddr in reservations
+                    if ipaddr not in ipaddrs]
+            if len(kept) != len(reservations):
+                self._write_reservations(reservations_path, kept)
+
+        LOG.debug('Released addresses %s in network %s',
+                  ', '.join(ipaddrs), network['name'])
+
+    def _reservations_path(self, network):
+        return path.join(self.reservations_dir,
+                         network['name'].replace(os.sep, '_'))
+
+    def _read_reservations(self, reservations_path):
+        if not path.exists(reservations_path):
+            return []
+        with open(reservations_path) as reservations_file:
+            return [line.strip() for line in reservations_file
+                    if line.strip()]
+
+    def _write_reservations(self, reservations_path, reservations):
+        utils.write_file_atomic(reservations_path,
+                                _format_reservations(reservations))
+
+    def _append_reservations(self, reservations_path, reservations):
+        # allocating doesn't rewrite the file, only releasing does
+        with open(reservations_path, 'a') as reservations_file:
+            reservations_file.write(_format_reservations(reservations))
+
+
+class NetworkBitmap(utils.Bitmap):
+    """One bit per address of an IPv4 network, set bits are in use."""
+
+    def __init__(self, network, netmask):
+        prefix_len = utils.netmask_to_prefix_len(netmask)
+        self.base = utils.ipv4_to_int(network) & \
+            utils.prefix_len_to_mask(prefix_len)
+        super(NetworkBitmap, self).__init__(1 << (32 - prefix_len))
+
+    def add_address(self, ipaddr):
+        offset = utils.ipv4_to_int(ipaddr) - self.base
+        if 0 <= offset < self.size:
+            self.add(offset)
+
+    def add_address_range(self, start, end):
+        self.add_range(utils.ipv4_to_int(start) - self.base,
+                       utils.ipv4_to_int(end) - self.base)
+
+    def exclude_network(self, network):
+        # network and broadcast addresses
+        self.add(0)
+        self.add(self.size - 1)
+        if network.get('address'):
+            self.add_address(network['address'])
+        for start, end in network.get('dhcp_ranges', []):
+            self.add_address_range(start, end)
+        for ipaddr in network.get('dhcp_hosts', []):
+            self.add_address(ipaddr)
+
+    def allocate(self, network_name):
+        offset = self.first_free()
+        if offset is None:
+            raise RuntimeError("No free IP addresses left in libvirt "
+                               "network '%s'." % network_name)
+        self.add(offset)
+        return utils.int_to_ipv4(self.base + offset)
+
+
+def _format_reservations(reservations):
+    return ''.join('%s\n' % ipaddr for ipaddr in reservations)
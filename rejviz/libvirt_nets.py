@@ -10,38 +10,243 @@
 # implied. See the License for the specific language governing
 # permissions and limitations under the License.
 
+import collections
 import logging
+import threading
 from xml.etree import ElementTree
 
 import libvirt
 
+from rejviz import trace
+from rejviz import utils
+
 LOG = logging.getLogger(__file__)
 
+_default_index = None
+_default_index_lock = threading.Lock()
+_event_loop_lock = threading.Lock()
+_event_loop_started = False
 
-def get_libvirt_networks():
-    conn = libvirt.openReadOnly()
-    if not conn:
-        raise RuntimeError('Could not connect to libvirt.')
 
-    networks = [_fetch_network_data(n) for n in conn.listAllNetworks()]
-    conn.close()
+def get_libvirt_networks():
+    with trace.span('libvirt_nets.get_libvirt_networks') as span_args:
+        networks = default_index().networks()
+        span_args['networks'] = len(networks)
     return networks
 
 
+def default_index():
+    """Process-wide network index, created on first use."""
+    global _default_index
+    with _default_index_lock:
+        if _default_index is None:
+            _default_index = NetworkIndex(watch_events=True)
+        return _default_index
+
+
+class NetworkIndex(object):
+    """Parsed libvirt networks, kept over a single read-only connection.
+
+    Every network's XML is parsed once. With `watch_events`, network
+    lifecycle events mark the affected networks, which get re-parsed on
+    the next read, and undefined networks are dropped. When the
+    connection closes (e.g. libvirtd restarts), the next read
+    reconnects and lists all networks anew.
+    """
+
+    def __init__(self, uri=None, watch_events=False):
+        if watch_events:
+            # has to happen before the connection is opened
+            _start_event_loop()
+
+        self._uri = uri
+        self._watch_events = watch_events
+        self._lock = threading.Lock()
+        self._networks = collections.OrderedDict()
+        self._stale = set()
+        self._conn = None
+        self._callback_id = None
+        self._closed = False
+        with self._lock:
+            self._connect()
+
+    def networks(self):
+        with self._lock:
+            if self._closed:
+                LOG.info('libvirt connection closed, reconnecting')
+                self._disconnect()
+                self._connect()
+            for name in self._stale:
+                self._reload_network(name)
+            self._stale.clear()
+            return list(self._networks.values())
+
+    def refresh(self):
+        with self._lock:
+            self._refresh()
+
+    def close(self):
+        with self._lock:
+            self._disconnect()
+
+    def _connect(self):
+        conn = libvirt.openReadOnly(self._uri)
+        if not conn:
+            raise RuntimeError('Could not connect to libvirt.')
+        self._conn = conn
+        self._closed = False
+        if self._watch_events:
+            # registered before listing, so that networks defined in
+            # between aren't missed
+            self._callback_id = conn.networkEventRegisterAny(
+                None, libvirt.VIR_NETWORK_EVENT_ID_LIFECYCLE,
+                self._on_lifecycle_event, None)
+            conn.registerCloseCallback(self._on_close, None)
+        self._refresh()
+
+    def _disconnect(self):
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        # the connection may be dead already
+        try:
+            if self._callback_id is not None:
+                conn.networkEventDeregisterAny(self._callback_id)
+            if self._watch_events:
+                conn.unregisterCloseCallback()
+        except libvirt.libvirtError as e:
+            LOG.debug('Could not deregister libvirt callbacks: %s', e)
+        finally:
+            self._callback_id = None
+        try:
+            conn.close()
+        except libvirt.libvirtError as e:
+            LOG.debug('Could not close libvirt connection: %s', e)
+
+    def _refresh(self):
+        with trace.span('libvirt_nets.refresh'):
+            self._networks.clear()
+            self._stale.clear()
+            for network in self._conn.listAllNetworks():
+                self._networks[network.name()] = _fetch_network_data(network)
+
+    def _reload_network(self, name):
+        try:
+            network = self._conn.networkLookupByName(name)
+        except libvirt.libvirtError:
+            self._networks.pop(name, None)
+            return
+        self._networks[name] = _fetch_network_data(network)
+
+    def _on_close(self, conn, reason, opaque):
+        # runs in the event loop thread, reconnecting is left to the
+        # next read
+        LOG.debug('libvirt connection closed, reason %s', reason)
+        self._closed = True
+
+    def _on_lifecycle_event(self, conn, network, event, detail, opaque):
+        name = network.name()
+        LOG.debug('libvirt network %s lifecycle event %s', name, event)
+        with self._lock:
+            if event == libvirt.VIR_NETWORK_EVENT_UNDEFINED:
+                self._networks.pop(name, None)
+                self._stale.discard(name)
+            else:
+                self._stale.add(name)
+
+
+def _start_event_loop():
+    global _event_loop_started
+    with _event_loop_lock:
+        if _event_loop_started:
+            return
+        libvirt.virEventRegisterDefaultImpl()
+
+        def run_event_loop():
+            while True:
+                libvirt.virEventRunDefaultImpl()
+        event_thread = threading.Thread(target=run_event_loop,
+                                        name='libvirt-event-loop')
+        event_thread.daemon = True
+        event_thread.start()
+        _event_loop_started = True
+
+
+class PrefixIndex(object):
+    """Longest-prefix-match index of IPv4 networks.
+
+    Networks are hashed by their address under each distinct prefix
+    length, so a lookup costs at most one dict probe per prefix length
+    present (33 at worst), regardless of the number of networks.
+    """
+
+    def __init__(self):
+        self._by_prefix_len = {}
+        self._prefix_lens = []
+
+    def add(self, network, netmask, value):
+        prefix_len = utils.netmask_to_prefix_len(netmask)
+        mask = utils.prefix_len_to_mask(prefix_len)
+        networks = self._by_prefix_len.get(prefix_len)
+        if networks is None:
+            networks = self._by_prefix_len[prefix_len] = {}
+            self._prefix_lens = sorted(self._by_prefix_len, reverse=True)
+        networks.setdefault(utils.ipv4_to_int(network) & mask, value)
+
+    def lookup(self, ipaddr):
+        address = utils.ipv4_to_int(ipaddr)
+        for prefix_len in self._prefix_lens:
+            value = self._by_prefix_len[prefix_len].get(
+                address & utils.prefix_len_to_mask(prefix_len))
+            if value is not None:
+                return value
+        return None
+
+
+def build_prefix_index(networks):
+    index = PrefixIndex()
+    for network in networks:
+        if network.get('network') and network.get('netmask'):
+            index.add(network['network'], network['netmask'], network)
+    return index
+
+
 def _fetch_network_data(network):
-    network_data = {'name': network.name()}
+    network_data = {'name': network.name(), 'dhcp': False,
+                    'address': None, 'network': None, 'netmask': None,
+                    'dhcp_ranges': [], 'dhcp_hosts': []}
 
     root = ElementTree.fromstring(network.XMLDesc())
-    network_data['dhcp'] = root.find('./ip/dhcp') is not None
-    network_data['netmask'] = root.find('./ip').attrib['netmask']
+    ip = _ipv4_element(root)
+    if ip is None:
+        return network_data
+
+    network_data['dhcp'] = ip.find('./dhcp') is not None
+    network_data['dhcp_ranges'] = [
+        (dhcp_range.attrib['start'], dhcp_range.attrib['end'])
+        for dhcp_range in ip.findall('./dhcp/range')]
+    network_data['dhcp_hosts'] = [
+        host.attrib['ip'] for host in ip.findall('./dhcp/host')
+        if 'ip' in host.attrib]
+    network_data['address'] = ip.attrib['address']
+    if 'netmask' in ip.attrib:
+        network_data['netmask'] = ip.attrib['netmask']
+    else:
+        network_data['netmask'] = utils.prefix_len_to_netmask(
+            int(ip.attrib['prefix']))
     network_data['network'] = _gateway_ipaddr_to_network(
-        root.find('./ip').attrib['address'])
+        network_data['address'], network_data['netmask'])
 
     return network_data
 
 
-def _gateway_ipaddr_to_network(ipaddr):
-    octets = ipaddr.split('.')
-    # smarty pants
-    octets[3] = str(int(octets[3]) - 1)
-    return '.'.join(octets)
+def _ipv4_element(root):
+    for ip in root.findall('./ip'):
+        if ip.attrib.get('family', 'ipv4') == 'ipv4':
+            return ip
+    return None
+
+
+def _gateway_ipaddr_to_network(ipaddr, netmask):
+    return utils.int_to_ipv4(
+        utils.ipv4_to_int(ipaddr) & utils.ipv4_to_int(netmask))
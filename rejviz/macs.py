@@ -0,0 +1,183 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License. You may
+# obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+import logging
+from os import path
+import random
+import threading
+import time
+from xml.etree import ElementTree
+
+import libvirt
+
+from rejviz import utils
+
+
+LOG = logging.getLogger(__file__)
+MAC_PREFIX = '52:54:00:'  # 52:54:00 is libvirt default
+MAC_SPACE = 1 << 24
+RANDOM_PROBES = 64
+RESERVATION_TTL = 30 * 24 * 3600
+RESERVATIONS_FILE = 'mac-reservations'
+
+_default_allocator = None
+_default_allocator_lock = threading.Lock()
+
+
+def allocate_mac():
+    return allocate_macs(1)[0]
+
+
+def allocate_macs(count):
+    global _default_allocator
+    with _default_allocator_lock:
+        if _default_allocator is None:
+            _default_allocator = MacAllocator()
+    return _default_allocator.allocate(count)
+
+
+class MacAllocator(object):
+    """Allocates KVM MAC addresses not used anywhere on the host.
+
+    Used addresses are the ones in libvirt domain definitions plus the
+    ones reserved by earlier allocations (from any rejviz process) in
+    a reservation file. Reservations expire after RESERVATION_TTL, by
+    then the address is expected to show up in a domain definition, so
+    domains are listed anew for every allocation (also in a long-running
+    rejvizd).
+    """
+
+    def __init__(self, reservations_path=None, uri=None):
+        self.reservations_path = reservations_path or path.join(
+            utils.state_dir(), RESERVATIONS_FILE)
+        self.uri = uri
+
+    def allocate(self, count=1):
+        domain_macs = _libvirt_domain_macs(self.uri)
+        with utils.locked(self.reservations_path + '.lock'):
+            reservations, prune = self._read_reservations()
+            used = MacBitmap()
+            used.update(domain_macs)
+            used.update(reservations)
+
+            allocated = [used.allocate() for _ in range(count)]
+            now = int(time.time())
+            new_reservations = dict((mac, now) for mac in allocated)
+            if prune:
+                reservations.update(new_reservations)
+                self._write_reservations(reservations)
+            else:
+                self._append_reservations(new_reservations)
+
+        LOG.debug('Allocated MAC addresses %s', ', '.join(allocated))
+        return allocated
+
+    def _read_reservations(self):
+        """Returns a tuple (reservations, file_needs_pruning)."""
+        reservations = {}
+        prune = False
+        if not path.exists(self.reservations_path):
+            return reservations, prune
+
+        expire_before = time.time() - RESERVATION_TTL
+        with open(self.reservations_path) as reservations_file:
+            for line in reservations_file:
+                try:
+                    mac, reserved_at = line.split()
+                    if int(reserved_at) >= expire_before:
+                        reservations[mac] = int(reserved_at)
+                    else:
+                        prune = True
+                except ValueError:
+                    LOG.warning('Ignoring malformed MAC reservation: %s',
+                                line.strip())
+                    prune = True
+        return reservations, prune
+
+    def _write_reservations(self, reservations):
+        utils.write_file_atomic(self.reservations_path,
+                                _format_reservations(reservations))
+
+    def _append_reservations(self, reservations):
+        # the common case, the file is rewritten only to drop expired ones
+        with open(self.reservations_path, 'a') as reservations_file:
+            reservations_file.write(_format_reservations(reservations))
+
+
+class MacBitmap(utils.Bitmap):
+    """One bit per address in the 52:54:00:xx:xx:xx space (2 MiB)."""
+
+    def __init__(self):
+        super(MacBitmap, self).__init__(MAC_SPACE)
+
+    def update(self, macs):
+        for mac in macs:
+            suffix = _mac_suffix(mac)
+            if suffix is not None:
+                self.add(suffix)
+
+    def allocate(self):
+        # the space is mostly empty, so random probing is expected O(1)
+        for _ in range(RANDOM_PROBES):
+            suffix = random.randrange(MAC_SPACE)
+            if suffix not in self:
+                return self._take(suffix)
+
+        # almost full, look for any free bit
+        suffix = self.first_free()
+        if suffix is None:
+            raise RuntimeError('No free MAC addresses left under %s'
+                               % MAC_PREFIX)
+        return self._take(suffix)
+
+    def _take(self, suffix):
+        self.add(suffix)
+        return MAC_PREFIX + ':'.join(
+            '%02x' % ((suffix >> shift) & 0xff) for shift in (16, 8, 0))
+
+
+def _format_reservations(reservations):
+    return ''.join('%s %d\n' % item for item in sorted(reservations.items()))
+
+
+def _mac_suffix(mac):
+    mac = mac.lower()
+    if not mac.startswith(MAC_PREFIX):
+        return None
+    try:
+        octets = [int(octet, 16) for octet in mac[len(MAC_PREFIX):].split(':')]
+    except ValueError:
+        return None
+    if len(octets) != 3:
+        return None
+    return (octets[0] << 16) | (octets[1] << 8) | octets[2]
+
+
+def _libvirt_domain_macs(uri=None):
+    try:
+        conn = libvirt.openReadOnly(uri)
+        if not conn:
+            raise libvirt.libvirtError('Could not connect to libvirt.')
+    except libvirt.libvirtError as e:
+        LOG.warning('Cannot read MAC addresses of libvirt domains, relying '
+                    'on rejviz reservations only: %s', e)
+        return set()
+
+    try:
+        macs = set()
+        for domain in conn.listAllDomains():
+            root = ElementTree.fromstring(domain.XMLDesc(0))
+            for mac in root.findall('./devices/interface/mac'):
+                macs.add(mac.attrib['address'].lower())
+        return macs
+    finally:
+        conn.close()
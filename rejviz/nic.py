@@ -13,41 +13,82 @@
 import logging
 import os
 from os import path
-import random
-
-import jinja2
 
+from rejviz import arguments
+from rejviz import daemon
+from rejviz import trace
 from rejviz import utils
 
+# ipam, libvirt_nets, macs and render (and with them jinja2 and libvirt)
+# are imported only where needed, so that rejvizd clients start fast
+
 
 LOG = logging.getLogger(__file__)
 NIC_CONFIG_PREFIX = 'etc/sysconfig/network-scripts/ifcfg-'
+INJECTION_UPLOAD = 'upload'
+INJECTION_COPY_IN = 'copy-in'
+INJECTION_WRITE = 'write'
+INJECTION_MODES = [INJECTION_UPLOAD, INJECTION_COPY_IN, INJECTION_WRITE]
+
+
+def process_args(args, tmp_dir, use_daemon=True):
+    """Convert --nic options in `args` to virt-builder options.
+
+    NIC configs are rendered into `tmp_dir`. When rejvizd is running
+    (and `use_daemon` is set), the work is done there.
+    """
+    if use_daemon:
+        try:
+            return daemon.call('nic.process_args', args=list(args),
+                               tmp_dir=tmp_dir)
+        except daemon.DaemonUnavailable as e:
+            LOG.debug('Processing NICs in-process: %s', e)
+
+    args = arguments.tokenize(args)
+    injection = args.last('--nic-injection', INJECTION_UPLOAD)
+    if injection not in INJECTION_MODES:
+        raise ValueError("Unknown NIC injection mode '%s', expected one of: "
+                         "%s" % (injection, ', '.join(INJECTION_MODES)))
+
+    replacements = dict((index, [])
+                        for index in args.token_indexes('--nic-injection'))
+    nic_indexes = args.token_indexes('--nic')
+    all_nic_vars = _parse_nics(
+        [args.tokens[index].value for index in nic_indexes])
+    copy_in_configs = []
+    for index, nic_vars in zip(nic_indexes, all_nic_vars):
+        if injection == INJECTION_UPLOAD:
+            replacements[index] = _nic_values_to_args(nic_vars, tmp_dir)
+        elif injection == INJECTION_WRITE:
+            replacements[index] = _nic_values_to_write_args(nic_vars)
+        else:
+            replacements[index] = []
+            copy_in_configs.append(_nic_config(nic_vars))
 
+    # with copy-in, all configs are injected at the place of the first --nic
+    if copy_in_configs:
+        replacements[nic_indexes[0]] = _copy_in_args(copy_in_configs, tmp_dir)
+    return args.rebuild(replacements)
 
-def process_args(args, tmp_dir):
-    final_args = []
-    args_iter = iter(args)
-    for arg in args_iter:
-        # if not '--nic' or '--nic=something', just pass it untouched
-        if arg.find('--nic=') != 0 and arg != '--nic':
-            final_args.append(arg)
-        # if just '--nic', we're looking for the next element in args
-        # array to fetch the values from
-        elif arg == '--nic':
-            nic_values = next(args_iter)
-            final_args += _nic_values_to_args(nic_values, tmp_dir)
-        # if specified as '--nic=values', remove the '--nic=' part
-        else:
-            nic_values = arg[len('--nic='):]
-            final_args += _nic_values_to_args(nic_values, tmp_dir)
-    return final_args
 
+def _parse_nics(nic_strings):
+    """NIC vars of `nic_strings`, missing MACs allocated in one batch."""
+    all_nic_vars = []
+    for nic_string in nic_strings:
+        LOG.debug("NIC string %s", nic_string)
+        all_nic_vars.append(utils.parse_keyvals(nic_string))
 
-def _nic_values_to_args(nic_string, tmp_dir):
-    LOG.debug("NIC string %s", nic_string)
-    nic_vars = _ensure_nic_vars(utils.parse_keyvals(nic_string))
-    config_contents = _render_nic_template(nic_vars)
-    config_file_path = NIC_CONFIG_PREFIX + nic_vars['name']
+    without_hwaddr = [nic_vars for nic_vars in all_nic_vars
+                      if not nic_vars.get('hwaddr')]
+    if without_hwaddr:
+        hwaddrs = _generate_mac_addresses(len(without_hwaddr))
+        for nic_vars, hwaddr in zip(without_hwaddr, hwaddrs):
+            nic_vars['hwaddr'] = hwaddr
+    return all_nic_vars
+
+
+def _nic_values_to_args(nic_vars, tmp_dir):
+    config_file_path, config_contents = _nic_config(nic_vars)
     tmp_config_file_path = path.join(tmp_dir, config_file_path)
     tmp_config_dir_path = path.dirname(tmp_config_file_path)
     target_config_file_path = path.join('/', config_file_path)
@@ -56,20 +97,59 @@ def _nic_values_to_args(nic_string, tmp_dir):
         os.makedirs(tmp_config_dir_path, 0o700)
     with open(tmp_config_file_path, 'w') as config_file:
         config_file.write(config_contents)
-    LOG.info("Adding NIC with params %s", str(nic_vars))
     return [
         '--upload',
         ':'.join([tmp_config_file_path, target_config_file_path]),
     ]
 
 
-def _render_nic_template(nic_vars):
-    template_file_name = path.join(
-        path.dirname(path.realpath(__file__)), 'templates', 'ifcfg-eth.j2')
-    with open(template_file_name) as template_file:
-        template = jinja2.Template(template_file.read())
+def _nic_values_to_write_args(nic_vars):
+    config_file_path, config_contents = _nic_config(nic_vars)
+    return [
+        '--write',
+        ':'.join([path.join('/', config_file_path), config_contents]),
+    ]
+
 
-    return template.render(**nic_vars)
+def _copy_in_args(nic_configs, tmp_dir):
+    # one directory copied in as a single tar stream, merged with the
+    # existing network-scripts dir in the guest, so its mode must match;
+    # tar keeps the host owner, so the copied files are chowned to root
+    config_dir_path = path.dirname(NIC_CONFIG_PREFIX)
+    guest_paths = [path.join('/', config_dir_path)]
+    tmp_config_dir_path = path.join(tmp_dir, 'nic-configs',
+                                    path.basename(config_dir_path))
+    os.makedirs(tmp_config_dir_path)
+    os.chmod(tmp_config_dir_path, 0o755)
+    for config_file_path, config_contents in nic_configs:
+        tmp_config_file_path = path.join(tmp_config_dir_path,
+                                         path.basename(config_file_path))
+        with open(tmp_config_file_path, 'w') as config_file:
+            config_file.write(config_contents)
+        os.chmod(tmp_config_file_path, 0o644)
+        guest_paths.append(path.join('/', config_file_path))
+    return [
+        '--copy-in',
+        ':'.join([tmp_config_dir_path,
+                  path.join('/', path.dirname(config_dir_path))]),
+        '--run-command',
+        ' '.join(['chown', 'root:root'] + guest_paths),
+    ]
+
+
+def _nic_config(nic_vars):
+    """Returns a tuple (config_file_path, config_contents) for a NIC."""
+    with trace.span('nic.config') as span_args:
+        nic_vars = _ensure_nic_vars(nic_vars)
+        LOG.info("Adding NIC with params %s", str(nic_vars))
+        config_contents = _render_nic_template(nic_vars)
+        span_args.update(name=nic_vars['name'], bytes=len(config_contents))
+    return NIC_CONFIG_PREFIX + nic_vars['name'], config_contents
+
+
+def _render_nic_template(nic_vars):
+    from rejviz import render
+    return render.render('ifcfg-eth.j2', **nic_vars)
 
 
 def _ensure_nic_vars(nic_vars):
@@ -80,7 +160,12 @@ def _ensure_nic_vars(nic_vars):
         raise ValueError("Invalid NIC parameters - name not set: %s"
                          % str(nic_vars))
 
-    new_vars.setdefault('hwaddr', _generate_mac_address())
+    if not new_vars.get('hwaddr'):
+        new_vars['hwaddr'] = _generate_mac_address()
+
+    if new_vars.get('ipaddr') == 'auto':
+        _allocate_ipaddr(new_vars)
+    new_vars.pop('libvirt_network', None)
 
     if new_vars.get('ipaddr'):
         new_vars.setdefault('bootproto', 'static')
@@ -90,15 +175,17 @@ def _ensure_nic_vars(nic_vars):
             raise ValueError("NIC '%(name)s' - when bootproto is 'static'"
                              "it is required to specify also 'ipaddr'")
 
-        # "123.456.789.123" => "123.456.789."
-        ip_prefix = new_vars['ipaddr'][:(new_vars['ipaddr'].rindex('.') + 1)]
-
-        if not new_vars.get('network'):
-            new_vars['network'] = ip_prefix + '0'
+        # without a netmask, assume a /24 network
         if not new_vars.get('netmask'):
             new_vars['netmask'] = '255.255.255.0'
+        ipaddr = utils.ipv4_to_int(new_vars['ipaddr'])
+        mask = utils.ipv4_to_int(new_vars['netmask'])
+
+        if not new_vars.get('network'):
+            new_vars['network'] = utils.int_to_ipv4(ipaddr & mask)
         if not new_vars.get('broadcast'):
-            new_vars['broadcast'] = ip_prefix + '255'
+            new_vars['broadcast'] = utils.int_to_ipv4(
+                ipaddr | (~mask & 0xffffffff))
     else:
         new_vars['bootproto'] = 'dhcp'
         new_vars.pop('ipaddr', None)
@@ -113,10 +200,46 @@ def _ensure_nic_vars(nic_vars):
     return new_vars
 
 
+def _allocate_ipaddr(nic_vars):
+    from rejviz import ipam
+    network = _find_libvirt_network(nic_vars)
+    nic_vars['ipaddr'] = ipam.allocate_ipaddr(network)
+    nic_vars['network'] = network['network']
+    nic_vars['netmask'] = network['netmask']
+    nic_vars.pop('broadcast', None)
+    nic_vars.setdefault('gateway', network['address'])
+    LOG.info("Allocated address %s for NIC '%s' in libvirt network '%s'",
+             nic_vars['ipaddr'], nic_vars['name'], network['name'])
+
+
+def _find_libvirt_network(nic_vars):
+    from rejviz import libvirt_nets
+    networks = libvirt_nets.get_libvirt_networks()
+
+    if nic_vars.get('libvirt_network'):
+        for network in networks:
+            if network['name'] == nic_vars['libvirt_network']:
+                return network
+        raise ValueError("NIC '%s' - libvirt network '%s' not found"
+                         % (nic_vars['name'], nic_vars['libvirt_network']))
+
+    if nic_vars.get('network'):
+        network = libvirt_nets.build_prefix_index(networks).lookup(
+            nic_vars['network'])
+        if network:
+            return network
+        raise ValueError("NIC '%s' - no libvirt network contains '%s'"
+                         % (nic_vars['name'], nic_vars['network']))
+
+    raise ValueError("NIC '%s' - ipaddr=auto requires also "
+                     "'libvirt_network' or 'network'" % nic_vars['name'])
+
+
 def _generate_mac_address():
-    prefix = '52:54:00:'  # 52:54:00 is libvirt default
+    from rejviz import macs
+    return macs.allocate_mac()
 
-    def one_group():
-        return ''.join([random.choice('0123456789abcdef') for _ in range(2)])
 
-    return prefix + ':'.join([one_group() for _ in range(3)])
+def _generate_mac_addresses(count):
+    from rejviz import macs
+    return macs.allocate_macs(count)
@@ -10,195 +10,308 @@
 # implied. See the License for the specific language governing
 # permissions and limitations under the License.
 
-from copy import deepcopy
+import collections
 import logging
-from os import path
-import subprocess
+import os
 
-import jinja2
-
-from rejviz import libvirt_nets
+from rejviz import arguments
+from rejviz import daemon
+from rejviz import trace
 from rejviz import utils
 
+# inspection and libvirt_nets (and with them guestfs, jinja2 and libvirt)
+# are imported only where needed, so that invocations without NIC
+# mappings start fast
+
 
 LOG = logging.getLogger(__file__)
-NIC_CONFIG_DIR = '/etc/sysconfig/network-scripts'
-NIC_CONFIG_PREFIX = 'ifcfg-'
-NIC_CONFIG_FULL_PREFIX = path.join(NIC_CONFIG_DIR, NIC_CONFIG_PREFIX)
-FETCH_SCRIPT_TEMPLATE = path.join(
-    path.dirname(path.realpath(__file__)),
-    'templates', 'fetch_nic.guestfish.j2')
 
+_NIC_FIELDS = ['name', 'type', 'hwaddr', 'bootproto', 'ipaddr', 'network',
+               'netmask', 'libvirt_network']
 
-def process_nic_mappings(args):
-    if not _has_nic_mapping_args(args):
-        return args
 
-    LOG.info('Looking for NIC configurations in the image...')
-    nics = _fetch_nics_from_image(args)
-    LOG.info('NICs found: %s', ', '.join([n['name'] for n in nics]))
-    for nic in nics:
-        LOG.debug('NIC %s: %s', nic['name'], str(nic))
+class Nic(collections.namedtuple('Nic', _NIC_FIELDS)):
+    """Immutable NIC record, updated copies come from `_replace`."""
+
+    __slots__ = ()
+
+    @classmethod
+    def from_dict(cls, nic):
+        return cls(*[nic.get(field) for field in cls._fields])
+
+
+class NicCollection(object):
+    """Immutable ordered collection of Nic records.
+
+    Indexed by name and hwaddr. Updating returns a new collection which
+    shares the unchanged records with this one.
+    """
+
+    __slots__ = ('_nics', '_by_name', '_by_hwaddr')
+
+    def __init__(self, nics=()):
+        self._nics = tuple(nics)
+        self._by_name = dict((nic.name, nic) for nic in self._nics)
+        self._by_hwaddr = dict((nic.hwaddr.lower(), nic)
+                               for nic in self._nics if nic.hwaddr)
+
+    @classmethod
+    def from_dicts(cls, nics):
+        return cls(Nic.from_dict(nic) for nic in nics)
+
+    def __iter__(self):
+        return iter(self._nics)
+
+    def __len__(self):
+        return len(self._nics)
+
+    def __eq__(self, other):
+        return isinstance(other, NicCollection) and \
+            self._nics == other._nics
+
+    def __ne__(self, other):
+        return not self == other
+
+    def names(self):
+        return [nic.name for nic in self._nics]
+
+    def by_name(self, name):
+        try:
+            return self._by_name[name]
+        except KeyError:
+            raise ValueError("NIC with name '%s' not found" % name)
+
+    def by_hwaddr(self, hwaddr):
+        return self._by_hwaddr.get(hwaddr.lower())
+
+    def replace(self, updated_nics):
+        """New collection with NICs of the same names replaced."""
+        if not updated_nics:
+            return self
+        updated = dict((nic.name, nic) for nic in updated_nics)
+        return NicCollection(updated.get(nic.name, nic)
+                             for nic in self._nics)
+
+
+def process_nic_mappings(args, nics=None, networks=None, use_daemon=True):
+    """Convert NIC mapping options in `args` to virt-install options.
+
+    `nics` (as returned by fetch_nics_from_image, or streamed by
+    iter_nics_from_image) and libvirt `networks` can be passed in when
+    they are already known, e.g. when processing many VMs at once.
+    Otherwise they are fetched, by rejvizd when it is running (and
+    `use_daemon` is set).
+    """
+    if use_daemon and nics is None and networks is None and \
+            has_nic_mapping_args(args):
+        try:
+            return daemon.call('nic_mappings.process_nic_mappings',
+                               args=list(args), cwd=os.getcwd())
+        except daemon.DaemonUnavailable as e:
+            LOG.debug('Processing NIC mappings in-process: %s', e)
+
+    # tokenized once, all the helpers below reuse the same ArgList
+    args = arguments.tokenize(args)
+    no_cache = args.has('--no-inspection-cache')
+    refresh_cache = args.has('--refresh-inspection')
+    args = args.without('--no-inspection-cache', '--refresh-inspection')
+    if not has_nic_mapping_args(args):
+        return args.args
+
+    if networks is None:
+        from rejviz import libvirt_nets
+        networks = libvirt_nets.get_libvirt_networks()
+
+    if nics is None:
+        LOG.info('Looking for NIC configurations in the image...')
+        nics = iter_nics_from_image(args, use_cache=not no_cache,
+                                    refresh_cache=refresh_cache)
+
+    with trace.span('nic_mappings.map_nics',
+                    networks=len(networks)) as span_args:
+        # NICs are auto-mapped one by one as the inspection yields them,
+        # while the appliance is still reading the rest; sorted by name
+        # afterwards, as that's the order of the --network options
+        if _auto_nic_mappings_enabled(args):
+            nic_records = _iter_nics_mapped_auto(nics, networks)
+        else:
+            nic_records = _iter_nic_records(nics)
+        mapped_nics = NicCollection(sorted(nic_records,
+                                           key=lambda nic: nic.name))
+        span_args['nics'] = len(mapped_nics)
+        LOG.info('NICs found: %s', ', '.join(mapped_nics.names()))
+        for nic in mapped_nics:
+            LOG.debug('NIC %s: %s', nic.name, str(nic))
 
-    networks = libvirt_nets.get_libvirt_networks()
+        manual_mappings = _parse_manual_nic_mappings(args)
+        mapped_nics = _map_nics_manual(mapped_nics, manual_mappings)
 
-    mapped_nics = nics
-    if _auto_nic_mappings_enabled(args):
-        mapped_nics = _map_nics_auto(nics, networks)
+        # TODO(jistr): check mappings' sanity
 
-    manual_mappings = _parse_manual_nic_mappings(args)
-    mapped_nics = _map_nics_manual(mapped_nics, manual_mappings)
+        return _convert_nic_mappings_args(args, mapped_nics)
 
-    # TODO(jistr): check mappings' sanity
 
-    return _convert_nic_mappings_args(args, mapped_nics)
+def has_nic_mapping_args(args):
+    args = arguments.tokenize(args)
+    return args.has('--nic-mappings') or args.has('--auto-nic-mappings')
 
 
-def _has_nic_mapping_args(args):
-    return '--nic-mappings' in args or '--auto-nic-mappings' in args
+def _auto_nic_mappings_enabled(args):
+    return arguments.tokenize(args).has('--auto-nic-mappings')
 
 
-def _auto_nic_mappings_enabled(args):
-    return '--auto-nic-mappings' in args
+def fetch_nics_from_image(args, use_cache=True, refresh_cache=False):
+    """Ethernet NICs of the image in `args`, sorted by name."""
+    return sorted(iter_nics_from_image(args, use_cache, refresh_cache),
+                  key=lambda nic: nic['name'])
 
 
-def _fetch_nics_from_image(args):
+def iter_nics_from_image(args, use_cache=True, refresh_cache=False):
+    """Like fetch_nics_from_image, but yields NICs as they are read."""
+    from rejviz import inspection
+    from rejviz import inspection_cache
+
     image_args = utils.extract_image_args_from_disks(args)
-    nic_names = _get_nic_names_from_image(image_args)
-    command = ['guestfish', '-i', '--ro'] + image_args
-    with open(FETCH_SCRIPT_TEMPLATE) as template_file:
-        template = jinja2.Template(template_file.read())
-    script = template.render(
-        nic_config_dir=NIC_CONFIG_DIR,
-        nic_config_prefix=NIC_CONFIG_PREFIX,
-        nic_names=nic_names)
-    LOG.debug('Running guestfish to get NIC config details: %s', str(command))
-    fetcher = subprocess.Popen(command, stdin=subprocess.PIPE,
-                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    output, _ = fetcher.communicate(script)
-    LOG.debug('guestfish returned: %s', output)
-    return _filter_ethernet_nics(_parse_nics_output(output))
-
-
-def _get_nic_names_from_image(image_args):
-    command = ['virt-ls'] + image_args + [NIC_CONFIG_DIR]
-    LOG.debug('Running virt-ls to list NIC configs: %s', str(command))
-    network_scripts = subprocess.check_output(command).splitlines()
-    ifcfg_scripts = [s for s in network_scripts
-                     if s.startswith(NIC_CONFIG_PREFIX)]
-    prefix_len = len(NIC_CONFIG_PREFIX)
-    nic_names = [s[prefix_len:] for s in ifcfg_scripts]
-    return nic_names
-
-
-def _parse_nics_output(output):
-    lines = output.splitlines()
-    nics = []
-    current_nic = {}
-    for i, line in enumerate(lines):
-        # if line is a separator, start a new NIC
-        if line == '@-----':
-            nics.append(current_nic)
-            current_nic = {}
+    cache = inspection_cache.InspectionCache() if use_cache else None
+
+    with trace.span('nic_mappings.fetch_nics_from_image',
+                    image_args=image_args) as span_args:
+        nics = None
+        if cache and not refresh_cache:
+            nics = cache.get(image_args)
+        span_args['cache_hit'] = nics is not None
+        if nics is not None:
+            for nic in _filter_ethernet_nics(nics):
+                yield nic
+        else:
+            nics = []
+            for nic in inspection.iter_nics(image_args):
+                nics.append(nic)
+                if _is_ethernet(nic):
+                    yield nic
+            nics.sort(key=lambda nic: nic['name'])
+            if cache:
+                cache.put(image_args, nics)
+        span_args['nics'] = len(nics)
+
+
+def fetch_nics_from_images(args_list, use_cache=True, refresh_cache=False):
+    """fetch_nics_from_image for many images, sharing appliance launches.
+
+    Returns a list with the NICs of each image, or the exception raised
+    while inspecting it.
+    """
+    from rejviz import inspection
+    from rejviz import inspection_cache
+
+    cache = inspection_cache.InspectionCache() if use_cache else None
+    results = []
+    missed = []
+    for args in args_list:
+        try:
+            image_args = utils.extract_image_args_from_disks(args)
+        except ValueError as e:
+            results.append(e)
             continue
+        nics = None
+        if cache and not refresh_cache:
+            nics = cache.get(image_args)
+        if nics is None:
+            missed.append((len(results), image_args))
+        results.append(nics)
+
+    with trace.span('nic_mappings.fetch_nics_from_images',
+                    images=len(args_list), misses=len(missed)):
+        fetched = inspection.fetch_nics_multi(
+            [image_args for _, image_args in missed])
+        for (i, image_args), nics in zip(missed, fetched):
+            if cache and not isinstance(nics, Exception):
+                cache.put(image_args, nics)
+            results[i] = nics
+    return [nics if isinstance(nics, Exception)
+            else _filter_ethernet_nics(nics) for nics in results]
 
-        # if line is a key, assign a value
-        if line.startswith('@'):
-            next_line = lines[i + 1] if i + 1 < len(lines) else None
 
-            if next_line and not next_line.startswith('@'):
-                current_nic[line[1:]] = next_line
-            # if next line is a key again, assign None to the current key
-            else:
-                current_nic[line[1:]] = None
-    return nics
+def _filter_ethernet_nics(nics):
+    return [nic for nic in nics if _is_ethernet(nic)]
 
 
-def _filter_ethernet_nics(nics):
-    return [nic for nic in nics
-            if nic['type'] and nic['type'].lower() == 'ethernet']
+def _is_ethernet(nic):
+    return nic['type'] and nic['type'].lower() == 'ethernet'
 
 
-def _map_nics_auto(nics, networks):
-    mapped_nics = deepcopy(nics)
+def _iter_nic_records(nics):
+    for nic in nics:
+        yield nic if isinstance(nic, Nic) else Nic.from_dict(nic)
 
-    for nic in mapped_nics:
-        if not nic.get('network'):
-            continue
 
-        for network in networks:
-            if network['network'] == nic['network']:
-                nic['libvirt_network'] = network['name']
+def _iter_nics_mapped_auto(nics, networks):
+    from rejviz import libvirt_nets
+    prefix_index = libvirt_nets.build_prefix_index(networks)
 
-    return mapped_nics
+    for nic in _iter_nic_records(nics):
+        # prefer the NIC's own address, fall back to its network address
+        address = nic.ipaddr or nic.network
+        network = prefix_index.lookup(address) if address else None
+        if network:
+            nic = nic._replace(libvirt_network=network['name'])
+        yield nic
 
 
-def _map_nics_manual(nics, manual_mappings):
-    mapped_nics = deepcopy(nics)
+def _map_nics_auto(nics, networks):
+    return NicCollection(_iter_nics_mapped_auto(nics, networks))
 
-    for nic in mapped_nics:
-        if manual_mappings.get(nic['name']):
-            nic['libvirt_network'] = manual_mappings[nic['name']]
 
-    return mapped_nics
+def _map_nics_manual(nics, manual_mappings):
+    return nics.replace(
+        [nic._replace(libvirt_network=manual_mappings[nic.name])
+         for nic in nics if manual_mappings.get(nic.name)])
 
 
 def _parse_manual_nic_mappings(args):
-    if '--nic-mappings' not in args:
-        return {}
-
-    raw_mappings = args[args.index('--nic-mappings') + 1]
-    keyvals = raw_mappings.split(',')
-    return dict(keyval.split('=', 1) for keyval in keyvals)
+    """Mappings of all --nic-mappings options, later ones take precedence."""
+    mappings = {}
+    for raw_mappings in arguments.tokenize(args).values('--nic-mappings'):
+        mappings.update(keyval.split('=', 1)
+                        for keyval in raw_mappings.split(','))
+    return mappings
 
 
 def _convert_nic_mappings_args(args, mapped_nics):
-    def get_nic_names(manual_mappings):
-        keyvals = manual_mappings.split(',')
-        return [keyval.split('=', 1)[0] for keyval in keyvals]
-
+    args = arguments.tokenize(args)
+    replacements = {}
     inserted_nic_names = set()
 
-    # convert manual mappings
-    converted_manual = []
-    args_iter = iter(args)
-    for arg in args_iter:
-        if arg == '--nic-mappings':
-            mappings_value = next(args_iter)
-            nic_names = get_nic_names(mappings_value)
-            inserted_nic_names = inserted_nic_names.union(set(nic_names))
-            converted_manual.extend(_network_args(nic_names, mapped_nics))
-        else:
-            converted_manual.append(arg)
-
-    # convert automatic mappings
-    converted_auto = []
-    for arg in converted_manual:
-        if arg == '--auto-nic-mappings':
-            all_nic_names = set(nic['name'] for nic in mapped_nics)
-            names_to_insert = all_nic_names.difference(inserted_nic_names)
-            inserted_nic_names = inserted_nic_names.union(names_to_insert)
-            converted_auto.extend(_network_args(names_to_insert, mapped_nics))
-        else:
-            converted_auto.append(arg)
+    # manual mappings first, automatic ones only add the remaining NICs;
+    # a NIC mapped repeatedly is emitted once, where it's first mentioned
+    for index in args.token_indexes('--nic-mappings'):
+        nic_names = []
+        for keyval in args.tokens[index].value.split(','):
+            nic_name = keyval.split('=', 1)[0]
+            if nic_name not in inserted_nic_names:
+                inserted_nic_names.add(nic_name)
+                nic_names.append(nic_name)
+        replacements[index] = _network_args(nic_names, mapped_nics)
+
+    for index in args.token_indexes('--auto-nic-mappings'):
+        names_to_insert = [name for name in mapped_nics.names()
+                           if name not in inserted_nic_names]
+        inserted_nic_names.update(names_to_insert)
+        replacements[index] = _network_args(names_to_insert, mapped_nics)
 
-    return converted_auto
+    return args.rebuild(replacements)
 
 
 def _network_args(nic_names, mapped_nics):
     args = []
 
     for nic_name in nic_names:
-        nic = _nic_by_name(nic_name, mapped_nics)
+        nic = mapped_nics.by_name(nic_name)
+        if not nic.libvirt_network:
+            raise ValueError("NIC '%s' is not mapped to any libvirt network"
+                             % nic_name)
         args.append('--network')
-        args.append('network=%(libvirt_network)s,mac=%(hwaddr)s,model=virtio'
-                    % nic)
+        args.append('network=%s,mac=%s,model=virtio'
+                    % (nic.libvirt_network, nic.hwaddr))
 
     return args
-
-
-def _nic_by_name(nic_name, nics):
-    for nic in nics:
-        if nic['name'] == nic_name:
-            return nic
-    raise ValueError("NIC with name '%s' not found" % nic_name)
@@ -0,0 +1,53 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License. You may
+# obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+import logging
+import threading
+
+import jinja2
+
+from rejviz import utils
+
+
+LOG = logging.getLogger(__file__)
+
+_environment = None
+_environment_lock = threading.Lock()
+
+
+def render(template_name, **template_vars):
+    template = get_environment().get_template(template_name)
+    return template.render(**template_vars)
+
+
+def get_environment():
+    """Process-wide Jinja environment for the packaged templates.
+
+    Templates are compiled once per process, and the compiled code is
+    kept in a bytecode cache on disk, so following processes skip the
+    compilation too.
+    """
+    global _environment
+    with _environment_lock:
+        if _environment is None:
+            _environment = jinja2.Environment(
+                loader=jinja2.PackageLoader('rejviz', 'templates'),
+                bytecode_cache=_bytecode_cache())
+        return _environment
+
+
+def _bytecode_cache():
+    try:
+        return jinja2.FileSystemBytecodeCache(utils.cache_dir('jinja'))
+    except OSError as e:
+        LOG.debug('Template bytecode cache disabled: %s', e)
+        return None
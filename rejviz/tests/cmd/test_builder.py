@@ -10,6 +10,12 @@
 # implied. See the License for the specific language governing
 # permissions and limitations under the License.
 
+import json
+from os import path
+import shutil
+import subprocess
+import tempfile
+
 import mock
 
 from rejviz.cmd import builder
@@ -32,3 +38,67 @@ class BuilderTest(tutils.TestCase):
         tmp.create_dir.assert_called_with()
         call.assert_called_with(['virt-builder', '--one', '--two'])
         tmp.remove_dir.assert_called_with('/tmp/abc')
+
+    @mock.patch('os.execvp')
+    @mock.patch('rejviz.cmd.builder.tmp')
+    @mock.patch('subprocess.call')
+    @mock.patch('sys.argv', new=['rejviz-builder', '--one', '--exec'])
+    def test_main_exec(self, call, tmp, execvp):
+        tmp.create_dir.return_value = '/tmp/abc'
+        execvp.side_effect = OSError('exec failed')
+
+        self.assertRaises(OSError, builder.main)
+
+        tmp.remove_dir_after_exit.assert_called_with('/tmp/abc')
+        execvp.assert_called_with('virt-builder', ['virt-builder', '--one'])
+        self.assertEqual([], call.mock_calls)
+        # cleaned up right away if exec fails
+        tmp.remove_dir.assert_called_with('/tmp/abc')
+
+    @mock.patch('rejviz.build_cache.BuildCache')
+    @mock.patch('subprocess.call')
+    def test_build_with_cache(self, call, build_cache):
+        call.return_value = 0
+        cache = build_cache.return_value
+        cache.build.side_effect = lambda args, build_image: build_image(
+            ['-o', '/cache/tmp'] + args)
+
+        exit_code = builder._build(
+            ['centos-7.0', '--build-cache', '--build-cache-max-gib', '2'],
+            '/tmp/abc')
+
+        self.assertEqual(0, exit_code)
+        build_cache.assert_called_once_with(max_bytes=2 * 1024 ** 3)
+        call.assert_called_once_with(
+            ['virt-builder', '-o', '/cache/tmp', 'centos-7.0'])
+
+    @mock.patch('rejviz.cmd.builder.tmp')
+    @mock.patch('subprocess.call')
+    def test_main_batch(self, call, tmp):
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir)
+        manifest_path = path.join(work_dir, 'manifest.json')
+        summary_path = path.join(work_dir, 'summary.json')
+        with open(manifest_path, 'w') as f:
+            json.dump([{'name': 'vm1', 'args': ['-o', 'vm1.qcow2']},
+                       {'name': 'vm2', 'args': ['-o', 'vm2.qcow2']}], f)
+        tmp.create_dir.side_effect = ['/tmp/vm1', '/tmp/vm2']
+        call.side_effect = lambda args, **kwargs: 0 if 'vm1.qcow2' in args \
+            else 1
+        argv = ['rejviz-builder', 'centos-7.0', '--batch', manifest_path,
+                '--batch-log-dir', path.join(work_dir, 'logs'),
+                '--batch-summary', summary_path, '--batch-jobs', '1']
+
+        with mock.patch('sys.argv', new=argv):
+            exit_error = self.assertRaises(SystemExit, builder.main)
+
+        self.assertEqual(1, exit_error.code)
+        call.assert_any_call(
+            ['virt-builder', 'centos-7.0', '-o', 'vm1.qcow2'],
+            stdout=mock.ANY, stderr=subprocess.STDOUT)
+        self.assertEqual([mock.call('/tmp/vm1'), mock.call('/tmp/vm2')],
+                         tmp.remove_dir.mock_calls)
+        with open(summary_path) as f:
+            summary = json.load(f)
+        self.assertEqual([0, 1], [j['exit_code'] for j in summary['jobs']])
+        self.assertTrue(path.exists(path.join(work_dir, 'logs', 'vm1.log')))
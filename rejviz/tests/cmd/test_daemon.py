@@ -0,0 +1,59 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License. You may
+# obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+import mock
+
+from rejviz.cmd import daemon
+import rejviz.tests.utils as tutils
+
+
+class DaemonTest(tutils.TestCase):
+
+    @mock.patch('rejviz.nic.process_args', return_value=['--upload', 'a:b'])
+    def test_process_nic_args(self, process_args):
+        self.assertEqual(
+            ['--upload', 'a:b'],
+            daemon.methods()['nic.process_args'](['--nic', 'name=eth0'],
+                                                 '/tmp/dir'))
+        process_args.assert_called_with(['--nic', 'name=eth0'], '/tmp/dir',
+                                        use_daemon=False)
+
+    @mock.patch('rejviz.libvirt_nets.get_libvirt_networks',
+                return_value=[{'name': 'default'}])
+    @mock.patch('rejviz.nic_mappings.process_nic_mappings')
+    @mock.patch('rejviz.nic_mappings.iter_nics_from_image')
+    def test_process_nic_mappings(self, fetch_nics, process_nic_mappings,
+                                  get_libvirt_networks):
+        args = ['--disk', 'path=vm.qcow2,bus=virtio', '--auto-nic-mappings',
+                '--refresh-inspection']
+
+        daemon.methods()['nic_mappings.process_nic_mappings'](
+            args, '/home/user')
+
+        # the image is looked up relative to the client
+        fetch_nics.assert_called_with(['--disk', '/home/user/vm.qcow2'],
+                                      use_cache=True, refresh_cache=True)
+        process_nic_mappings.assert_called_with(
+            args, nics=fetch_nics.return_value,
+            networks=[{'name': 'default'}], use_daemon=False)
+
+    @mock.patch('rejviz.nic_mappings.process_nic_mappings',
+                return_value=['--name', 'vm'])
+    @mock.patch('rejviz.nic_mappings.iter_nics_from_image')
+    def test_process_nic_mappings_without_mappings(self, fetch_nics,
+                                                   process_nic_mappings):
+        daemon.methods()['nic_mappings.process_nic_mappings'](
+            ['--name', 'vm'], '/home/user')
+
+        self.assertEqual([], fetch_nics.mock_calls)
+        process_nic_mappings.assert_called_with(
+            ['--name', 'vm'], nics=None, networks=None, use_daemon=False)
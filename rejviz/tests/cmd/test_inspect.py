@@ -0,0 +1,137 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License. You may
+# obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+import json
+from multiprocessing import pool
+import os
+from os import path
+import shutil
+import tempfile
+
+import mock
+import six
+
+from rejviz import trace
+from rejviz.cmd import inspect
+import rejviz.tests.utils as tutils
+
+
+class InspectTest(tutils.TestCase):
+
+    def setUp(self):
+        super(InspectTest, self).setUp()
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir)
+
+    def _touch(self, *path_parts):
+        file_path = path.join(self.work_dir, *path_parts)
+        if not path.isdir(path.dirname(file_path)):
+            os.makedirs(path.dirname(file_path))
+        with open(file_path, 'w') as f:
+            f.write('not a real image')
+        return file_path
+
+    def test_find_images(self):
+        b_img = self._touch('b.img')
+        a_qcow2 = self._touch('sub', 'a.qcow2')
+        self._touch('notes.txt')
+
+        self.assertEqual(
+            [['-a', '/explicit.raw'], ['-a', b_img], ['-a', a_qcow2]],
+            inspect._find_images(['/explicit.raw', self.work_dir]))
+
+    @mock.patch('rejviz.inspection.fetch_nics')
+    def test_inspect_caches(self, fetch_nics):
+        image_path = self._touch('a.img')
+        fetch_nics.return_value = [{'name': 'eth0', 'hwaddr': None}]
+
+        first = inspect._inspect(['-a', image_path])
+        second = inspect._inspect(['-a', image_path])
+
+        self.assertEqual({'image': image_path, 'cached': False,
+                          'nics': fetch_nics.return_value},
+                         dict((k, v) for k, v in first.items()
+                              if k != 'seconds'))
+        self.assertTrue(second['cached'])
+        self.assertEqual(1, fetch_nics.call_count)
+        fetch_nics.assert_called_with(['-a', image_path], mode='raw')
+
+    @mock.patch('rejviz.inspection.fetch_nics')
+    def test_inspect_caches_per_mode(self, fetch_nics):
+        image_path = self._touch('a.img')
+        fetch_nics.return_value = [{'name': 'eth0', 'hwaddr': None}]
+
+        inspect._inspect(['-a', image_path])
+        record = inspect._inspect(['-a', image_path], mode='augeas')
+
+        self.assertFalse(record['cached'])
+        fetch_nics.assert_called_with(['-a', image_path], mode='augeas')
+
+    @mock.patch('rejviz.inspection.fetch_nics',
+                side_effect=RuntimeError('No operating system found'))
+    def test_inspect_error(self, fetch_nics):
+        record = inspect._inspect(['-d', 'vm1'])
+
+        self.assertEqual('vm1', record['domain'])
+        self.assertEqual('No operating system found', record['error'])
+        self.assertIn('seconds', record)
+
+    @mock.patch('multiprocessing.Pool', pool.ThreadPool)
+    @mock.patch('sys.stdout', new_callable=six.StringIO)
+    @mock.patch('rejviz.inspection.fetch_nics')
+    def test_main(self, fetch_nics, stdout):
+        good = self._touch('good.img')
+        bad = self._touch('bad.img')
+        fetch_nics.side_effect = lambda image_args, mode: \
+            [{'name': 'eth0'}] if image_args[1] == good else \
+            self._raise(RuntimeError('broken'))
+
+        with mock.patch('sys.argv', new=['rejviz-inspect', '-j', '2',
+                                         '--no-inspection-cache',
+                                         self.work_dir]):
+            exit_error = self.assertRaises(SystemExit, inspect.main)
+
+        self.assertEqual(1, exit_error.code)
+        records = dict((r['image'], r) for r in
+                       map(json.loads, stdout.getvalue().splitlines()))
+        self.assertEqual([{'name': 'eth0'}], records[good]['nics'])
+        self.assertEqual('broken', records[bad]['error'])
+
+    @mock.patch('sys.stdout', new_callable=six.StringIO)
+    @mock.patch('rejviz.inspection.fetch_nics')
+    def test_main_traces_workers(self, fetch_nics, stdout):
+        image_path = self._touch('a.img')
+        trace_path = path.join(self.work_dir, 'trace.json')
+
+        def fetch_nics_traced(image_args, mode):
+            with trace.span('inspection.fetch_nics'):
+                return [{'name': 'eth0'}]
+        fetch_nics.side_effect = fetch_nics_traced
+
+        # workers are forked, spans reach the trace only through the parent
+        with mock.patch('sys.argv', new=['rejviz-inspect', '-j', '1',
+                                         '--no-inspection-cache',
+                                         '--trace', trace_path,
+                                         image_path]):
+            exit_error = self.assertRaises(SystemExit, inspect.main)
+
+        self.assertEqual(0, exit_error.code)
+        with open(trace_path) as f:
+            events = json.load(f)['traceEvents']
+        self.assertEqual(
+            ['rejviz-inspect', 'rejviz-inspect.image',
+             'inspection.fetch_nics'],
+            [e['name'] for e in events])
+        self.assertNotEqual(os.getpid(), events[2]['pid'])
+
+    def _raise(self, error):
+        raise error
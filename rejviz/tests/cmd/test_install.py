@@ -10,6 +10,12 @@
 # implied. See the License for the specific language governing
 # permissions and limitations under the License.
 
+import json
+from os import path
+import shutil
+import subprocess
+import tempfile
+
 import mock
 
 from rejviz.cmd import install
@@ -24,3 +30,88 @@ class InstallTest(tutils.TestCase):
         install.main()
 
         call.assert_called_with(['virt-install', '--one', '--two'])
+
+    @mock.patch('os.execvp')
+    @mock.patch('subprocess.call')
+    @mock.patch('sys.argv', new=['rejviz-install', '--exec', '--one'])
+    def test_main_exec(self, call, execvp):
+        execvp.side_effect = OSError('exec failed')
+
+        self.assertRaises(OSError, install.main)
+
+        execvp.assert_called_with('virt-install', ['virt-install', '--one'])
+        self.assertEqual([], call.mock_calls)
+
+    @mock.patch('rejviz.libvirt_nets.get_libvirt_networks')
+    @mock.patch('rejviz.nic_mappings.fetch_nics_from_images')
+    @mock.patch('subprocess.call')
+    def test_main_batch(self, call, fetch_nics, get_networks):
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir)
+        manifest_path = path.join(work_dir, 'manifest.json')
+        summary_path = path.join(work_dir, 'summary.json')
+        image_path = path.join(work_dir, 'base.qcow2')
+        disk_arg = 'path=%s' % image_path
+        with open(manifest_path, 'w') as f:
+            json.dump([{'name': 'vm%d' % i,
+                        'args': ['--name', 'vm%d' % i, '--disk', disk_arg,
+                                 '--auto-nic-mappings']}
+                       for i in range(3)], f)
+        fetch_nics.return_value = [[{'name': 'eth0', 'network': '10.0.0.0',
+                                     'hwaddr': '52:54:00:00:00:01'}]]
+        get_networks.return_value = [
+            {'name': 'net1', 'network': '10.0.0.0',
+             'netmask': '255.255.255.0'}]
+        call.return_value = 0
+        argv = ['rejviz-install', '--batch', manifest_path,
+                '--batch-log-dir', path.join(work_dir, 'logs'),
+                '--batch-summary', summary_path]
+
+        with mock.patch('sys.argv', new=argv):
+            exit_error = self.assertRaises(SystemExit, install.main)
+
+        self.assertEqual(0, exit_error.code)
+        fetch_nics.assert_called_once_with(
+            [['--name', 'vm0', '--disk', disk_arg, '--auto-nic-mappings']],
+            use_cache=True, refresh_cache=False)
+        get_networks.assert_called_once_with()
+        call.assert_any_call(
+            ['virt-install', '--name', 'vm1', '--disk', disk_arg,
+             '--network',
+             'network=net1,mac=52:54:00:00:00:01,model=virtio'],
+            stdout=mock.ANY, stderr=subprocess.STDOUT)
+        with open(summary_path) as f:
+            summary = json.load(f)
+        self.assertEqual(3, summary['total'])
+        self.assertEqual(0, summary['failed'])
+
+    @mock.patch('rejviz.nic_mappings.fetch_nics_from_images')
+    def test_inspect_images_failure_is_per_image(self, fetch_nics):
+        error = RuntimeError('broken image')
+        fetch_nics.side_effect = lambda args_list, **kwargs: [
+            error if 'path=/a.img' in args else [] for args in args_list]
+
+        nics_by_image = install._inspect_images(
+            [['--disk', 'path=/a.img', '--auto-nic-mappings'],
+             ['--disk', 'path=/b.img', '--auto-nic-mappings'],
+             ['--disk', 'path=/b.img', '--auto-nic-mappings'],
+             ['--disk', 'path=/c.img']], 2)
+
+        self.assertEqual({('-a', '/a.img'): error, ('-a', '/b.img'): []},
+                         nics_by_image)
+        # 2 images with concurrency 2, one chunk each
+        self.assertEqual(2, fetch_nics.call_count)
+
+    @mock.patch('rejviz.inspection.MAX_DRIVES', 2)
+    @mock.patch('rejviz.nic_mappings.fetch_nics_from_images')
+    def test_inspect_images_in_chunks(self, fetch_nics):
+        fetch_nics.side_effect = lambda args_list, **kwargs: \
+            [[] for _ in args_list]
+
+        nics_by_image = install._inspect_images(
+            [['--disk', 'path=/%d.img' % i, '--auto-nic-mappings']
+             for i in range(5)], 1)
+
+        self.assertEqual(5, len(nics_by_image))
+        self.assertEqual([2, 2, 1], [len(c[0][0])
+                                     for c in fetch_nics.call_args_list])
@@ -0,0 +1,201 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License. You may
+# obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+import fcntl
+import os
+from os import path
+import shutil
+import stat
+import tempfile
+import threading
+
+import mock
+
+from rejviz import admission
+import rejviz.tests.utils as tutils
+
+
+class AdmissionControllerTest(tutils.TestCase):
+
+    def setUp(self):
+        super(AdmissionControllerTest, self).setUp()
+        self.run_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.run_dir)
+        self.controller = admission.AdmissionController(
+            self.run_dir, max_launches=2, min_free_bytes=0)
+        self.poll_patcher = mock.patch('rejviz.admission.POLL_INTERVAL',
+                                       0.01)
+        self.poll_patcher.start()
+        self.addCleanup(self.poll_patcher.stop)
+
+    def _queued_ticket(self, ticket, locked=True):
+        ticket_path = path.join(self.run_dir, '%s%016d-1' % (
+            admission.QUEUE_PREFIX, ticket))
+        ticket_fd = os.open(ticket_path, os.O_WRONLY | os.O_CREAT)
+        if locked:
+            fcntl.flock(ticket_fd, fcntl.LOCK_EX)
+            self.addCleanup(os.close, ticket_fd)
+        else:
+            os.close(ticket_fd)
+        return ticket_path
+
+    def _queue(self):
+        return [name for name in os.listdir(self.run_dir)
+                if name.startswith(admission.QUEUE_PREFIX)]
+
+    def test_acquire_up_to_max_launches(self):
+        first = self.controller.acquire()
+        second = self.controller.acquire()
+        self.assertEqual([0, 1], sorted([first.index, second.index]))
+        self.assertRaises(RuntimeError, self.controller.acquire, timeout=0)
+
+        first.release()
+        third = self.controller.acquire(timeout=1)
+        self.assertEqual(first.index, third.index)
+        self.assertEqual([], self._queue())
+
+    def test_acquire_waits_for_earlier_tickets(self):
+        earlier = self._queued_ticket(0)
+        self.assertRaises(RuntimeError, self.controller.acquire, timeout=0.05)
+
+        os.unlink(earlier)
+        self.assertEqual(0, self.controller.acquire(timeout=1).index)
+
+    def test_acquire_skips_tickets_of_dead_waiters(self):
+        dead = self._queued_ticket(0, locked=False)
+        self.assertEqual(0, self.controller.acquire(timeout=1).index)
+        self.assertFalse(path.exists(dead))
+
+    def test_acquire_is_fifo(self):
+        held = self.controller.acquire()
+        self.controller.acquire()
+        order = []
+
+        def wait(name):
+            order.append((name, self.controller.acquire(timeout=5)))
+
+        waiters = []
+        for name in ['first', 'second']:
+            waiter = threading.Thread(target=wait, args=(name,))
+            waiter.start()
+            waiters.append(waiter)
+            # wait until the waiter is queued
+            while len(self._queue()) < len(waiters):
+                pass
+
+        held.release()
+        waiters[0].join()
+        self.assertEqual(['first'], [name for name, _ in order])
+        order[0][1].release()
+        waiters[1].join()
+        self.assertEqual(['first', 'second'], [name for name, _ in order])
+
+    def test_corrupt_ticket_counter(self):
+        with open(path.join(self.run_dir, admission.TICKET_COUNTER),
+                  'w') as counter:
+            counter.write('garbage')
+
+        self.assertEqual(0, self.controller.acquire(timeout=1).index)
+        counter_path = path.join(self.run_dir, admission.TICKET_COUNTER)
+        with open(counter_path) as counter:
+            self.assertEqual('1', counter.read())
+
+    def test_symlinks_not_followed(self):
+        victim_fd, victim = tempfile.mkstemp()
+        os.close(victim_fd)
+        self.addCleanup(os.unlink, victim)
+        os.chmod(victim, 0o600)
+        os.symlink(victim, path.join(self.run_dir, admission.TICKET_COUNTER))
+
+        self.assertRaises(OSError, self.controller.acquire, timeout=0)
+        self.assertEqual(0o600, stat.S_IMODE(os.stat(victim).st_mode))
+        self.assertEqual(0, os.stat(victim).st_size)
+
+    def test_unsafe_run_dir(self):
+        os.chmod(self.run_dir, 0o777)
+        self.assertRaises(RuntimeError, self.controller.acquire, timeout=0)
+
+        link = self.run_dir + '-link'
+        os.symlink(self.run_dir, link)
+        self.addCleanup(os.unlink, link)
+        os.chmod(self.run_dir, 0o700)
+        controller = admission.AdmissionController(link, max_launches=1,
+                                                   min_free_bytes=0)
+        self.assertRaises(RuntimeError, controller.acquire, timeout=0)
+
+    @mock.patch('rejviz.admission.os.lstat')
+    def test_run_dir_of_other_user(self, lstat):
+        lstat.return_value = mock.Mock(st_mode=stat.S_IFDIR | 0o700,
+                                       st_uid=os.getuid() + 1)
+        self.assertRaises(RuntimeError, self.controller.acquire, timeout=0)
+
+    @mock.patch('rejviz.admission.os.lstat')
+    def test_shared_run_dir(self, lstat):
+        lstat.return_value = mock.Mock(st_mode=stat.S_IFDIR | 0o1777,
+                                       st_uid=0)
+        counter_path = path.join(self.run_dir, admission.TICKET_COUNTER)
+        os.close(os.open(counter_path, os.O_WRONLY | os.O_CREAT, 0o600))
+        os.chmod(counter_path, 0o600)
+
+        self.controller.acquire(timeout=1).release()
+
+        # files created are usable by all users, existing ones untouched
+        self.assertEqual(0o666, stat.S_IMODE(os.stat(
+            path.join(self.run_dir, admission.SLOT_PREFIX + '0')).st_mode))
+        self.assertEqual(0o600, stat.S_IMODE(os.stat(counter_path).st_mode))
+
+    def test_default_run_dir_is_private(self):
+        with mock.patch.dict(os.environ, {admission.DIR_ENV: ''}):
+            controller = admission.AdmissionController(max_launches=1,
+                                                       min_free_bytes=0)
+            controller.acquire(timeout=1).release()
+        self.assertEqual(
+            0o700, stat.S_IMODE(os.stat(controller.run_dir).st_mode))
+
+    @mock.patch('rejviz.admission._available_memory')
+    def test_acquire_waits_for_memory(self, available_memory):
+        self.controller.min_free_bytes = 1024 ** 3
+        available_memory.return_value = 1023 * 1024 ** 2
+        error = self.assertRaises(RuntimeError, self.controller.acquire,
+                                  timeout=0.05)
+        self.assertIn('1024 MiB of available memory, only 1023 MiB',
+                      str(error))
+
+        available_memory.return_value = 1024 ** 3
+        self.assertEqual(0, self.controller.acquire(timeout=1).index)
+
+    @mock.patch('rejviz.admission._available_memory', return_value=0)
+    def test_memory_gate_is_opt_in(self, available_memory):
+        os.environ.pop(admission.MIN_FREE_ENV, None)
+        controller = admission.AdmissionController(self.run_dir)
+        self.assertEqual(0, controller.min_free_bytes)
+        controller.acquire(timeout=1).release()
+
+    def test_config_from_env(self):
+        with mock.patch.dict(os.environ, {admission.MAX_LAUNCHES_ENV: '3',
+                                          admission.MIN_FREE_ENV: '2'}):
+            controller = admission.AdmissionController()
+        self.assertEqual(3, controller.max_launches)
+        self.assertEqual(2 * 1024 ** 2, controller.min_free_bytes)
+
+    @mock.patch('rejviz.admission.AdmissionController.acquire')
+    def test_appliance_slot_disabled(self, acquire):
+        with mock.patch.dict(os.environ, {admission.MAX_LAUNCHES_ENV: '0'}):
+            with admission.appliance_slot('virt-ls') as slot:
+                self.assertIsNone(slot)
+        self.assertEqual([], acquire.mock_calls)
+
+    def test_appliance_slot_releases(self):
+        with admission.appliance_slot('virt-ls') as slot:
+            slot_fd = slot.fd
+        self.assertIsNone(slot.fd)
+        self.assertRaises(OSError, os.fstat, slot_fd)
@@ -0,0 +1,97 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License. You may
+# obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+from rejviz import arguments
+import rejviz.tests.utils as tutils
+
+
+class ArgListTest(tutils.TestCase):
+
+    def setUp(self):
+        super(ArgListTest, self).setUp()
+        self.args = arguments.ArgList([
+            '--name', 'vm', '--disk', '/image1', '--nic-mappings=eth0=net0',
+            '--auto-nic-mappings', '--disk=path=/image2', '--nic-mappings',
+            'eth1=net1', '--other'])
+
+    def test_tokens(self):
+        self.assertEqual(
+            [(None, '--name', 0, 1),
+             (None, 'vm', 1, 2),
+             ('--disk', '/image1', 2, 4),
+             ('--nic-mappings', 'eth0=net0', 4, 5),
+             ('--auto-nic-mappings', None, 5, 6),
+             ('--disk', 'path=/image2', 6, 7),
+             ('--nic-mappings', 'eth1=net1', 7, 9),
+             (None, '--other', 9, 10)],
+            self.args.tokens)
+
+    def test_other_value_options(self):
+        args = arguments.ArgList(['-d', 'dom', '--disk'],
+                                 value_options=arguments.IMAGE_OPTIONS)
+
+        self.assertEqual(['dom'], args.values('-d'))
+        self.assertFalse(args.has('--disk'))
+
+    def test_missing_value(self):
+        self.assertRaises(ValueError, arguments.ArgList, ['--nic'])
+
+    def test_lookups(self):
+        self.assertTrue(self.args.has('--auto-nic-mappings'))
+        self.assertFalse(self.args.has('--nic'))
+        self.assertEqual([2, 6], self.args.positions('--disk'))
+        self.assertEqual(['/image1', 'path=/image2'],
+                         self.args.values('--disk'))
+        self.assertEqual('eth0=net0', self.args.first('--nic-mappings'))
+        self.assertEqual('eth1=net1', self.args.last('--nic-mappings'))
+        self.assertEqual('x', self.args.first('--nic', 'x'))
+
+    def test_rebuild(self):
+        args = arguments.ArgList(['-a', '--nic', 'x', '--nic=y', '-b'])
+        nic_indexes = args.token_indexes('--nic')
+
+        self.assertEqual(
+            ['-a', '--upload', 'x', '-b'],
+            args.rebuild({nic_indexes[0]: ['--upload', 'x'],
+                          nic_indexes[1]: []}))
+        self.assertEqual(['-a', '--nic', 'x', '--nic=y', '-b'],
+                         args.rebuild({}))
+
+    def test_without(self):
+        args = arguments.ArgList(['--refresh-inspection', '--disk', 'd',
+                                  '--refresh-inspection'])
+
+        self.assertEqual(['--disk', 'd'],
+                         args.without('--refresh-inspection').args)
+        self.assertIs(args, args.without('--no-inspection-cache'))
+
+    def test_without_keeps_options(self):
+        args = arguments.ArgList(['-o', 'out', '--format', 'qcow2', '-x'],
+                                 value_options=arguments.VIRT_BUILDER_OPTIONS,
+                                 flag_options=())
+        remaining = args.without('-o')
+
+        self.assertEqual(['--format', 'qcow2', '-x'], remaining.args)
+        self.assertEqual([('--format', 'qcow2', 0, 2), (None, '-x', 2, 3)],
+                         remaining.tokens)
+        self.assertEqual('qcow2', remaining.last('--format'))
+        self.assertIs(remaining, arguments.tokenize(
+            remaining, arguments.VIRT_BUILDER_OPTIONS, flag_options=()))
+
+    def test_tokenize(self):
+        self.assertIs(self.args, arguments.tokenize(self.args))
+        self.assertEqual(['--disk', 'd'],
+                         arguments.tokenize(('--disk', 'd')).args)
+        # tokenized again when other options are asked for
+        image_args = arguments.tokenize(self.args, arguments.IMAGE_OPTIONS)
+        self.assertIsNot(self.args, image_args)
+        self.assertFalse(image_args.has('--disk'))
@@ -0,0 +1,131 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License. You may
+# obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+
+import json
+from os import path
+import shutil
+import tempfile
+import threading
+import time
+
+import mock
+
+from rejviz import batch
+import rejviz.tests.utils as tutils
+
+
+class BatchTest(tutils.TestCase):
+
+    def setUp(self):
+        super(BatchTest, self).setUp()
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir)
+        self.log_dir = path.join(self.work_dir, 'logs')
+
+    def _write_manifest(self, manifest, name='manifest.json'):
+        manifest_path = path.join(self.work_dir, name)
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f)
+        return manifest_path
+
+    def test_load_manifest(self):
+        manifest_path = self._write_manifest({'jobs': [
+            {'name': 'web1', 'args': ['centos-7.0']},
+            {'args': ['fedora-20']},
+        ]})
+
+        self.assertEqual(
+            [{'name': 'web1', 'args': ['centos-7.0']},
+             {'name': 'job-1', 'args': ['fedora-20']}],
+            batch.load_manifest(manifest_path))
+
+    def test_load_manifest_list(self):
+        manifest_path = self._write_manifest([{'name': 'a'}])
+        self.assertEqual([{'name': 'a', 'args': []}],
+                         batch.load_manifest(manifest_path))
+
+    def test_load_manifest_invalid(self):
+        for manifest in [{'no': 'jobs'}, ['not a job'],
+                         [{'args': 'not a list'}],
+                         [{'name': 'a'}, {'name': 'a'}]]:
+            self.assertRaises(ValueError, batch.load_manifest,
+                              self._write_manifest(manifest))
+
+    @mock.patch.dict('sys.modules', {'yaml': None})
+    def test_load_manifest_yaml_unavailable(self):
+        manifest_path = self._write_manifest([], name='manifest.yaml')
+        self.assertRaises(ValueError, batch.load_manifest, manifest_path)
+
+    def test_run_jobs(self):
+        def run_job(job, log_path):
+            if job['name'] == 'broken':
+                raise RuntimeError('broken job')
+            return job['exit_code']
+
+        results = batch.run_jobs(
+            [{'name': 'ok', 'exit_code': 0},
+             {'name': 'failed', 'exit_code': 3},
+             {'name': 'broken'},
+             {'name': 'weird/name', 'exit_code': 0}],
+            run_job, concurrency=2, log_dir=self.log_dir)
+
+        self.assertEqual(['ok', 'failed', 'broken', 'weird/name'],
+                         [r['name'] for r in results])
+        self.assertEqual([0, 3, None, 0], [r['exit_code'] for r in results])
+        self.assertEqual('broken job', results[2]['error'])
+        self.assertEqual(path.join(self.log_dir, 'weird_name.log'),
+                         results[3]['log'])
+        self.assertEqual([False, True, True, False],
+                         [batch.job_failed(r) for r in results])
+
+    def test_run_jobs_concurrency_limit(self):
+        lock = threading.Lock()
+        state = {'running': 0, 'max_running': 0}
+
+        def run_job(job, log_path):
+            with lock:
+                state['running'] += 1
+                state['max_running'] = max(state['max_running'],
+                                           state['running'])
+            time.sleep(0.02)
+            with lock:
+                state['running'] -= 1
+            return 0
+
+        batch.run_jobs([{'name': str(i)} for i in range(12)], run_job,
+                       concurrency=3, log_dir=self.log_dir)
+
+        self.assertEqual(3, state['max_running'])
+
+    def test_write_summary(self):
+        summary_path = path.join(self.work_dir, 'summary.json')
+        results = [{'name': 'a', 'exit_code': 0, 'duration': 1.0},
+                   {'name': 'b', 'exit_code': 1, 'duration': 2.0}]
+
+        batch.write_summary(results, summary_path)
+
+        with open(summary_path) as f:
+            summary = json.load(f)
+        self.assertEqual(2, summary['total'])
+        self.assertEqual(1, summary['failed'])
+        self.assertEqual(results, summary['jobs'])
+
+    def test_pop_batch_options(self):
+        options, args = batch.pop_batch_options(
+            ['--batch', 'm.json', '--batch-jobs=8', '--size', '10G',
+             '--batch-summary', 's.json'])
+
+        self.assertEqual({'manifest': 'm.json', 'concurrency': 8,
+                          'log_dir': 'rejviz-batch-logs',
+                          'summary': 's.json'}, options)
+        self.assertEqual(['--size', '10G'], args.args)
@@ -0,0 +1,222 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License. You may
+# obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+import json
+import os
+from os import path
+import shutil
+import struct
+import tempfile
+
+import mock
+
+from rejviz import build_cache
+from rejviz import inspection_cache
+import rejviz.tests.utils as tutils
+
+
+class BuildCacheTest(tutils.TestCase):
+
+    def setUp(self):
+        super(BuildCacheTest, self).setUp()
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir)
+        self.cache_dir = path.join(self.work_dir, 'cache')
+        os.mkdir(self.cache_dir)
+        self.cache = build_cache.BuildCache(self.cache_dir)
+        self.builds = []
+
+    def _write_file(self, name, contents):
+        file_path = path.join(self.work_dir, name)
+        with open(file_path, 'w') as f:
+            f.write(contents)
+        return file_path
+
+    def _build_image(self, args):
+        self.builds.append(args)
+        with open(args[args.index('-o') + 1], 'w') as f:
+            f.write('image built from %s' % args[2:])
+        return 0
+
+    def _cached_images(self):
+        return [f for f in os.listdir(self.cache_dir)
+                if f.endswith(build_cache.IMAGE_SUFFIX)]
+
+    def test_cache_key_ignores_output_and_verbosity(self):
+        self.assertEqual(
+            build_cache.cache_key(['centos-7.0', '--size', '10G']),
+            build_cache.cache_key(['centos-7.0', '-o', 'a.img', '-v',
+                                   '--size=10G', '--output', 'b.img']))
+        self.assertNotEqual(
+            build_cache.cache_key(['centos-7.0', '--size', '10G']),
+            build_cache.cache_key(['centos-7.0', '--size', '20G']))
+
+    def test_cache_key_hashes_uploaded_file_contents(self):
+        first = self._write_file('ifcfg-eth0', 'DEVICE=eth0\n')
+        same = self._write_file('other-ifcfg-eth0', 'DEVICE=eth0\n')
+        changed = self._write_file('changed-ifcfg-eth0', 'DEVICE=eth1\n')
+
+        def key(local_path):
+            return build_cache.cache_key(
+                ['centos-7.0', '--upload', local_path + ':/etc/ifcfg-eth0'])
+
+        self.assertEqual(key(first), key(same))
+        self.assertNotEqual(key(first), key(changed))
+        self.assertIsNone(key(path.join(self.work_dir, 'missing')))
+
+    def test_cache_key_hashes_selector_files(self):
+        first = self._write_file('key.pub', 'ssh-rsa AAAA\n')
+        changed = self._write_file('changed-key.pub', 'ssh-rsa BBBB\n')
+
+        for option, template in [('--root-password', 'file:%s'),
+                                 ('--root-password', 'locked:file:%s'),
+                                 ('--password', 'joe:file:%s'),
+                                 ('--ssh-inject', 'root:file:%s'),
+                                 ('--sm-credentials', 'joe:file:%s')]:
+            def key(local_path):
+                return build_cache.cache_key(
+                    ['centos-7.0', option, template % local_path])
+
+            self.assertEqual(key(first), key(first))
+            self.assertNotEqual(key(first), key(changed))
+            self.assertIsNone(key(path.join(self.work_dir, 'missing')))
+
+        self.assertIsNotNone(build_cache.cache_key(
+            ['centos-7.0', '--root-password', 'password:file:x']))
+        self.assertIsNotNone(build_cache.cache_key(
+            ['centos-7.0', '--ssh-inject', 'root:string:ssh-rsa AAAA']))
+
+    def test_cache_key_not_reusable(self):
+        self.assertIsNone(build_cache.cache_key(
+            ['centos-7.0', '--root-password', 'random']))
+        self.assertIsNone(build_cache.cache_key(
+            ['centos-7.0', '--password', 'joe:locked:random']))
+        self.assertIsNone(build_cache.cache_key(
+            ['centos-7.0', '--ssh-inject', 'root']))
+
+    def test_cache_key_hashes_commands_from_file(self):
+        ifcfg = self._write_file('ifcfg-eth0', 'DEVICE=eth0\n')
+        commands = self._write_file('commands', (
+            '# comment\n'
+            '\n'
+            'upload %s:/etc/ifcfg-eth0\n'
+            'run-command echo \\\n'
+            '  hello\n'
+            'selinux-relabel\n' % ifcfg))
+        key = build_cache.cache_key(
+            ['centos-7.0', '--commands-from-file', commands])
+
+        self.assertEqual(
+            ['--upload', ifcfg + ':/etc/ifcfg-eth0',
+             '--run-command', 'echo hello', '--selinux-relabel'],
+            build_cache._read_commands_file(commands))
+        self._write_file('ifcfg-eth0', 'DEVICE=eth1\n')
+        self.assertNotEqual(key, build_cache.cache_key(
+            ['centos-7.0', '--commands-from-file', commands]))
+        self.assertIsNone(build_cache.cache_key(
+            ['centos-7.0', '--commands-from-file',
+             path.join(self.work_dir, 'missing')]))
+
+    def test_build_miss_then_hit(self):
+        first_output = path.join(self.work_dir, 'first.img')
+        second_output = path.join(self.work_dir, 'second.img')
+
+        self.assertEqual(0, self.cache.build(
+            ['centos-7.0', '-o', first_output], self._build_image))
+        self.assertEqual(0, self.cache.build(
+            ['centos-7.0', '-o', second_output], self._build_image))
+
+        self.assertEqual(1, len(self.builds))
+        self.assertEqual('-o', self.builds[0][0])
+        self.assertEqual(1, len(self._cached_images()))
+        with open(second_output) as f:
+            self.assertEqual("image built from ['centos-7.0']", f.read())
+
+    def test_build_failure_is_not_cached(self):
+        output = path.join(self.work_dir, 'out.img')
+
+        exit_code = self.cache.build(['centos-7.0', '-o', output],
+                                     lambda args: 1)
+
+        self.assertEqual(1, exit_code)
+        self.assertEqual([], [f for f in os.listdir(self.cache_dir)
+                              if not f.endswith('.lock')])
+        self.assertFalse(path.exists(output))
+
+    def test_build_without_output_is_not_cached(self):
+        build_image = mock.Mock(return_value=0)
+        self.cache.build(['centos-7.0'], build_image)
+        build_image.assert_called_once_with(['centos-7.0'])
+
+    @mock.patch('subprocess.check_call')
+    def test_build_qcow2_creates_overlay(self, check_call):
+        # qemu of the system libvirt must be able to open the backing file
+        os.chmod(self.work_dir, 0o755)
+        os.chmod(self.cache_dir, 0o755)
+        output = path.join(self.work_dir, 'out.qcow2')
+        self.cache.build(['centos-7.0', '--format', 'qcow2', '-o', output],
+                         self._build_image)
+
+        image_path = path.join(self.cache_dir, self._cached_images()[0])
+        check_call.assert_called_once_with(
+            ['qemu-img', 'create', '-q', '-f', 'qcow2', '-F', 'qcow2',
+             '-b', image_path, output])
+        meta_path = image_path[:-len(build_cache.IMAGE_SUFFIX)] + '.json'
+        with open(meta_path) as f:
+            self.assertEqual([output], json.load(f)['overlays'])
+
+    @mock.patch('subprocess.check_call')
+    def test_build_qcow2_private_cache_copies(self, check_call):
+        check_call.side_effect = lambda args: shutil.copy(args[-2], args[-1])
+        os.chmod(self.cache_dir, 0o700)
+        output = path.join(self.work_dir, 'out.qcow2')
+        self.cache.build(['centos-7.0', '--format', 'qcow2', '-o', output],
+                         self._build_image)
+
+        image_path = path.join(self.cache_dir, self._cached_images()[0])
+        check_call.assert_called_once_with(
+            ['cp', '--reflink=auto', image_path, output])
+        self.assertEqual(0o644, os.stat(output).st_mode & 0o777)
+
+    def test_cache_dir_from_env(self):
+        cache_dir = path.join(self.work_dir, 'pool', 'rejviz')
+        with mock.patch.dict(os.environ, {build_cache.DIR_ENV: cache_dir}):
+            self.assertEqual(cache_dir, build_cache.BuildCache().cache_dir)
+        self.assertTrue(path.isdir(cache_dir))
+
+    def _write_overlay(self, overlay_path, backing_path):
+        backing = backing_path.encode('utf-8')
+        header = (inspection_cache.QCOW2_MAGIC +
+                  struct.pack('>IQI', 3, 512, len(backing)))
+        with open(overlay_path, 'wb') as f:
+            f.write(header + b'\0' * (512 - len(header)) + backing)
+
+    def test_evict_keeps_images_backing_overlays(self):
+        os.chmod(self.work_dir, 0o755)
+        os.chmod(self.cache_dir, 0o755)
+        self.cache.max_bytes = 0
+        with mock.patch('subprocess.check_call') as check_call:
+            check_call.side_effect = lambda args: self._write_overlay(
+                args[-1], args[-2])
+            self.cache.build(['centos-7.0', '--format', 'qcow2',
+                              '-o', path.join(self.work_dir, 'vm.qcow2')],
+                             self._build_image)
+        self.cache.build(['fedora-21', '-o',
+                          path.join(self.work_dir, 'vm.img')],
+                         self._build_image)
+
+        # only the image backing vm.qcow2 is left
+        self.assertEqual(1, len(self._cached_images()))
+
+        os.unlink(path.join(self.work_dir, 'vm.qcow2'))
+        self.cache.evict()
+        self.assertEqual([], self._cached_images())
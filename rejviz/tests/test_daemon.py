@@ -0,0 +1,138 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License. You may
+# obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+import json
+import os
+from os import path
+import shutil
+import socket
+import tempfile
+import threading
+
+import mock
+
+from rejviz import daemon
+import rejviz.tests.utils as tutils
+
+
+class DaemonTest(tutils.TestCase):
+
+    def setUp(self):
+        super(DaemonTest, self).setUp()
+        self.run_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.run_dir)
+        self.sock_path = path.join(self.run_dir, 'rejviz',
+                                   daemon.SOCKET_NAME)
+        environ_patcher = mock.patch.dict(
+            os.environ, {daemon.SOCKET_ENV: self.sock_path})
+        environ_patcher.start()
+        self.addCleanup(environ_patcher.stop)
+
+    def _start_server(self, methods):
+        server = daemon.listen(self.sock_path, methods)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.start()
+
+        def stop():
+            server.shutdown()
+            server_thread.join()
+            server.server_close()
+        self.addCleanup(stop)
+        return server
+
+    def _fail(self):
+        raise ValueError('bad NIC')
+
+    def test_call(self):
+        self._start_server({'echo': lambda **params: params,
+                            'fail': self._fail})
+
+        self.assertEqual({'args': ['--nic', 'name=eth0']},
+                         daemon.call('echo', args=['--nic', 'name=eth0']))
+        error = self.assertRaises(ValueError, daemon.call, 'fail')
+        self.assertEqual('bad NIC', str(error))
+        error = self.assertRaises(ValueError, daemon.call, 'unknown')
+        self.assertIn('Bad request', str(error))
+        self.assertEqual(0o600, os.stat(self.sock_path).st_mode & 0o777)
+
+    def test_call_unavailable(self):
+        self.assertRaises(daemon.DaemonUnavailable, daemon.call, 'echo')
+
+        with mock.patch.dict(os.environ, {daemon.SOCKET_ENV: ''}):
+            self.assertIsNone(daemon.socket_path())
+            self.assertRaises(daemon.DaemonUnavailable, daemon.call, 'echo')
+
+    def test_stale_socket(self):
+        os.mkdir(path.dirname(self.sock_path), 0o700)
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.sock_path)
+        stale.close()
+
+        self.assertRaises(daemon.DaemonUnavailable, daemon.call, 'echo')
+
+        self._start_server({'echo': lambda: 'ok'})
+        self.assertEqual('ok', daemon.call('echo'))
+
+    def test_socket_dir_not_private(self):
+        os.mkdir(path.dirname(self.sock_path), 0o700)
+        daemon.listen(self.sock_path, {})
+        os.chmod(path.dirname(self.sock_path), 0o755)
+
+        self.assertRaises(daemon.DaemonUnavailable, daemon.call, 'echo')
+        self.assertRaises(RuntimeError, daemon.listen, self.sock_path, {})
+
+    def test_socket_dir_symlink(self):
+        os.mkdir(path.join(self.run_dir, 'real'), 0o700)
+        os.symlink(path.join(self.run_dir, 'real'),
+                   path.dirname(self.sock_path))
+
+        self.assertRaises(RuntimeError, daemon.listen, self.sock_path, {})
+
+    def test_not_a_socket(self):
+        os.mkdir(path.dirname(self.sock_path), 0o700)
+        open(self.sock_path, 'w').close()
+
+        self.assertRaises(daemon.DaemonUnavailable, daemon.call, 'echo')
+
+    def test_daemon_of_other_user(self):
+        self._start_server({'echo': lambda: 'ok'})
+
+        with mock.patch('rejviz.daemon._peer_uid',
+                        return_value=os.getuid() + 1):
+            self.assertRaises(daemon.DaemonUnavailable, daemon.call, 'echo')
+
+    @mock.patch('rejviz.daemon._peer_uid')
+    def test_client_of_other_user(self, peer_uid):
+        self._start_server({'echo': lambda: 'ok'})
+        peer_uid.return_value = os.getuid() + 1
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(client.close)
+        client.connect(self.sock_path)
+        client.sendall(b'{"method": "echo"}\n')
+        client.shutdown(socket.SHUT_WR)
+
+        response = json.loads(client.makefile('rb').read().decode('utf-8'))
+        self.assertEqual('Permission denied', response['error']['message'])
+
+    def test_listen_already_running(self):
+        self._start_server({})
+        self.assertRaises(RuntimeError, daemon.listen, self.sock_path, {})
+
+    def test_server_close_removes_socket(self):
+        daemon.listen(self.sock_path, {}).server_close()
+        self.assertFalse(path.exists(self.sock_path))
+
+    def test_socket_path_default(self):
+        with mock.patch.dict(os.environ, {'XDG_RUNTIME_DIR': '/run/user/1'}):
+            os.environ.pop(daemon.SOCKET_ENV)
+            self.assertEqual('/run/user/1/rejviz/rejvizd.sock',
+                             daemon.socket_path())
@@ -0,0 +1,520 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License. You may
+# obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+import io
+import subprocess
+import tarfile
+
+import mock
+
+from rejviz import inspection
+import rejviz.tests.utils as tutils
+
+
+NICS_SCRIPT = u'''aug-init / 0
+echo @name
+echo eth0
+echo @type
+-aug-get /files/etc/sysconfig/network-scripts/ifcfg-eth0/TYPE
+echo @hwaddr
+-aug-get /files/etc/sysconfig/network-scripts/ifcfg-eth0/HWADDR
+echo @bootproto
+-aug-get /files/etc/sysconfig/network-scripts/ifcfg-eth0/BOOTPROTO
+echo @ipaddr
+-aug-get /files/etc/sysconfig/network-scripts/ifcfg-eth0/IPADDR
+echo @network
+-aug-get /files/etc/sysconfig/network-scripts/ifcfg-eth0/NETWORK
+echo @netmask
+-aug-get /files/etc/sysconfig/network-scripts/ifcfg-eth0/NETMASK
+echo @-----
+echo @name
+echo eth1
+echo @type
+-aug-get /files/etc/sysconfig/network-scripts/ifcfg-eth1/TYPE
+echo @hwaddr
+-aug-get /files/etc/sysconfig/network-scripts/ifcfg-eth1/HWADDR
+echo @bootproto
+-aug-get /files/etc/sysconfig/network-scripts/ifcfg-eth1/BOOTPROTO
+echo @ipaddr
+-aug-get /files/etc/sysconfig/network-scripts/ifcfg-eth1/IPADDR
+echo @network
+-aug-get /files/etc/sysconfig/network-scripts/ifcfg-eth1/NETWORK
+echo @netmask
+-aug-get /files/etc/sysconfig/network-scripts/ifcfg-eth1/NETMASK
+echo @-----
+echo @name
+echo lo
+echo @type
+-aug-get /files/etc/sysconfig/network-scripts/ifcfg-lo/TYPE
+echo @hwaddr
+-aug-get /files/etc/sysconfig/network-scripts/ifcfg-lo/HWADDR
+echo @bootproto
+-aug-get /files/etc/sysconfig/network-scripts/ifcfg-lo/BOOTPROTO
+echo @ipaddr
+-aug-get /files/etc/sysconfig/network-scripts/ifcfg-lo/IPADDR
+echo @network
+-aug-get /files/etc/sysconfig/network-scripts/ifcfg-lo/NETWORK
+echo @netmask
+-aug-get /files/etc/sysconfig/network-scripts/ifcfg-lo/NETMASK
+echo @-----
+'''
+
+
+NICS_OUTPUT = u'''@name
+eth0
+@type
+Ethernet
+@hwaddr
+52:54:00:12:34:56
+@bootproto
+dhcp
+@network
+@netmask
+@-----
+@name
+eth1
+@type
+Ethernet
+@hwaddr
+52:54:00:12:34:78
+@bootproto
+static
+@network
+192.168.123.0
+@netmask
+255.255.255.0
+@-----
+@name
+loopback
+@type
+@hwaddr
+@bootproto
+@network
+127.0.0.0
+@netmask
+255.0.0.0
+@-----
+'''
+
+
+IFCFG_ETH0 = b'''# Generated by rejviz
+HWADDR=52:54:00:12:34:56
+TYPE=Ethernet
+BOOTPROTO="dhcp"
+NAME=eth0
+'''
+
+IFCFG_ETH1 = b'''TYPE='Ethernet'
+HWADDR=52:54:00:12:34:78
+BOOTPROTO=static
+IPADDR=192.168.123.10
+NETWORK=192.168.123.0  # trailing comment
+NETMASK=255.255.255.0
+'''
+
+
+def make_tarball(files):
+    tar_data = io.BytesIO()
+    with tarfile.open(fileobj=tar_data, mode='w') as tar:
+        for name, contents in files:
+            info = tarfile.TarInfo(name)
+            info.size = len(contents)
+            tar.addfile(info, io.BytesIO(contents))
+    return tar_data.getvalue()
+
+
+class InspectionTest(tutils.TestCase):
+
+    @mock.patch('rejviz.inspection._fetch_nics_legacy')
+    @mock.patch('rejviz.inspection._fetch_nics_raw')
+    def test_fetch_nics(self, fetch_raw, fetch_legacy):
+        fetch_raw.return_value = iter([{'name': 'eth1'}, {'name': 'eth0'}])
+
+        nics = inspection.fetch_nics(['-a', '/image'])
+
+        fetch_raw.assert_called_with(['-a', '/image'])
+        self.assertEqual([{'name': 'eth0'}, {'name': 'eth1'}], nics)
+        self.assertEqual([], fetch_legacy.mock_calls)
+
+    @mock.patch('rejviz.inspection._fetch_nics_legacy')
+    @mock.patch('rejviz.inspection._fetch_nics_in_session')
+    def test_fetch_nics_augeas(self, fetch_in_session, fetch_legacy):
+        fetch_in_session.return_value = [{'name': 'eth0'}]
+
+        nics = inspection.fetch_nics(['-a', '/image'], mode='augeas')
+
+        fetch_in_session.assert_called_with(['-a', '/image'])
+        self.assertEqual([{'name': 'eth0'}], nics)
+        self.assertEqual([], fetch_legacy.mock_calls)
+
+    def test_fetch_nics_bad_mode(self):
+        self.assertRaises(ValueError, inspection.fetch_nics,
+                          ['-a', '/image'], mode='psychic')
+
+    @mock.patch('rejviz.inspection._fetch_nics_legacy')
+    @mock.patch('rejviz.inspection._fetch_nics_raw',
+                side_effect=RuntimeError('appliance failed'))
+    def test_fetch_nics_fallback(self, fetch_raw, fetch_legacy):
+        fetch_legacy.return_value = [{'name': 'eth0'}]
+
+        nics = inspection.fetch_nics(['-a', '/image'])
+
+        fetch_legacy.assert_called_with(['-a', '/image'])
+        self.assertEqual([{'name': 'eth0'}], nics)
+
+    @mock.patch('rejviz.inspection._fetch_nics_legacy')
+    @mock.patch('rejviz.inspection._fetch_nics_raw')
+    def test_iter_nics_is_incremental(self, fetch_raw, fetch_legacy):
+        def fetch(image_args):
+            yield {'name': 'eth0'}
+            raise AssertionError('read past the first NIC')
+        fetch_raw.side_effect = fetch
+
+        nics = inspection.iter_nics(['-a', '/image'])
+
+        self.assertEqual({'name': 'eth0'}, next(nics))
+        nics.close()
+
+    @mock.patch('rejviz.inspection._fetch_nics_legacy')
+    @mock.patch('rejviz.inspection._fetch_nics_raw')
+    def test_iter_nics_fallback_after_some_nics(self, fetch_raw,
+                                                fetch_legacy):
+        def fetch(image_args):
+            yield {'name': 'eth0'}
+            raise subprocess.CalledProcessError(1, ['guestfish'])
+        fetch_raw.side_effect = fetch
+        fetch_legacy.return_value = [{'name': 'eth0'}, {'name': 'eth1'}]
+
+        self.assertEqual([{'name': 'eth0'}, {'name': 'eth1'}],
+                         list(inspection.iter_nics(['-a', '/image'])))
+
+    @mock.patch('rejviz.inspection.guestfs', new=None)
+    @mock.patch('subprocess.Popen')
+    def test_fetch_nics_raw_guestfish(self, popen):
+        tarball = make_tarball([
+            ('./ifcfg-eth1', IFCFG_ETH1),
+            ('./ifup-eth0', b'#!/bin/sh'),
+            ('./ifcfg-eth0', IFCFG_ETH0),
+        ])
+        stdout = io.BytesIO(tarball)
+        stdout.close = mock.Mock()
+        popen.return_value.stdout = stdout
+        popen.return_value.wait.return_value = 0
+
+        nics = list(inspection._fetch_nics_raw(['-a', '/image']))
+
+        # the whole archive including padding is read before closing
+        self.assertEqual(len(tarball), stdout.tell())
+        stdout.close.assert_called_with()
+
+        popen.assert_called_with(
+            ['guestfish', '-i', '--ro', '-a', '/image',
+             'tar-out', '/etc/sysconfig/network-scripts', '-'],
+            stdout=subprocess.PIPE)
+        # in archive order, fetch_nics sorts them
+        self.assertEqual(
+            [
+                {'name': 'eth1', 'type': 'Ethernet',
+                 'hwaddr': '52:54:00:12:34:78', 'bootproto': 'static',
+                 'ipaddr': '192.168.123.10', 'network': '192.168.123.0',
+                 'netmask': '255.255.255.0'},
+                {'name': 'eth0', 'type': 'Ethernet',
+                 'hwaddr': '52:54:00:12:34:56', 'bootproto': 'dhcp',
+                 'ipaddr': None, 'network': None, 'netmask': None},
+            ],
+            nics)
+
+    @mock.patch('rejviz.inspection.guestfs', new=None)
+    @mock.patch('subprocess.Popen')
+    def test_fetch_nics_raw_guestfish_failed(self, popen):
+        popen.return_value.stdout = io.BytesIO(make_tarball([]))
+        popen.return_value.wait.return_value = 1
+
+        self.assertRaises(subprocess.CalledProcessError, list,
+                          inspection._fetch_nics_raw(['-a', '/image']))
+
+    @mock.patch('rejviz.inspection.guestfs')
+    def test_fetch_nics_raw_guestfs(self, guestfs):
+        handle = guestfs.GuestFS.return_value
+        handle.inspect_os.return_value = ['/dev/sda1']
+        handle.inspect_get_mountpoints.return_value = {'/': '/dev/sda1'}
+
+        def tar_out(directory, local_path):
+            with open(local_path, 'wb') as f:
+                f.write(make_tarball([('./ifcfg-eth0', IFCFG_ETH0)]))
+        handle.tar_out.side_effect = tar_out
+
+        nics = list(inspection._fetch_nics_raw(['-a', '/image']))
+
+        self.assertEqual(['eth0'], [n['name'] for n in nics])
+        self.assertEqual(1, len(handle.launch.mock_calls))
+        handle.close.assert_called_with()
+
+    def test_parse_ifcfg(self):
+        self.assertEqual(
+            {'TYPE': 'Ethernet', 'HWADDR': '52:54:00:12:34:78',
+             'BOOTPROTO': 'static', 'IPADDR': '192.168.123.10',
+             'NETWORK': '192.168.123.0',
+             'NETMASK': '255.255.255.0'},
+            inspection.parse_ifcfg(IFCFG_ETH1.decode('utf-8')))
+        self.assertEqual(
+            {'NAME': 'System eth0'},
+            inspection.parse_ifcfg('NAME="System eth0"\nBROKEN="\n'))
+
+    @mock.patch('rejviz.inspection.guestfs')
+    def test_fetch_nics_guestfs(self, guestfs):
+        handle = guestfs.GuestFS.return_value
+        handle.inspect_os.return_value = ['/dev/sda1']
+        handle.inspect_get_mountpoints.return_value = {
+            '/boot': '/dev/sda2', '/': '/dev/sda1'}
+        handle.ls.return_value = ['ifcfg-eth0', 'ifup-eth0']
+        values = {'TYPE': 'Ethernet', 'HWADDR': '52:54:00:12:34:56',
+                  'BOOTPROTO': 'dhcp'}
+
+        def aug_get(aug_path):
+            key = aug_path.rsplit('/', 1)[1]
+            if key not in values:
+                raise RuntimeError('no matching node')
+            return values[key]
+        handle.aug_get.side_effect = aug_get
+
+        nics = inspection._fetch_nics_guestfs(['-a', '/image'])
+
+        self.assertEqual(
+            [{'name': 'eth0', 'type': 'Ethernet',
+              'hwaddr': '52:54:00:12:34:56', 'bootproto': 'dhcp',
+              'ipaddr': None, 'network': None, 'netmask': None}],
+            nics)
+        handle.add_drive_opts.assert_called_with('/image', readonly=1)
+        self.assertEqual([mock.call('/dev/sda1', '/'),
+                          mock.call('/dev/sda2', '/boot')],
+                         handle.mount_ro.mock_calls)
+        self.assertEqual(1, len(handle.launch.mock_calls))
+        handle.close.assert_called_with()
+
+    @mock.patch('rejviz.inspection.guestfs')
+    def test_fetch_nics_guestfs_no_os(self, guestfs):
+        handle = guestfs.GuestFS.return_value
+        handle.inspect_os.return_value = []
+
+        self.assertRaises(RuntimeError,
+                          inspection._fetch_nics_guestfs, ['-a', '/image'])
+        handle.close.assert_called_with()
+
+    @mock.patch('subprocess.call')
+    @mock.patch('subprocess.Popen')
+    @mock.patch('subprocess.check_output')
+    def test_fetch_nics_guestfish(self, check_output, popen, call):
+        check_output.side_effect = [
+            'GUESTFISH_PID=4513; export GUESTFISH_PID\n',
+            'ifcfg-eth0\nifcfg-eth1\nifcfg-lo\nifup-eth0\n',
+        ]
+        popen.return_value.stdout = io.StringIO(NICS_OUTPUT)
+
+        nics = list(inspection._fetch_nics_guestfish(['-a', '/image']))
+
+        self.assertEqual([
+            mock.call(['guestfish', '--listen', '-i', '--ro', '-a', '/image'],
+                      universal_newlines=True),
+            mock.call(['guestfish', '--remote=4513', 'ls',
+                       '/etc/sysconfig/network-scripts'],
+                      universal_newlines=True),
+        ], check_output.mock_calls)
+        popen.return_value.stdin.write.assert_called_with(NICS_SCRIPT)
+        call.assert_called_with(['guestfish', '--remote=4513', 'exit'])
+        self.assertEqual(['eth0', 'eth1', 'loopback'],
+                         [n['name'] for n in nics])
+
+    @mock.patch('subprocess.call')
+    @mock.patch('subprocess.Popen', side_effect=OSError('boom'))
+    @mock.patch('subprocess.check_output')
+    def test_fetch_nics_guestfish_exits_session(self, check_output, popen,
+                                                call):
+        check_output.side_effect = [
+            'GUESTFISH_PID=4513; export GUESTFISH_PID\n',
+            'ifcfg-eth0\n',
+        ]
+
+        self.assertRaises(OSError, list,
+                          inspection._fetch_nics_guestfish(['-a', '/image']))
+        call.assert_called_with(['guestfish', '--remote=4513', 'exit'])
+
+    def test_parse_guestfish_pid(self):
+        self.assertEqual('4513', inspection._parse_guestfish_pid(
+            'GUESTFISH_PID=4513; export GUESTFISH_PID\n'))
+        self.assertRaises(RuntimeError,
+                          inspection._parse_guestfish_pid, 'error')
+
+    @mock.patch('subprocess.Popen')
+    @mock.patch('rejviz.inspection._get_nic_names_from_image')
+    def test_fetch_nics_legacy(self, get_nic_names, popen):
+        # setup
+        popen.return_value.stdout = io.StringIO(NICS_OUTPUT)
+        get_nic_names.return_value = ['eth0', 'eth1', 'lo']
+
+        # test
+        nics = list(inspection._fetch_nics_legacy(['-a', '/image']))
+        popen.assert_called_with(
+            ['guestfish', '-i', '--ro', '-a', '/image'], stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, stderr=mock.ANY, universal_newlines=True)
+        popen.return_value.stdin.write.assert_called_with(NICS_SCRIPT)
+        get_nic_names.assert_called_with(['-a', '/image'])
+        self.assertEqual(3, len(nics))
+        self.assertEqual(['eth0', 'eth1', 'loopback'],
+                         [n['name'] for n in nics])
+
+    @mock.patch('subprocess.check_output')
+    def test_get_nic_names_from_image(self, check_output):
+        check_output.return_value = (
+            'ifcfg-eth0\n'
+            'ifcfg-eth1\n'
+            'ifdown-eth0\n'
+            'ifdown-eth1\n'
+            'ifup-eth0\n'
+            'ifup-eth1\n')
+
+        self.assertEqual(
+            ['eth0', 'eth1'],
+            inspection._get_nic_names_from_image(['-a', '/image']))
+        check_output.assert_called_with(
+            ['virt-ls', '-a', '/image',
+             '/etc/sysconfig/network-scripts'], universal_newlines=True)
+
+    def test_parse_nics_output(self):
+        self.assertEqual(
+            [
+                {'name': 'eth0', 'type': 'Ethernet',
+                 'hwaddr': '52:54:00:12:34:56', 'bootproto': 'dhcp',
+                 'network': None, 'netmask': None},
+                {'name': 'eth1', 'type': 'Ethernet',
+                 'hwaddr': '52:54:00:12:34:78', 'bootproto': 'static',
+                 'network': '192.168.123.0', 'netmask': '255.255.255.0'},
+                {'name': 'loopback', 'type': None,
+                 'hwaddr': None, 'bootproto': None,
+                 'network': '127.0.0.0', 'netmask': '255.0.0.0'},
+            ],
+            inspection.parse_nics_output(NICS_OUTPUT)
+        )
+
+    def test_iter_nics_output_is_incremental(self):
+        def lines():
+            yield '@name'
+            yield 'eth0'
+            yield '@type'
+            yield '@-----'
+            raise AssertionError('read past the first NIC')
+
+        nics = inspection.iter_nics_output(lines())
+        self.assertEqual({'name': 'eth0', 'type': None}, next(nics))
+
+    def _shared_handle(self, guestfs, roots, tarballs):
+        # drive N is /dev/sdX, LVM volume groups are named after drives
+        handle = guestfs.GuestFS.return_value
+        handle.inspect_os.return_value = roots
+        handle.is_lv.side_effect = lambda device: device.startswith('/dev/vg')
+        handle.lvm_canonical_lv_name.side_effect = lambda device: device
+        handle.vgpvuuids.side_effect = lambda vg: ['uuid-' + vg[3:]]
+        handle.pvs.return_value = ['/dev/sda2', '/dev/sdb2']
+        handle.pvuuid.side_effect = lambda pv: 'uuid-' + pv[5:8]
+        handle.part_to_dev.side_effect = lambda device: device[:8]
+        handle.device_index.side_effect = lambda device: \
+            ord(device[7]) - ord('a')
+        handle.inspect_get_mountpoints.side_effect = lambda root: \
+            {'/': root}
+        mounted = []
+        handle.mount_ro.side_effect = lambda device, mp: mounted.append(
+            device)
+
+        def tar_out(directory, local_path):
+            with open(local_path, 'wb') as f:
+                f.write(make_tarball(tarballs[mounted[-1]]))
+        handle.tar_out.side_effect = tar_out
+        return handle
+
+    @mock.patch('rejviz.inspection.fetch_nics')
+    @mock.patch('rejviz.inspection.guestfs')
+    def test_fetch_nics_multi(self, guestfs, fetch_nics):
+        handle = self._shared_handle(
+            guestfs, ['/dev/sda1', '/dev/vg-sdb/root'],
+            {'/dev/sda1': [('./ifcfg-eth0', IFCFG_ETH0)],
+             '/dev/vg-sdb/root': [('./ifcfg-eth1', IFCFG_ETH1)]})
+        fetch_nics.return_value = [{'name': 'eth9'}]
+
+        results = inspection.fetch_nics_multi(
+            [['-a', '/a.img'], ['-a', '/b.img'], ['-a', '/c.img'],
+             ['-d', 'domain']])
+
+        self.assertEqual([['eth0'], ['eth1']],
+                         [[n['name'] for n in nics] for nics in results[:2]])
+        # no root found on /c.img, and domains aren't shared
+        self.assertEqual([[{'name': 'eth9'}]] * 2, results[2:])
+        fetch_nics.assert_has_calls([mock.call(['-a', '/c.img']),
+                                     mock.call(['-d', 'domain'])])
+        self.assertEqual(1, len(handle.launch.mock_calls))
+        self.assertEqual(3, len(handle.add_drive_opts.mock_calls))
+        handle.close.assert_called_with()
+
+    @mock.patch('rejviz.inspection.fetch_nics')
+    @mock.patch('rejviz.inspection.guestfs')
+    def test_fetch_nics_multi_chunks(self, guestfs, fetch_nics):
+        handle = self._shared_handle(guestfs, ['/dev/sda1'],
+                                     {'/dev/sda1': []})
+        fetch_nics.side_effect = RuntimeError('broken image')
+
+        results = inspection.fetch_nics_multi(
+            [['-a', '/%d.img' % i] for i in range(3)], max_drives=2)
+
+        self.assertEqual(2, len(handle.launch.mock_calls))
+        self.assertEqual([], results[0])
+        self.assertIsInstance(results[1], RuntimeError)
+        self.assertEqual([], results[2])
+
+    @mock.patch('rejviz.inspection.fetch_nics', return_value=[])
+    @mock.patch('rejviz.inspection.guestfs')
+    def test_fetch_nics_multi_launch_failed(self, guestfs, fetch_nics):
+        guestfs.GuestFS.return_value.launch.side_effect = RuntimeError(
+            'no KVM')
+
+        results = inspection.fetch_nics_multi([['-a', '/a.img'],
+                                               ['-a', '/b.img']])
+
+        self.assertEqual([[], []], results)
+        self.assertEqual(2, fetch_nics.call_count)
+
+    @mock.patch('subprocess.call')
+    @mock.patch('subprocess.check_output')
+    def test_guestfish_session(self, check_output, call):
+        outputs = {
+            'run': '',
+            'inspect-os': '/dev/sda1\n/dev/sdb1\n',
+            'inspect-get-mountpoints': '/: /dev/sda1\n/boot: /dev/sda2\n',
+            'is-lv': 'false\n',
+            'device-index': '1\n',
+        }
+        check_output.side_effect = lambda command, **kwargs: \
+            'GUESTFISH_PID=4242; export GUESTFISH_PID\n' \
+            if '--listen' in command else outputs[command[2]]
+
+        session = inspection.GuestfishSession(['/a.img', '/b.img'])
+
+        check_output.assert_any_call(
+            ['guestfish', '--listen', '--ro', '-a', '/a.img', '-a', '/b.img'],
+            universal_newlines=True)
+        self.assertEqual(['/dev/sda1', '/dev/sdb1'], session.inspect_os())
+        self.assertEqual({'/': '/dev/sda1', '/boot': '/dev/sda2'},
+                         session.inspect_get_mountpoints('/dev/sda1'))
+        self.assertFalse(session.is_lv('/dev/sda1'))
+        self.assertEqual(1, session.device_index('/dev/sdb'))
+        check_output.side_effect = subprocess.CalledProcessError(1, 'x')
+        self.assertRaises(RuntimeError, session.mount_ro, '/dev/sda1', '/')
+        session.close()
+        call.assert_called_with(['guestfish', '--remote=4242', 'exit'])
@@ -0,0 +1,130 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License. You may
+# obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+
+import os
+from os import path
+import shutil
+import struct
+import tempfile
+
+from rejviz import inspection_cache
+import rejviz.tests.utils as tutils
+
+
+NICS = [{'name': 'eth0', 'type': 'Ethernet',
+         'hwaddr': '52:54:00:12:34:56', 'bootproto': 'dhcp',
+         'network': None, 'netmask': None}]
+
+
+class InspectionCacheTest(tutils.TestCase):
+
+    def setUp(self):
+        super(InspectionCacheTest, self).setUp()
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir)
+        self.cache_dir = path.join(self.work_dir, 'cache')
+        os.mkdir(self.cache_dir)
+        self.cache = inspection_cache.InspectionCache(self.cache_dir)
+        self.image = self._write_file('image.raw', b'\0' * 1024)
+
+    def _write_file(self, name, contents):
+        file_path = path.join(self.work_dir, name)
+        with open(file_path, 'wb') as f:
+            f.write(contents)
+        return file_path
+
+    def _write_qcow2(self, name, backing_file):
+        backing = backing_file.encode('utf-8')
+        header = (inspection_cache.QCOW2_MAGIC +
+                  struct.pack('>IQI', 3, 512, len(backing)))
+        contents = header + b'\0' * (512 - len(header)) + backing
+        return self._write_file(name, contents)
+
+    def test_get_miss(self):
+        self.assertIsNone(self.cache.get(['-a', self.image]))
+
+    def test_put_get(self):
+        self.cache.put(['-a', self.image], NICS)
+        self.assertEqual(NICS, self.cache.get(['-a', self.image]))
+        self.assertEqual(
+            [], [f for f in os.listdir(self.cache_dir)
+                 if not f.endswith('.json')])
+
+    def test_modes_cached_separately(self):
+        self.cache.put(['-a', self.image], NICS, mode='augeas')
+
+        self.assertIsNone(self.cache.get(['-a', self.image]))
+        self.assertEqual(NICS, self.cache.get(['-a', self.image],
+                                              mode='augeas'))
+
+    def test_image_change_invalidates(self):
+        self.cache.put(['-a', self.image], NICS)
+        with open(self.image, 'ab') as f:
+            f.write(b'more data')
+        self.assertIsNone(self.cache.get(['-a', self.image]))
+
+    def test_backing_file_change_invalidates(self):
+        base = self._write_file('base.raw', b'\0' * 1024)
+        overlay = self._write_qcow2('overlay.qcow2', 'base.raw')
+        self.cache.put(['-a', overlay], NICS)
+        self.assertEqual(NICS, self.cache.get(['-a', overlay]))
+
+        with open(base, 'ab') as f:
+            f.write(b'more data')
+        self.assertIsNone(self.cache.get(['-a', overlay]))
+
+    def test_domain_not_cached(self):
+        self.cache.put(['-d', 'domain'], NICS)
+        self.assertEqual([], os.listdir(self.cache_dir))
+        self.assertIsNone(self.cache.get(['-d', 'domain']))
+
+    def test_missing_image_not_cached(self):
+        missing = path.join(self.work_dir, 'missing.raw')
+        self.cache.put(['-a', missing], NICS)
+        self.assertIsNone(self.cache.get(['-a', missing]))
+
+    def test_corrupt_entry_is_miss(self):
+        self.cache.put(['-a', self.image], NICS)
+        entry_name = os.listdir(self.cache_dir)[0]
+        with open(path.join(self.cache_dir, entry_name), 'w') as f:
+            f.write('{not json')
+        self.assertIsNone(self.cache.get(['-a', self.image]))
+
+    def test_evict_lru(self):
+        cache = inspection_cache.InspectionCache(self.cache_dir,
+                                                 max_entries=2)
+        images = [self._write_file('image%d.raw' % i, b'\0' * i)
+                  for i in range(3)]
+        for i, image in enumerate(images[:2]):
+            cache.put(['-a', image], NICS)
+            # the first image is the least recently used one
+            entry_path = cache._entry_path(
+                inspection_cache._cache_key(['-a', image]))
+            os.utime(entry_path, (1000 + i, 1000 + i))
+
+        cache.put(['-a', images[2]], NICS)
+
+        self.assertEqual(2, len(os.listdir(self.cache_dir)))
+        self.assertIsNone(cache.get(['-a', images[0]]))
+        self.assertEqual(NICS, cache.get(['-a', images[1]]))
+        self.assertEqual(NICS, cache.get(['-a', images[2]]))
+
+    def test_qcow2_backing_file(self):
+        overlay = self._write_qcow2('overlay.qcow2', 'base.qcow2')
+        with open(overlay, 'rb') as f:
+            header = f.read(4096)
+        self.assertEqual(
+            path.join(self.work_dir, 'base.qcow2'),
+            inspection_cache.qcow2_backing_file(overlay, header))
+        self.assertIsNone(
+            inspection_cache.qcow2_backing_file(self.image, b'\0' * 512))
@@ -0,0 +1,114 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License. You may
+# obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+from os import path
+import shutil
+import tempfile
+
+import mock
+
+from rejviz import ipam
+import rejviz.tests.utils as tutils
+
+
+DEFAULT_NETWORK = {
+    'name': 'default',
+    'dhcp': True,
+    'address': '192.168.122.1',
+    'network': '192.168.122.0',
+    'netmask': '255.255.255.0',
+    'dhcp_ranges': [('192.168.122.128', '192.168.122.254')],
+    'dhcp_hosts': ['192.168.122.3'],
+}
+
+
+class AddressAllocatorTest(tutils.TestCase):
+
+    def setUp(self):
+        super(AddressAllocatorTest, self).setUp()
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir)
+        self.allocator = ipam.AddressAllocator(self.work_dir)
+
+    def test_allocate_skips_used(self):
+        self.assertEqual(['192.168.122.2', '192.168.122.4'],
+                         self.allocator.allocate(DEFAULT_NETWORK, 2))
+
+    def _reserved(self):
+        with open(path.join(self.work_dir, 'default')) as f:
+            return [line.strip() for line in f]
+
+    def test_allocations_are_reserved(self):
+        self.allocator.allocate(DEFAULT_NETWORK)
+        self.assertEqual(['192.168.122.4'],
+                         self.allocator.allocate(DEFAULT_NETWORK))
+        self.assertEqual(['192.168.122.2', '192.168.122.4'],
+                         self._reserved())
+
+    def test_release(self):
+        self.allocator.allocate(DEFAULT_NETWORK, 3)
+        self.allocator.release(DEFAULT_NETWORK, ['192.168.122.4'])
+
+        self.assertEqual(['192.168.122.2', '192.168.122.5'],
+                         self._reserved())
+        self.assertEqual(['192.168.122.4'],
+                         self.allocator.allocate(DEFAULT_NETWORK))
+
+    @mock.patch('rejviz.ipam.utils.write_file_atomic')
+    def test_new_reservations_appended(self, write_file_atomic):
+        with open(path.join(self.work_dir, 'default'), 'w') as f:
+            f.write('192.168.122.4\n')
+
+        self.allocator.allocate(DEFAULT_NETWORK, 2)
+
+        self.assertEqual(['192.168.122.4', '192.168.122.2', '192.168.122.5'],
+                         self._reserved())
+        self.assertEqual([], write_file_atomic.mock_calls)
+
+    def test_network_exhausted(self):
+        self.allocator.allocate(DEFAULT_NETWORK, 125)
+        self.assertRaises(RuntimeError,
+                          self.allocator.allocate, DEFAULT_NETWORK)
+
+    def test_network_without_ip(self):
+        self.assertRaises(ValueError, self.allocator.allocate,
+                          {'name': 'bridged', 'network': None,
+                           'netmask': None})
+
+    def test_large_mostly_full_network(self):
+        network = {
+            'name': 'big',
+            'address': '10.0.0.1',
+            'network': '10.0.0.0',
+            'netmask': '255.255.0.0',
+            'dhcp_ranges': [('10.0.0.2', '10.0.255.200')],
+            'dhcp_hosts': [],
+        }
+        self.assertEqual(['10.0.255.201', '10.0.255.202'],
+                         self.allocator.allocate(network, 2))
+
+
+class NetworkBitmapTest(tutils.TestCase):
+
+    def test_add_address_range(self):
+        bitmap = ipam.NetworkBitmap('10.0.0.0', '255.255.255.0')
+        bitmap.add_address_range('10.0.0.3', '10.0.0.20')
+
+        self.assertEqual(list(range(3, 21)),
+                         [i for i in range(256) if i in bitmap])
+
+    def test_addresses_outside_ignored(self):
+        bitmap = ipam.NetworkBitmap('10.0.0.0', '255.255.255.0')
+        bitmap.add_address('10.0.1.1')
+        bitmap.add_address_range('9.255.255.250', '10.0.0.1')
+
+        self.assertEqual([0, 1], [i for i in range(256) if i in bitmap])
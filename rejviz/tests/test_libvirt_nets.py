@@ -10,6 +10,7 @@
 # implied. See the License for the specific language governing
 # permissions and limitations under the License.
 
+import libvirt
 import mock
 
 from rejviz import libvirt_nets
@@ -30,30 +31,45 @@ NETWORK_XMLDESC = """
   <ip address='192.168.122.1' netmask='255.255.255.0'>
     <dhcp>
       <range start='192.168.122.2' end='192.168.122.254'/>
+      <host mac='52:54:00:00:00:01' name='vm1' ip='192.168.122.10'/>
     </dhcp>
   </ip>
 </network>
 """
 
+PREFIX_NETWORK_XML = """
+<network>
+  <name>prefixed</name>
+  <ip family='ipv6' address='2001:db8::1' prefix='64'/>
+  <ip address='10.20.0.1' prefix='16'/>
+</network>
+"""
 
-class LibvirtNetsTest(tutils.TestCase):
+ISOLATED_NETWORK_XML = """
+<network>
+  <name>isolated</name>
+  <ip address='192.168.150.1' netmask='255.255.255.0'/>
+</network>
+"""
 
-    @mock.patch('libvirt.openReadOnly')
-    @mock.patch('rejviz.libvirt_nets._fetch_network_data')
-    def test_get_libvirt_networks(self, _fetch_network_data, openReadOnly):
-        conn = openReadOnly.return_value
-        conn.listAllNetworks.return_value = ['net1', 'net2']
 
+class LibvirtNetsTest(tutils.TestCase):
+
+    @mock.patch('rejviz.libvirt_nets.default_index')
+    def test_get_libvirt_networks(self, default_index):
         networks = libvirt_nets.get_libvirt_networks()
 
-        self.assertEqual([_fetch_network_data.return_value,
-                          _fetch_network_data.return_value],
+        self.assertEqual(default_index.return_value.networks.return_value,
                          networks)
-        openReadOnly.assertCalledWith()
-        conn.listAllNetworks.assertCalledWith()
-        _fetch_network_data.assertCalledWith('net1')
-        _fetch_network_data.assertCalledWith('net2')
-        conn.close.assertCalledWith()
+
+    @mock.patch('rejviz.libvirt_nets.NetworkIndex')
+    def test_default_index_is_shared(self, network_index):
+        self.addCleanup(setattr, libvirt_nets, '_default_index', None)
+        libvirt_nets._default_index = None
+
+        self.assertIs(libvirt_nets.default_index(),
+                      libvirt_nets.default_index())
+        network_index.assert_called_once_with(watch_events=True)
 
     def test_fetch_network_data(self):
         network_object = mock.MagicMock()
@@ -63,15 +79,217 @@ class LibvirtNetsTest(tutils.TestCase):
         network = libvirt_nets._fetch_network_data(network_object)
         self.assertEqual('default', network['name'])
         self.assertEqual(True, network['dhcp'])
+        self.assertEqual('192.168.122.1', network['address'])
         self.assertEqual('192.168.122.0', network['network'])
         self.assertEqual('255.255.255.0', network['netmask'])
+        self.assertEqual([('192.168.122.2', '192.168.122.254')],
+                         network['dhcp_ranges'])
+        self.assertEqual(['192.168.122.10'], network['dhcp_hosts'])
+
+    def test_fetch_network_data_prefix(self):
+        network_object = mock.MagicMock()
+        network_object.name.return_value = 'prefixed'
+        network_object.XMLDesc.return_value = PREFIX_NETWORK_XML
+
+        network = libvirt_nets._fetch_network_data(network_object)
+        self.assertEqual(False, network['dhcp'])
+        self.assertEqual('10.20.0.0', network['network'])
+        self.assertEqual('255.255.0.0', network['netmask'])
+
+    def test_fetch_network_data_no_ip(self):
+        network_object = mock.MagicMock()
+        network_object.name.return_value = 'bridged'
+        network_object.XMLDesc.return_value = \
+            '<network><name>bridged</name></network>'
+
+        network = libvirt_nets._fetch_network_data(network_object)
+        self.assertEqual('bridged', network['name'])
+        self.assertIsNone(network['network'])
 
     def test_gateway_ipaddr_to_network(self):
         # for 192.168.122.0/24
         self.assertEqual(
             '192.168.122.0',
-            libvirt_nets._gateway_ipaddr_to_network('192.168.122.1'))
+            libvirt_nets._gateway_ipaddr_to_network('192.168.122.1',
+                                                    '255.255.255.0'))
         # for 192.168.123.192/26
         self.assertEqual(
             '192.168.123.192',
-            libvirt_nets._gateway_ipaddr_to_network('192.168.123.193'))
+            libvirt_nets._gateway_ipaddr_to_network('192.168.123.193',
+                                                    '255.255.255.192'))
+        # gateway not at the first address
+        self.assertEqual(
+            '10.0.0.0',
+            libvirt_nets._gateway_ipaddr_to_network('10.0.0.254',
+                                                    '255.255.255.0'))
+
+
+class PrefixIndexTest(tutils.TestCase):
+
+    def test_lookup(self):
+        wide = {'name': 'wide', 'network': '10.0.0.0',
+                'netmask': '255.0.0.0'}
+        narrow = {'name': 'narrow', 'network': '10.1.2.0',
+                  'netmask': '255.255.255.0'}
+        index = libvirt_nets.build_prefix_index([
+            wide, narrow,
+            {'name': 'bridged', 'network': None, 'netmask': None}])
+
+        self.assertEqual(narrow, index.lookup('10.1.2.0'))
+        self.assertEqual(narrow, index.lookup('10.1.2.77'))
+        self.assertEqual(wide, index.lookup('10.1.3.1'))
+        self.assertIsNone(index.lookup('192.168.1.1'))
+
+    def test_lookup_many_networks(self):
+        index = libvirt_nets.build_prefix_index([
+            {'name': 'net%d' % i,
+             'network': '10.%d.%d.0' % (i // 256, i % 256),
+             'netmask': '255.255.255.0'}
+            for i in range(5000)])
+
+        self.assertEqual('net4097', index.lookup('10.16.1.200')['name'])
+        self.assertIsNone(index.lookup('10.200.0.1'))
+
+
+def _mock_network(name):
+    network = mock.MagicMock()
+    network.name.return_value = name
+    return network
+
+
+class NetworkIndexTest(tutils.TestCase):
+
+    @mock.patch('libvirt.openReadOnly')
+    @mock.patch('rejviz.libvirt_nets._fetch_network_data')
+    def test_networks_parsed_once(self, _fetch_network_data, openReadOnly):
+        conn = openReadOnly.return_value
+        net1, net2 = _mock_network('net1'), _mock_network('net2')
+        conn.listAllNetworks.return_value = [net1, net2]
+        _fetch_network_data.side_effect = lambda n: {'name': n.name()}
+
+        index = libvirt_nets.NetworkIndex()
+        index.networks()
+        networks = index.networks()
+
+        self.assertEqual([{'name': 'net1'}, {'name': 'net2'}], networks)
+        openReadOnly.assert_called_once_with(None)
+        self.assertEqual([mock.call(net1), mock.call(net2)],
+                         _fetch_network_data.mock_calls)
+
+        index.close()
+        conn.close.assert_called_with()
+
+    @mock.patch('libvirt.openReadOnly', return_value=None)
+    def test_connection_failed(self, openReadOnly):
+        self.assertRaises(RuntimeError, libvirt_nets.NetworkIndex)
+
+    @mock.patch('rejviz.libvirt_nets._start_event_loop')
+    @mock.patch('libvirt.openReadOnly')
+    @mock.patch('rejviz.libvirt_nets._fetch_network_data')
+    def test_lifecycle_events(self, _fetch_network_data, openReadOnly,
+                              _start_event_loop):
+        conn = openReadOnly.return_value
+        net1, net2 = _mock_network('net1'), _mock_network('net2')
+        conn.listAllNetworks.return_value = [net1, net2]
+        conn.networkLookupByName.side_effect = \
+            lambda name: _mock_network(name)
+        _fetch_network_data.side_effect = lambda n: {'name': n.name()}
+
+        index = libvirt_nets.NetworkIndex(watch_events=True)
+        _start_event_loop.assert_called_with()
+        conn.networkEventRegisterAny.assert_called_with(
+            None, libvirt.VIR_NETWORK_EVENT_ID_LIFECYCLE,
+            index._on_lifecycle_event, None)
+
+        index._on_lifecycle_event(
+            conn, net1, libvirt.VIR_NETWORK_EVENT_UNDEFINED, 0, None)
+        index._on_lifecycle_event(
+            conn, _mock_network('net3'), libvirt.VIR_NETWORK_EVENT_DEFINED,
+            0, None)
+        _fetch_network_data.reset_mock()
+
+        self.assertEqual([{'name': 'net2'}, {'name': 'net3'}],
+                         index.networks())
+        # only the newly defined network got parsed
+        self.assertEqual(1, len(_fetch_network_data.mock_calls))
+
+        index.close()
+        conn.networkEventDeregisterAny.assert_called_with(
+            conn.networkEventRegisterAny.return_value)
+
+    @mock.patch('rejviz.libvirt_nets._start_event_loop')
+    @mock.patch('libvirt.openReadOnly')
+    @mock.patch('rejviz.libvirt_nets._fetch_network_data')
+    def test_events_registered_before_listing(
+            self, _fetch_network_data, openReadOnly, _start_event_loop):
+        conn = openReadOnly.return_value
+        conn.listAllNetworks.return_value = []
+
+        libvirt_nets.NetworkIndex(watch_events=True)
+
+        calls = [name for name, _, _ in conn.mock_calls]
+        self.assertLess(calls.index('networkEventRegisterAny'),
+                        calls.index('listAllNetworks'))
+        self.assertLess(calls.index('registerCloseCallback'),
+                        calls.index('listAllNetworks'))
+
+    @mock.patch('rejviz.libvirt_nets._start_event_loop')
+    @mock.patch('libvirt.openReadOnly')
+    @mock.patch('rejviz.libvirt_nets._fetch_network_data')
+    def test_reconnect_after_close(self, _fetch_network_data, openReadOnly,
+                                   _start_event_loop):
+        old_conn, new_conn = mock.MagicMock(), mock.MagicMock()
+        openReadOnly.side_effect = [old_conn, new_conn]
+        old_conn.listAllNetworks.return_value = [_mock_network('net1')]
+        new_conn.listAllNetworks.return_value = [_mock_network('net2')]
+        old_conn.networkEventDeregisterAny.side_effect = \
+            libvirt.libvirtError('connection closed')
+        _fetch_network_data.side_effect = lambda n: {'name': n.name()}
+
+        index = libvirt_nets.NetworkIndex(watch_events=True)
+        old_conn.registerCloseCallback.assert_called_with(
+            index._on_close, None)
+        self.assertEqual([{'name': 'net1'}], index.networks())
+
+        index._on_close(old_conn, 1, None)
+
+        self.assertEqual([{'name': 'net2'}], index.networks())
+        old_conn.close.assert_called_with()
+        new_conn.networkEventRegisterAny.assert_called_with(
+            None, libvirt.VIR_NETWORK_EVENT_ID_LIFECYCLE,
+            index._on_lifecycle_event, None)
+        new_conn.registerCloseCallback.assert_called_with(
+            index._on_close, None)
+        self.assertEqual([{'name': 'net2'}], index.networks())
+        self.assertEqual(2, len(openReadOnly.mock_calls))
+
+
+class NetworkIndexTestDriverTest(tutils.TestCase):
+
+    def setUp(self):
+        super(NetworkIndexTestDriverTest, self).setUp()
+        self.index = libvirt_nets.NetworkIndex('test:///default')
+        self.addCleanup(self.index.close)
+
+    def test_networks(self):
+        networks = self.index.networks()
+
+        self.assertEqual(['default'], [n['name'] for n in networks])
+        self.assertEqual('192.168.122.0', networks[0]['network'])
+        self.assertEqual('255.255.255.0', networks[0]['netmask'])
+
+    def test_defined_and_undefined_network(self):
+        conn = libvirt.open('test:///default')
+        self.addCleanup(conn.close)
+        network = conn.networkDefineXML(ISOLATED_NETWORK_XML)
+
+        self.index._on_lifecycle_event(
+            conn, network, libvirt.VIR_NETWORK_EVENT_DEFINED, 0, None)
+        self.assertEqual(['default', 'isolated'],
+                         [n['name'] for n in self.index.networks()])
+
+        network.undefine()
+        self.index._on_lifecycle_event(
+            conn, network, libvirt.VIR_NETWORK_EVENT_UNDEFINED, 0, None)
+        self.assertEqual(['default'],
+                         [n['name'] for n in self.index.networks()])
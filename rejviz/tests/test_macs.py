@@ -0,0 +1,171 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License. You may
+# obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+
+import multiprocessing
+from os import path
+import shutil
+import tempfile
+import time
+
+import libvirt
+import mock
+from testtools import matchers
+
+from rejviz import macs
+import rejviz.tests.utils as tutils
+
+
+DOMAIN_XMLDESC = """
+<domain type='kvm'>
+  <name>vm1</name>
+  <devices>
+    <interface type='network'>
+      <mac address='52:54:00:00:00:01'/>
+      <source network='default'/>
+    </interface>
+    <interface type='network'>
+      <mac address='52:54:00:00:00:02'/>
+      <source network='default'/>
+    </interface>
+  </devices>
+</domain>
+"""
+
+
+def _allocate_in_process(reservations_path, count, queue):
+    allocator = macs.MacAllocator(reservations_path)
+    with mock.patch('rejviz.macs._libvirt_domain_macs', return_value=set()):
+        queue.put(allocator.allocate(count))
+
+
+class MacAllocatorTest(tutils.TestCase):
+
+    def setUp(self):
+        super(MacAllocatorTest, self).setUp()
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir)
+        self.reservations_path = path.join(self.work_dir, 'reservations')
+
+    def _allocator(self, domain_macs=()):
+        patcher = mock.patch('rejviz.macs._libvirt_domain_macs',
+                             return_value=set(domain_macs))
+        self.domain_macs = patcher.start()
+        self.addCleanup(patcher.stop)
+        return macs.MacAllocator(self.reservations_path)
+
+    def test_allocate_batch(self):
+        allocated = self._allocator().allocate(100)
+
+        self.assertEqual(100, len(set(allocated)))
+        for mac in allocated:
+            self.assertThat(mac, matchers.MatchesRegex(
+                '^52:54:00:[0-9a-f]{2}:[0-9a-f]{2}:[0-9a-f]{2}$'))
+
+    def test_allocations_are_reserved(self):
+        first = self._allocator().allocate(10)
+        with open(self.reservations_path) as f:
+            reserved = [line.split()[0] for line in f]
+        self.assertEqual(sorted(first), reserved)
+
+        second = self._allocator().allocate(10)
+        self.assertEqual(set(), set(first) & set(second))
+
+    def test_expired_reservations_dropped(self):
+        with open(self.reservations_path, 'w') as f:
+            f.write('52:54:00:00:00:01 %d\n' % int(time.time()))
+            f.write('52:54:00:00:00:02 100\n')
+            f.write('garbage\n')
+
+        self._allocator().allocate()
+
+        with open(self.reservations_path) as f:
+            reserved = [line.split()[0] for line in f]
+        self.assertIn('52:54:00:00:00:01', reserved)
+        self.assertNotIn('52:54:00:00:00:02', reserved)
+
+    @mock.patch('rejviz.macs.utils.write_file_atomic')
+    def test_new_reservations_appended(self, write_file_atomic):
+        now = int(time.time())
+        with open(self.reservations_path, 'w') as f:
+            f.write('52:54:00:00:00:01 %d\n' % now)
+
+        allocated = self._allocator().allocate(2)
+
+        with open(self.reservations_path) as f:
+            reserved = [line.split()[0] for line in f]
+        self.assertEqual(['52:54:00:00:00:01'] + sorted(allocated), reserved)
+        self.assertEqual([], write_file_atomic.mock_calls)
+
+    @mock.patch('rejviz.macs.random.randrange', return_value=1)
+    def test_used_addresses_skipped(self, randrange):
+        allocator = self._allocator(domain_macs=['52:54:00:00:00:01'])
+        # random probes always hit the used address, falls back to a scan
+        self.assertEqual('52:54:00:00:00:00', allocator.allocate()[0])
+        self.assertEqual('52:54:00:00:00:02', allocator.allocate()[0])
+
+    def test_domains_listed_for_every_allocation(self):
+        allocator = self._allocator()
+        allocator.allocate()
+        self.domain_macs.return_value = set(['52:54:00:00:00:01'])
+        allocator.allocate()
+
+        self.assertEqual(2, len(self.domain_macs.mock_calls))
+
+    def test_concurrent_processes(self):
+        queue = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(
+                target=_allocate_in_process,
+                args=(self.reservations_path, 50, queue))
+            for _ in range(4)]
+        for process in processes:
+            process.start()
+        allocated = []
+        for _ in processes:
+            allocated.extend(queue.get(timeout=30))
+        for process in processes:
+            process.join()
+
+        self.assertEqual(200, len(set(allocated)))
+        with open(self.reservations_path) as f:
+            self.assertEqual(200, len(f.readlines()))
+
+    @mock.patch('libvirt.openReadOnly')
+    def test_libvirt_domain_macs(self, openReadOnly):
+        domain = mock.MagicMock()
+        domain.XMLDesc.return_value = DOMAIN_XMLDESC
+        openReadOnly.return_value.listAllDomains.return_value = [domain]
+
+        self.assertEqual({'52:54:00:00:00:01', '52:54:00:00:00:02'},
+                         macs._libvirt_domain_macs())
+        openReadOnly.return_value.close.assert_called_with()
+
+    @mock.patch('libvirt.openReadOnly',
+                side_effect=libvirt.libvirtError('no libvirtd'))
+    def test_libvirt_domain_macs_unavailable(self, openReadOnly):
+        self.assertEqual(set(), macs._libvirt_domain_macs())
+
+
+class MacBitmapTest(tutils.TestCase):
+
+    def test_full(self):
+        bitmap = macs.MacBitmap()
+        bitmap._bits = bytearray(b'\xff' * len(bitmap._bits))
+        self.assertRaises(RuntimeError, bitmap.allocate)
+
+    def test_update_ignores_foreign_macs(self):
+        bitmap = macs.MacBitmap()
+        bitmap.update(['12:34:56:00:00:01', '52:54:00:zz:00:01',
+                       '52:54:00:00:00:01'])
+        self.assertEqual(b'\x02', bytes(bitmap._bits[:1]))
+        self.assertEqual(1, sum(1 for b in bitmap._bits if b))
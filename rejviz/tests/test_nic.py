@@ -10,8 +10,13 @@
 # implied. See the License for the specific language governing
 # permissions and limitations under the License.
 
+import os
+from os import path
+import shutil
+import stat
+import tempfile
+
 import mock
-from testtools import matchers
 
 from rejviz import nic
 import rejviz.tests.utils as tutils
@@ -25,7 +30,7 @@ class NicTest(tutils.TestCase):
         # prepare
         args = [
             '--size', '10G',
-            '--nic', 'ipaddr=192.168.122.10;hwaddr=ab:cd:ef:gh:ij',
+            '--nic', 'ipaddr=192.168.122.10,hwaddr=ab:cd:ef:gh:ij',
             '--install', 'wget',
         ]
 
@@ -39,7 +44,8 @@ class NicTest(tutils.TestCase):
             '--install', 'wget',
         ], final_args)
         nic_values_to_args.assert_called_with(
-            'ipaddr=192.168.122.10;hwaddr=ab:cd:ef:gh:ij', '/tmp/dir')
+            {'ipaddr': '192.168.122.10', 'hwaddr': 'ab:cd:ef:gh:ij'},
+            '/tmp/dir')
 
     @mock.patch('rejviz.nic._nic_values_to_args',
                 return_value=['--upload', '/one:/two'])
@@ -47,7 +53,7 @@ class NicTest(tutils.TestCase):
         # prepare
         args = [
             '--size=10G',
-            '--nic=ipaddr=192.168.122.10;hwaddr=ab:cd:ef:gh:ij',
+            '--nic=ipaddr=192.168.122.10,hwaddr=ab:cd:ef:gh:ij',
             '--install=wget',
         ]
 
@@ -61,7 +67,19 @@ class NicTest(tutils.TestCase):
             '--install=wget',
         ], final_args)
         nic_values_to_args.assert_called_with(
-            'ipaddr=192.168.122.10;hwaddr=ab:cd:ef:gh:ij', '/tmp/dir')
+            {'ipaddr': '192.168.122.10', 'hwaddr': 'ab:cd:ef:gh:ij'},
+            '/tmp/dir')
+
+    @mock.patch('rejviz.nic._nic_values_to_args')
+    @mock.patch('rejviz.daemon.call', return_value=['--upload', '/one:/two'])
+    def test_process_args_in_daemon(self, call, nic_values_to_args):
+        final_args = nic.process_args(['--nic', 'name=eth0'], '/tmp/dir')
+
+        self.assertEqual(['--upload', '/one:/two'], final_args)
+        call.assert_called_with('nic.process_args',
+                                args=['--nic', 'name=eth0'],
+                                tmp_dir='/tmp/dir')
+        self.assertEqual([], nic_values_to_args.mock_calls)
 
     @mock.patch('rejviz.nic._ensure_nic_vars', return_value={'name': 'eth0'})
     @mock.patch('rejviz.nic._render_nic_template', return_value='rendered')
@@ -70,7 +88,8 @@ class NicTest(tutils.TestCase):
     def test_nic_values_to_args(self, makedirs, open_,
                                 render_nic_template, ensure_nic_vars):
         # run
-        args = nic._nic_values_to_args('name=eth0', '/tmp/rejviz-builder-123')
+        args = nic._nic_values_to_args({'name': 'eth0'},
+                                       '/tmp/rejviz-builder-123')
 
         # verify
         ensure_nic_vars.assert_called_with({'name': 'eth0'})
@@ -89,6 +108,70 @@ class NicTest(tutils.TestCase):
             ],
             args)
 
+    @mock.patch('rejviz.nic._generate_mac_addresses',
+                new=lambda count: ['52:54:00:00:00:%02x' % i
+                                   for i in range(count)])
+    @mock.patch('rejviz.nic._render_nic_template')
+    @mock.patch('rejviz.nic._ensure_nic_vars', new=lambda nic_vars: nic_vars)
+    def test_process_args_copy_in(self, render_nic_template):
+        render_nic_template.side_effect = lambda nic_vars: nic_vars['name']
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        args = ['--size', '10G', '--nic', 'name=eth0', '--install', 'wget',
+                '--nic=name=eth1', '--nic-injection', 'copy-in']
+
+        final_args = nic.process_args(args, tmp_dir)
+
+        config_dir = path.join(tmp_dir, 'nic-configs', 'network-scripts')
+        self.assertEqual([
+            '--size', '10G',
+            '--copy-in', config_dir + ':/etc/sysconfig',
+            '--run-command',
+            'chown root:root /etc/sysconfig/network-scripts '
+            '/etc/sysconfig/network-scripts/ifcfg-eth0 '
+            '/etc/sysconfig/network-scripts/ifcfg-eth1',
+            '--install', 'wget',
+        ], final_args)
+        self.assertEqual(['ifcfg-eth0', 'ifcfg-eth1'],
+                         sorted(os.listdir(config_dir)))
+        self.assertEqual(0o755, stat.S_IMODE(os.stat(config_dir).st_mode))
+        with open(path.join(config_dir, 'ifcfg-eth1')) as f:
+            self.assertEqual('eth1', f.read())
+
+    @mock.patch('rejviz.nic._generate_mac_addresses',
+                return_value=['52:54:00:00:00:01'])
+    @mock.patch('rejviz.nic._render_nic_template',
+                return_value='DEVICE=eth0\n')
+    @mock.patch('rejviz.nic._ensure_nic_vars', new=lambda nic_vars: nic_vars)
+    def test_process_args_write(self, render_nic_template,
+                                generate_mac_addresses):
+        args = ['--nic-injection=write', '--nic', 'name=eth0']
+
+        final_args = nic.process_args(args, '/nonexistent')
+
+        self.assertEqual([
+            '--write',
+            '/etc/sysconfig/network-scripts/ifcfg-eth0:DEVICE=eth0\n',
+        ], final_args)
+
+    @mock.patch('rejviz.nic._nic_values_to_write_args', return_value=[])
+    @mock.patch('rejviz.macs.allocate_macs',
+                return_value=['52:54:00:00:00:01', '52:54:00:00:00:02'])
+    def test_process_args_allocates_macs_in_batch(self, allocate_macs,
+                                                  nic_values_to_write_args):
+        nic.process_args(['--nic-injection=write', '--nic', 'name=eth0',
+                          '--nic', 'name=eth1,hwaddr=52:54:00:12:34:56',
+                          '--nic', 'name=eth2'], '/nonexistent')
+
+        allocate_macs.assert_called_once_with(2)
+        self.assertEqual(
+            ['52:54:00:00:00:01', '52:54:00:12:34:56', '52:54:00:00:00:02'],
+            [c[1][0]['hwaddr'] for c in nic_values_to_write_args.mock_calls])
+
+    def test_process_args_unknown_injection(self):
+        self.assertRaises(ValueError, nic.process_args,
+                          ['--nic-injection', 'tar'], '/tmp/dir')
+
     def test_render_nic_template(self):
         nic_vars = {
             'name': 'eth0',
@@ -142,7 +225,8 @@ class NicTest(tutils.TestCase):
         }
         self.assertRaises(ValueError, nic._ensure_nic_vars, nic_vars)
 
-    def test_ensure_nic_vars_minimal(self):
+    @mock.patch('rejviz.macs.allocate_mac', return_value='52:54:00:ab:cd:ef')
+    def test_ensure_nic_vars_minimal(self, allocate_mac):
         nic_vars = {
             'name': 'eth0',
         }
@@ -150,10 +234,12 @@ class NicTest(tutils.TestCase):
         self.assertEqual(3, len(ensured))
         self.assertEqual('eth0', ensured['name'])
         self.assertEqual('dhcp', ensured['bootproto'])
-        self.assertThat(
-            ensured['hwaddr'],
-            matchers.MatchesRegex(
-                '^52:54:00:[0-9a-f]{2}:[0-9a-f]{2}:[0-9a-f]{2}$'))
+        self.assertEqual('52:54:00:ab:cd:ef', ensured['hwaddr'])
+
+    @mock.patch('rejviz.macs.allocate_mac')
+    def test_ensure_nic_vars_hwaddr_not_allocated(self, allocate_mac):
+        nic._ensure_nic_vars({'name': 'eth0', 'hwaddr': '12:34:56:ab:cd:ef'})
+        self.assertEqual([], allocate_mac.mock_calls)
 
     def test_ensure_nic_vars_static_minimal(self):
         nic_vars = {
@@ -172,6 +258,62 @@ class NicTest(tutils.TestCase):
         }
         self.assertEqual(expected, nic._ensure_nic_vars(nic_vars))
 
+    def test_ensure_nic_vars_static_netmask(self):
+        nic_vars = {
+            'name': 'eth0',
+            'hwaddr': '12:34:56:ab:cd:ef',
+            'ipaddr': '10.1.2.3',
+            'netmask': '255.255.0.0',
+        }
+        ensured = nic._ensure_nic_vars(nic_vars)
+        self.assertEqual('10.1.0.0', ensured['network'])
+        self.assertEqual('10.1.255.255', ensured['broadcast'])
+
+    @mock.patch('rejviz.ipam.allocate_ipaddr', return_value='10.1.2.3')
+    @mock.patch('rejviz.libvirt_nets.get_libvirt_networks')
+    def test_ensure_nic_vars_auto_ipaddr(self, get_libvirt_networks,
+                                         allocate_ipaddr):
+        get_libvirt_networks.return_value = [
+            {'name': 'default', 'address': '192.168.122.1',
+             'network': '192.168.122.0', 'netmask': '255.255.255.0'},
+            {'name': 'net1', 'address': '10.1.0.1',
+             'network': '10.1.0.0', 'netmask': '255.255.0.0'},
+        ]
+        expected = {
+            'name': 'eth0',
+            'hwaddr': '12:34:56:ab:cd:ef',
+            'bootproto': 'static',
+            'ipaddr': '10.1.2.3',
+            'network': '10.1.0.0',
+            'netmask': '255.255.0.0',
+            'broadcast': '10.1.255.255',
+            'gateway': '10.1.0.1',
+        }
+
+        by_name = nic._ensure_nic_vars({
+            'name': 'eth0', 'hwaddr': '12:34:56:ab:cd:ef',
+            'ipaddr': 'auto', 'libvirt_network': 'net1'})
+        self.assertEqual(expected, by_name)
+        allocate_ipaddr.assert_called_with(
+            get_libvirt_networks.return_value[1])
+
+        by_network = nic._ensure_nic_vars({
+            'name': 'eth0', 'hwaddr': '12:34:56:ab:cd:ef',
+            'ipaddr': 'auto', 'network': '10.1.0.0'})
+        self.assertEqual(expected, by_network)
+
+    @mock.patch('rejviz.libvirt_nets.get_libvirt_networks', return_value=[])
+    def test_ensure_nic_vars_auto_ipaddr_no_network(self,
+                                                    get_libvirt_networks):
+        for nic_vars in [
+                {'name': 'eth0', 'hwaddr': '12:34:56:ab:cd:ef',
+                 'ipaddr': 'auto'},
+                {'name': 'eth0', 'hwaddr': '12:34:56:ab:cd:ef',
+                 'ipaddr': 'auto', 'libvirt_network': 'missing'},
+                {'name': 'eth0', 'hwaddr': '12:34:56:ab:cd:ef',
+                 'ipaddr': 'auto', 'network': '10.1.0.0'}]:
+            self.assertRaises(ValueError, nic._ensure_nic_vars, nic_vars)
+
     def test_ensure_nic_vars_dhcp(self):
         nic_vars = {
             'name': 'eth0',
@@ -186,10 +328,7 @@ class NicTest(tutils.TestCase):
         }
         self.assertEqual(expected, nic._ensure_nic_vars(nic_vars))
 
-    def test_generate_mac_address(self):
-        # testing randomness is bad, but in this case the probability
-        # of non-deterministic failure is extremely low
-        self.assertThat(
-            nic._generate_mac_address(),
-            matchers.MatchesRegex(
-                '^52:54:00:[0-9a-f]{2}:[0-9a-f]{2}:[0-9a-f]{2}$'))
+    @mock.patch('rejviz.macs.allocate_mac', return_value='52:54:00:ab:cd:ef')
+    def test_generate_mac_address(self, allocate_mac):
+        self.assertEqual('52:54:00:ab:cd:ef', nic._generate_mac_address())
+        allocate_mac.assert_called_with()
@@ -10,7 +10,7 @@
 # implied. See the License for the specific language governing
 # permissions and limitations under the License.
 
-import subprocess
+import os
 
 import mock
 
@@ -18,94 +18,14 @@ from rejviz import nic_mappings
 import rejviz.tests.utils as tutils
 
 
-NICS_SCRIPT = u'''aug-init / 0
-echo @name
-echo eth0
-echo @type
--aug-get /files/etc/sysconfig/network-scripts/ifcfg-eth0/TYPE
-echo @hwaddr
--aug-get /files/etc/sysconfig/network-scripts/ifcfg-eth0/HWADDR
-echo @bootproto
--aug-get /files/etc/sysconfig/network-scripts/ifcfg-eth0/BOOTPROTO
-echo @network
--aug-get /files/etc/sysconfig/network-scripts/ifcfg-eth0/NETWORK
-echo @netmask
--aug-get /files/etc/sysconfig/network-scripts/ifcfg-eth0/NETMASK
-echo @-----
-echo @name
-echo eth1
-echo @type
--aug-get /files/etc/sysconfig/network-scripts/ifcfg-eth1/TYPE
-echo @hwaddr
--aug-get /files/etc/sysconfig/network-scripts/ifcfg-eth1/HWADDR
-echo @bootproto
--aug-get /files/etc/sysconfig/network-scripts/ifcfg-eth1/BOOTPROTO
-echo @network
--aug-get /files/etc/sysconfig/network-scripts/ifcfg-eth1/NETWORK
-echo @netmask
--aug-get /files/etc/sysconfig/network-scripts/ifcfg-eth1/NETMASK
-echo @-----
-echo @name
-echo lo
-echo @type
--aug-get /files/etc/sysconfig/network-scripts/ifcfg-lo/TYPE
-echo @hwaddr
--aug-get /files/etc/sysconfig/network-scripts/ifcfg-lo/HWADDR
-echo @bootproto
--aug-get /files/etc/sysconfig/network-scripts/ifcfg-lo/BOOTPROTO
-echo @network
--aug-get /files/etc/sysconfig/network-scripts/ifcfg-lo/NETWORK
-echo @netmask
--aug-get /files/etc/sysconfig/network-scripts/ifcfg-lo/NETMASK
-echo @-----
-'''
-
-
-NICS_OUTPUT = '''@name
-eth0
-@type
-Ethernet
-@hwaddr
-52:54:00:12:34:56
-@bootproto
-dhcp
-@network
-@netmask
-@-----
-@name
-eth1
-@type
-Ethernet
-@hwaddr
-52:54:00:12:34:78
-@bootproto
-static
-@network
-192.168.123.0
-@netmask
-255.255.255.0
-@-----
-@name
-loopback
-@type
-@hwaddr
-@bootproto
-@network
-127.0.0.0
-@netmask
-255.0.0.0
-@-----
-'''
-
-
 class NicMappingTest(tutils.TestCase):
 
     def test_has_nic_mapping_args(self):
-        self.assertTrue(nic_mappings._has_nic_mapping_args(
+        self.assertTrue(nic_mappings.has_nic_mapping_args(
             ['--disk', '/image', '--auto-nic-mappings']))
-        self.assertTrue(nic_mappings._has_nic_mapping_args(
+        self.assertTrue(nic_mappings.has_nic_mapping_args(
             ['--disk', '/image', '--nic-mappings', 'eth0=net1']))
-        self.assertFalse(nic_mappings._has_nic_mapping_args(
+        self.assertFalse(nic_mappings.has_nic_mapping_args(
             ['--disk', '/image']))
 
     def test_auto_nic_mappings_enabled(self):
@@ -114,56 +34,153 @@ class NicMappingTest(tutils.TestCase):
         self.assertFalse(nic_mappings._auto_nic_mappings_enabled(
             ['--abc', '--nic-mappings', 'a=b', '--abcdef']))
 
-    @mock.patch('subprocess.Popen')
-    @mock.patch('rejviz.nic_mappings._get_nic_names_from_image')
-    def test_fetch_nics_from_image(self, get_nic_names, popen):
-        # setup
-        popen.return_value.communicate.return_value = (
-            NICS_OUTPUT, 'stderr contents')
-        get_nic_names.return_value = ['eth0', 'eth1', 'lo']
-
-        # test
-        nics = nic_mappings._fetch_nics_from_image(['--disk', '/image'])
-        popen.assert_called_with(
-            ['guestfish', '-i', '--ro', '-a', '/image'], stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        popen.return_value.communicate.assert_called_with(NICS_SCRIPT)
-        get_nic_names.assert_called_with(['-a', '/image'])
-        self.assertEqual(2, len(nics))
+    @mock.patch('rejviz.inspection_cache.InspectionCache')
+    @mock.patch('rejviz.inspection.iter_nics')
+    def test_fetch_nics_from_image(self, iter_nics, cache_class):
+        cache_class.return_value.get.return_value = None
+        iter_nics.return_value = iter([
+            {'name': 'lo', 'type': None},
+            {'name': 'eth1', 'type': 'Ethernet'},
+            {'name': 'eth0', 'type': 'Ethernet'},
+        ])
+
+        nics = nic_mappings.fetch_nics_from_image(['--disk', '/image'])
+
+        iter_nics.assert_called_with(['-a', '/image'])
+        cache_class.return_value.put.assert_called_with(
+            ['-a', '/image'], [{'name': 'eth0', 'type': 'Ethernet'},
+                               {'name': 'eth1', 'type': 'Ethernet'},
+                               {'name': 'lo', 'type': None}])
         self.assertEqual(['eth0', 'eth1'], [n['name'] for n in nics])
 
-    @mock.patch('subprocess.check_output')
-    def test_get_nic_names_from_image(self, check_output):
-        check_output.return_value = (
-            'ifcfg-eth0\n'
-            'ifcfg-eth1\n'
-            'ifdown-eth0\n'
-            'ifdown-eth1\n'
-            'ifup-eth0\n'
-            'ifup-eth1\n')
+    @mock.patch('rejviz.inspection_cache.InspectionCache')
+    @mock.patch('rejviz.inspection.iter_nics')
+    def test_fetch_nics_from_image_cached(self, iter_nics, cache_class):
+        cache_class.return_value.get.return_value = [
+            {'name': 'eth0', 'type': 'Ethernet'}]
+
+        nics = nic_mappings.fetch_nics_from_image(['--disk', '/image'])
+
+        self.assertEqual([], iter_nics.mock_calls)
+        self.assertEqual(['eth0'], [n['name'] for n in nics])
+
+    @mock.patch('rejviz.inspection_cache.InspectionCache')
+    @mock.patch('rejviz.inspection.iter_nics')
+    def test_fetch_nics_from_image_refresh(self, iter_nics, cache_class):
+        iter_nics.return_value = iter([{'name': 'eth0', 'type': 'Ethernet'}])
+
+        nic_mappings.fetch_nics_from_image(['--disk', '/image'],
+                                           refresh_cache=True)
+
+        self.assertEqual([], cache_class.return_value.get.mock_calls)
+        cache_class.return_value.put.assert_called_with(
+            ['-a', '/image'], [{'name': 'eth0', 'type': 'Ethernet'}])
+
+    @mock.patch('rejviz.inspection_cache.InspectionCache')
+    @mock.patch('rejviz.inspection.iter_nics')
+    def test_fetch_nics_from_image_no_cache(self, iter_nics, cache_class):
+        iter_nics.return_value = iter([{'name': 'eth0', 'type': 'Ethernet'}])
+
+        nic_mappings.fetch_nics_from_image(['--disk', '/image'],
+                                           use_cache=False)
 
+        self.assertEqual([], cache_class.mock_calls)
+        iter_nics.assert_called_with(['-a', '/image'])
+
+    @mock.patch('rejviz.libvirt_nets.get_libvirt_networks')
+    @mock.patch('rejviz.nic_mappings.iter_nics_from_image')
+    def test_process_nic_mappings_streams_nics(self, iter_nics_from_image,
+                                               get_libvirt_networks):
+        get_libvirt_networks.return_value = [
+            {'name': 'net1', 'network': '192.168.123.0',
+             'netmask': '255.255.255.0'}]
+        mapped = []
+
+        def iter_nics(args, use_cache, refresh_cache):
+            for name, ipaddr in [('eth1', '192.168.123.11'),
+                                 ('eth0', '192.168.123.10')]:
+                yield {'name': name, 'type': 'Ethernet',
+                       'hwaddr': '52:54:00:00:00:0' + name[-1],
+                       'ipaddr': ipaddr}
+                # the networks were listed before the first NIC came in
+                mapped.append(len(get_libvirt_networks.mock_calls))
+        iter_nics_from_image.side_effect = iter_nics
+
+        args = nic_mappings.process_nic_mappings(
+            ['--disk', '/image', '--auto-nic-mappings'], use_daemon=False)
+
+        self.assertEqual([1, 1], mapped)
         self.assertEqual(
-            ['eth0', 'eth1'],
-            nic_mappings._get_nic_names_from_image(['-a', '/image']))
-        check_output.assert_called_with(
-            ['virt-ls', '-a', '/image',
-             '/etc/sysconfig/network-scripts'])
+            ['--disk', '/image',
+             '--network', 'network=net1,mac=52:54:00:00:00:00,model=virtio',
+             '--network', 'network=net1,mac=52:54:00:00:00:01,model=virtio'],
+            args)
+
+    @mock.patch('rejviz.inspection_cache.InspectionCache')
+    @mock.patch('rejviz.inspection.fetch_nics_multi')
+    def test_fetch_nics_from_images(self, fetch_nics_multi, cache_class):
+        cached = {('-a', '/cached'): [{'name': 'eth0', 'type': 'Ethernet'}]}
+        cache_class.return_value.get.side_effect = \
+            lambda image_args: cached.get(tuple(image_args))
+        error = RuntimeError('broken image')
+        fetch_nics_multi.return_value = [
+            [{'name': 'eth1', 'type': 'Ethernet'},
+             {'name': 'lo', 'type': 'Loopback'}], error]
+
+        results = nic_mappings.fetch_nics_from_images(
+            [['--disk', '/new'], ['--disk', '/cached'], ['--disk', '/bad'],
+             ['--name', 'vm']])
+
+        self.assertEqual([[{'name': 'eth1', 'type': 'Ethernet'}],
+                          [{'name': 'eth0', 'type': 'Ethernet'}], error],
+                         results[:3])
+        self.assertIsInstance(results[3], ValueError)
+        fetch_nics_multi.assert_called_once_with([['-a', '/new'],
+                                                  ['-a', '/bad']])
+        cache_class.return_value.put.assert_called_once_with(
+            ['-a', '/new'], fetch_nics_multi.return_value[0])
+
+    @mock.patch('rejviz.libvirt_nets.get_libvirt_networks')
+    @mock.patch('rejviz.nic_mappings.fetch_nics_from_image')
+    def test_process_nic_mappings_prefetched(self, fetch_nics,
+                                             get_libvirt_networks):
+        nics = [{'name': 'eth0', 'type': 'Ethernet',
+                 'hwaddr': '52:54:00:12:34:56', 'bootproto': 'static',
+                 'ipaddr': '192.168.123.10', 'network': None,
+                 'netmask': None}]
+        networks = [{'name': 'net1', 'network': '192.168.123.0',
+                     'netmask': '255.255.255.0'}]
+
+        args = nic_mappings.process_nic_mappings(
+            ['--disk', '/image', '--auto-nic-mappings'],
+            nics=nics, networks=networks)
 
-    def test_parse_nics_output(self):
         self.assertEqual(
-            [
-                {'name': 'eth0', 'type': 'Ethernet',
-                 'hwaddr': '52:54:00:12:34:56', 'bootproto': 'dhcp',
-                 'network': None, 'netmask': None},
-                {'name': 'eth1', 'type': 'Ethernet',
-                 'hwaddr': '52:54:00:12:34:78', 'bootproto': 'static',
-                 'network': '192.168.123.0', 'netmask': '255.255.255.0'},
-                {'name': 'loopback', 'type': None,
-                 'hwaddr': None, 'bootproto': None,
-                 'network': '127.0.0.0', 'netmask': '255.0.0.0'},
-            ],
-            nic_mappings._parse_nics_output(NICS_OUTPUT)
-        )
+            ['--disk', '/image', '--network',
+             'network=net1,mac=52:54:00:12:34:56,model=virtio'],
+            args)
+        self.assertEqual([], fetch_nics.mock_calls)
+        self.assertEqual([], get_libvirt_networks.mock_calls)
+
+    @mock.patch('rejviz.nic_mappings.fetch_nics_from_image')
+    @mock.patch('rejviz.daemon.call', return_value=['--disk', '/image'])
+    def test_process_nic_mappings_in_daemon(self, call, fetch_nics):
+        args = nic_mappings.process_nic_mappings(
+            ['--disk', '/image', '--auto-nic-mappings'])
+
+        self.assertEqual(['--disk', '/image'], args)
+        call.assert_called_with('nic_mappings.process_nic_mappings',
+                                args=['--disk', '/image',
+                                      '--auto-nic-mappings'],
+                                cwd=os.getcwd())
+        self.assertEqual([], fetch_nics.mock_calls)
+
+    def test_process_nic_mappings_strips_cache_flags(self):
+        self.assertEqual(
+            ['--disk', '/image'],
+            nic_mappings.process_nic_mappings(
+                ['--no-inspection-cache', '--disk', '/image',
+                 '--refresh-inspection']))
 
     def test_filter_ethernet_nics(self):
         self.assertEqual(
@@ -188,19 +205,23 @@ class NicMappingTest(tutils.TestCase):
             ]),
         )
 
+    def _nics(self, *nics):
+        return nic_mappings.NicCollection.from_dicts(nics)
+
     def test_map_nics_auto(self):
+        nics = self._nics(
+            {'name': 'eth0', 'type': 'Ethernet',
+             'hwaddr': '52:54:00:12:34:56', 'bootproto': 'dhcp',
+             'network': None, 'netmask': None},
+            {'name': 'eth1', 'type': 'Ethernet',
+             'hwaddr': '52:54:00:12:34:78', 'bootproto': 'static',
+             'network': '192.168.123.0', 'netmask': '255.255.255.0'},
+            {'name': 'eth2', 'type': 'Ethernet',
+             'hwaddr': '52:54:00:12:34:90', 'bootproto': 'static',
+             'network': '192.168.124.0', 'netmask': '255.255.255.0'})
+
         mapped_nics = nic_mappings._map_nics_auto(
-            [
-                {'name': 'eth0', 'type': 'Ethernet',
-                 'hwaddr': '52:54:00:12:34:56', 'bootproto': 'dhcp',
-                 'network': None, 'netmask': None},
-                {'name': 'eth1', 'type': 'Ethernet',
-                 'hwaddr': '52:54:00:12:34:78', 'bootproto': 'static',
-                 'network': '192.168.123.0', 'netmask': '255.255.255.0'},
-                {'name': 'eth2', 'type': 'Ethernet',
-                 'hwaddr': '52:54:00:12:34:90', 'bootproto': 'static',
-                 'network': '192.168.124.0', 'netmask': '255.255.255.0'},
-            ],
+            nics,
             [
                 {'name': 'net1',
                  'dhcp': 'false',
@@ -212,52 +233,53 @@ class NicMappingTest(tutils.TestCase):
                  'netmask': '255.255.255.0'},
             ])
 
-        self.assertEqual(
-            [
+        self.assertEqual([None, 'net1', None],
+                         [n.libvirt_network for n in mapped_nics])
+        self.assertEqual(nics.by_name('eth1')._replace(
+            libvirt_network='net1'), mapped_nics.by_name('eth1'))
+        # unchanged records are shared, the input is left alone
+        self.assertIs(nics.by_name('eth0'), mapped_nics.by_name('eth0'))
+        self.assertIsNone(nics.by_name('eth1').libvirt_network)
+
+    def test_map_nics_auto_containment(self):
+        mapped_nics = nic_mappings._map_nics_auto(
+            self._nics(
                 {'name': 'eth0', 'type': 'Ethernet',
-                 'hwaddr': '52:54:00:12:34:56', 'bootproto': 'dhcp',
-                 'network': None, 'netmask': None},
+                 'hwaddr': '52:54:00:12:34:56', 'bootproto': 'static',
+                 'ipaddr': '10.1.2.15', 'network': None, 'netmask': None},
                 {'name': 'eth1', 'type': 'Ethernet',
                  'hwaddr': '52:54:00:12:34:78', 'bootproto': 'static',
-                 'network': '192.168.123.0', 'netmask': '255.255.255.0',
-                 'libvirt_network': 'net1'},
-                {'name': 'eth2', 'type': 'Ethernet',
-                 'hwaddr': '52:54:00:12:34:90', 'bootproto': 'static',
-                 'network': '192.168.124.0', 'netmask': '255.255.255.0'},
-            ],
-            mapped_nics)
+                 'ipaddr': '10.7.0.3', 'network': '10.7.0.0',
+                 'netmask': '255.255.0.0'}),
+            [
+                {'name': 'wide', 'dhcp': False,
+                 'network': '10.0.0.0', 'netmask': '255.0.0.0'},
+                {'name': 'narrow', 'dhcp': False,
+                 'network': '10.1.2.0', 'netmask': '255.255.255.0'},
+            ])
+
+        self.assertEqual(['narrow', 'wide'],
+                         [n.libvirt_network for n in mapped_nics])
 
     def test_map_nics_manual(self):
-        mapped_nics = nic_mappings._map_nics_manual(
-            [
-                {'name': 'eth0', 'type': 'Ethernet',
-                 'hwaddr': '52:54:00:12:34:56', 'bootproto': 'dhcp',
-                 'network': None, 'netmask': None},
-                {'name': 'eth1', 'type': 'Ethernet',
-                 'hwaddr': '52:54:00:12:34:78', 'bootproto': 'static',
-                 'network': '192.168.123.0', 'netmask': '255.255.255.0',
-                 'libvirt_network': 'net1'},
-                {'name': 'eth2', 'type': 'Ethernet',
-                 'hwaddr': '52:54:00:12:34:90', 'bootproto': 'static',
-                 'network': '192.168.124.0', 'netmask': '255.255.255.0'},
-            ],
-            {'eth0': 'net0'})
+        nics = self._nics(
+            {'name': 'eth0', 'type': 'Ethernet',
+             'hwaddr': '52:54:00:12:34:56', 'bootproto': 'dhcp',
+             'network': None, 'netmask': None},
+            {'name': 'eth1', 'type': 'Ethernet',
+             'hwaddr': '52:54:00:12:34:78', 'bootproto': 'static',
+             'network': '192.168.123.0', 'netmask': '255.255.255.0',
+             'libvirt_network': 'net1'},
+            {'name': 'eth2', 'type': 'Ethernet',
+             'hwaddr': '52:54:00:12:34:90', 'bootproto': 'static',
+             'network': '192.168.124.0', 'netmask': '255.255.255.0'})
 
-        self.assertEqual(
-            [
-                {'name': 'eth0', 'type': 'Ethernet',
-                 'hwaddr': '52:54:00:12:34:56', 'bootproto': 'dhcp',
-                 'network': None, 'netmask': None,
-                 'libvirt_network': 'net0'},
-                {'name': 'eth1', 'type': 'Ethernet',
-                 'hwaddr': '52:54:00:12:34:78', 'bootproto': 'static',
-                 'network': '192.168.123.0', 'netmask': '255.255.255.0',
-                 'libvirt_network': 'net1'},
-                {'name': 'eth2', 'type': 'Ethernet',
-                 'hwaddr': '52:54:00:12:34:90', 'bootproto': 'static',
-                 'network': '192.168.124.0', 'netmask': '255.255.255.0'},
-            ],
-            mapped_nics)
+        mapped_nics = nic_mappings._map_nics_manual(nics, {'eth0': 'net0'})
+
+        self.assertEqual(['net0', 'net1', None],
+                         [n.libvirt_network for n in mapped_nics])
+        self.assertIs(nics.by_name('eth1'), mapped_nics.by_name('eth1'))
+        self.assertIs(nics, nic_mappings._map_nics_manual(nics, {}))
 
     def test_parse_manual_nic_mappings(self):
         mappings = nic_mappings._parse_manual_nic_mappings(
@@ -265,10 +287,17 @@ class NicMappingTest(tutils.TestCase):
 
         self.assertEqual({'eth0': 'net0', 'eth1': 'net1'}, mappings)
 
+    def test_parse_manual_nic_mappings_repeated(self):
+        mappings = nic_mappings._parse_manual_nic_mappings(
+            ['--nic-mappings', 'eth0=net0,eth1=net1',
+             '--nic-mappings=eth1=net2'])
+
+        self.assertEqual({'eth0': 'net0', 'eth1': 'net2'}, mappings)
+
     def test_convert_nic_mappings_args(self):
         args = ['--abc', '--nic-mappings', 'eth0=net0', '--auto-nic-mappings',
                 '--def']
-        mapped_nics = [
+        mapped_nics = self._nics(
             {'name': 'eth0', 'type': 'Ethernet',
              'hwaddr': '52:54:00:12:34:56', 'bootproto': 'dhcp',
              'network': None, 'netmask': None,
@@ -276,8 +305,7 @@ class NicMappingTest(tutils.TestCase):
             {'name': 'eth1', 'type': 'Ethernet',
              'hwaddr': '52:54:00:12:34:78', 'bootproto': 'static',
              'network': '192.168.123.0', 'netmask': '255.255.255.0',
-             'libvirt_network': 'net1'},
-        ]
+             'libvirt_network': 'net1'})
 
         self.assertEqual(
             ['--abc',
@@ -288,16 +316,35 @@ class NicMappingTest(tutils.TestCase):
              '--def'],
             nic_mappings._convert_nic_mappings_args(args, mapped_nics))
 
-    def test_nic_by_name(self):
-        eth0 = {'name': 'eth0', 'type': 'Ethernet',
-                'hwaddr': '52:54:00:12:34:56', 'bootproto': 'dhcp',
-                'network': None, 'netmask': None,
-                'libvirt_network': 'net0'}
-        eth1 = {'name': 'eth1', 'type': 'Ethernet',
-                'hwaddr': '52:54:00:12:34:78', 'bootproto': 'static',
-                'network': '192.168.123.0', 'netmask': '255.255.255.0',
-                'libvirt_network': 'net1'}
-        nics = [eth0, eth1]
-
-        self.assertEqual(eth0, nic_mappings._nic_by_name('eth0', nics))
-        self.assertRaises(ValueError, nic_mappings._nic_by_name, 'eth2', nics)
+    def test_convert_nic_mappings_args_repeated(self):
+        args = ['--nic-mappings', 'eth0=n0,eth1=n1', '--nic-mappings=eth1=n2',
+                '--nic-mappings', 'eth0=n0,eth0=n0']
+        mapped_nics = nic_mappings._map_nics_manual(
+            self._nics({'name': 'eth0', 'hwaddr': '52:54:00:00:00:01'},
+                       {'name': 'eth1', 'hwaddr': '52:54:00:00:00:02'}),
+            nic_mappings._parse_manual_nic_mappings(args))
+
+        self.assertEqual(
+            ['--network', 'network=n0,mac=52:54:00:00:00:01,model=virtio',
+             '--network', 'network=n2,mac=52:54:00:00:00:02,model=virtio'],
+            nic_mappings._convert_nic_mappings_args(args, mapped_nics))
+
+    def test_network_args_unmapped_nic(self):
+        self.assertRaises(ValueError, nic_mappings._network_args, ['eth0'],
+                          self._nics({'name': 'eth0', 'hwaddr': 'x'}))
+
+    def test_nic_collection(self):
+        eth0 = nic_mappings.Nic.from_dict(
+            {'name': 'eth0', 'type': 'Ethernet',
+             'hwaddr': '52:54:00:12:34:56', 'unknown_key': 'ignored'})
+        eth1 = nic_mappings.Nic.from_dict({'name': 'eth1'})
+        nics = nic_mappings.NicCollection([eth0, eth1])
+
+        self.assertEqual(['eth0', 'eth1'], nics.names())
+        self.assertEqual(2, len(nics))
+        self.assertIsNone(eth1.hwaddr)
+        self.assertIs(eth0, nics.by_name('eth0'))
+        self.assertRaises(ValueError, nics.by_name, 'eth2')
+        self.assertIs(eth0, nics.by_hwaddr('52:54:00:12:34:56'.upper()))
+        self.assertIsNone(nics.by_hwaddr('52:54:00:00:00:00'))
+        self.assertRaises(AttributeError, setattr, eth0, 'name', 'eth9')
@@ -0,0 +1,52 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License. You may
+# obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+
+import os
+
+import mock
+
+from rejviz import render
+from rejviz import utils
+import rejviz.tests.utils as tutils
+
+
+class RenderTest(tutils.TestCase):
+
+    def test_render(self):
+        self.assertEqual('HWADDR=12:34:56:ab:cd:ef',
+                         render.render('ifcfg-eth.j2', name='eth0',
+                                       hwaddr='12:34:56:ab:cd:ef',
+                                       bootproto='dhcp').splitlines()[0])
+
+    def test_environment_shared(self):
+        self.assertIs(render.get_environment(), render.get_environment())
+
+    def test_compiled_once(self):
+        environment = render.get_environment()
+        with mock.patch.object(environment, 'compile',
+                               wraps=environment.compile) as compile_:
+            render.render('ifcfg-eth.j2', name='eth0', hwaddr='a')
+            render.render('ifcfg-eth.j2', name='eth1', hwaddr='b')
+        self.assertEqual(1, len(compile_.mock_calls))
+
+    def test_bytecode_cache_persisted(self):
+        render.render('ifcfg-eth.j2', name='eth0', hwaddr='a')
+        self.assertNotEqual([], os.listdir(utils.cache_dir('jinja')))
+
+        # a fresh environment (as in a new process) loads the bytecode
+        render._environment = None
+        environment = render.get_environment()
+        with mock.patch.object(environment, 'compile',
+                               wraps=environment.compile) as compile_:
+            render.render('ifcfg-eth.j2', name='eth0', hwaddr='a')
+        self.assertEqual([], compile_.mock_calls)
@@ -10,30 +10,173 @@
 # implied. See the License for the specific language governing
 # permissions and limitations under the License.
 
+import fcntl
+import os
+from os import path
+import shutil
+import subprocess
+import tempfile
+import time
+
 import mock
-from testtools import matchers
 
 import rejviz.tests.utils as tutils
 from rejviz import tmp
 
 
-class TmpTest(tutils.TestCase):
+class WorkspaceManagerTest(tutils.TestCase):
 
-    @mock.patch('rejviz.tmp.path.exists', return_value=False)
-    @mock.patch('rejviz.tmp.os.mkdir')
-    def test_create_dir(self, mkdir, exists):
-        tmp_dir = tmp.create_dir()
+    def setUp(self):
+        super(WorkspaceManagerTest, self).setUp()
+        self.base_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.base_dir)
+        self.manager = tmp.WorkspaceManager(self.base_dir)
 
-        mkdir.assert_called_with(tmp_dir, 0o700)
-        self.assertThat(tmp_dir,
-                        matchers.MatchesRegex('^/tmp/rejviz-builder-\\d+$'))
+    def _dead_workspace(self, locked_by_other=False):
+        workspace = tempfile.mkdtemp(prefix=tmp.TMP_DIR_PREFIX,
+                                     dir=self.base_dir)
+        lock_fd = os.open(path.join(workspace, tmp.LOCK_FILE),
+                          os.O_WRONLY | os.O_CREAT)
+        if locked_by_other:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            self.addCleanup(os.close, lock_fd)
+        else:
+            os.close(lock_fd)
+        return workspace
 
-    @mock.patch('rejviz.tmp.shutil.rmtree')
-    def test_remove_dir_ok(self, rmtree):
-        tmp.remove_dir('/tmp/rejviz-builder-123')
-        rmtree.assert_called_with('/tmp/rejviz-builder-123')
+    def test_create(self):
+        workspace = self.manager.create()
+
+        self.assertEqual(self.base_dir, path.dirname(workspace))
+        self.assertTrue(
+            path.basename(workspace).startswith(tmp.TMP_DIR_PREFIX))
+        self.assertEqual(0o700, os.stat(workspace).st_mode & 0o777)
+        with open(path.join(workspace, tmp.LOCK_FILE)) as lock_file:
+            self.assertEqual('%d\n' % os.getpid(), lock_file.read())
+        self.assertNotEqual(workspace, self.manager.create())
+
+    def test_create_not_reaped_while_locking(self):
+        real_rename = os.rename
+        reaped = []
+
+        def rename(src, dst):
+            # another process reaping right before the lock is in place
+            reaped.append(tmp.WorkspaceManager(self.base_dir).reap_stale())
+            real_rename(src, dst)
+
+        with mock.patch('rejviz.tmp.os.rename', side_effect=rename):
+            workspace = self.manager.create()
+
+        self.assertEqual([0], reaped)
+        self.assertEqual([tmp.LOCK_FILE], os.listdir(workspace))
+        self.assertEqual(0, tmp.WorkspaceManager(self.base_dir).reap_stale())
+
+    def test_remove(self):
+        workspace = self.manager.create()
+        self.manager.remove(workspace)
+        self.assertFalse(path.exists(workspace))
 
     @mock.patch('rejviz.tmp.shutil.rmtree')
-    def test_remove_dir_bad_prefix(self, rmtree):
-        self.assertRaises(ValueError, tmp.remove_dir, '/tmp/rejviz-123')
+    def test_remove_bad_prefix(self, rmtree):
+        self.assertRaises(ValueError, self.manager.remove,
+                          path.join(self.base_dir, 'rejviz-123'))
+        self.assertRaises(ValueError, self.manager.remove,
+                          '/tmp/elsewhere/rejviz-builder-123')
         self.assertEqual([], rmtree.mock_calls)
+
+    def test_reap_stale(self):
+        live = self.manager.create()
+        locked = self._dead_workspace(locked_by_other=True)
+        dead = self._dead_workspace()
+        lockless = tempfile.mkdtemp(prefix=tmp.TMP_DIR_PREFIX,
+                                    dir=self.base_dir)
+        old_lockless = tempfile.mkdtemp(prefix=tmp.TMP_DIR_PREFIX,
+                                        dir=self.base_dir)
+        old = time.time() - tmp.LOCKLESS_GRACE - 1
+        os.utime(old_lockless, (old, old))
+
+        self.assertEqual(2, self.manager.reap_stale())
+
+        self.assertTrue(path.exists(live))
+        self.assertTrue(path.exists(locked))
+        self.assertTrue(path.exists(lockless))
+        self.assertFalse(path.exists(dead))
+        self.assertFalse(path.exists(old_lockless))
+
+    @mock.patch('rejviz.tmp.shutil.rmtree')
+    def test_reap_stale_counts_removed_only(self, rmtree):
+        self._dead_workspace()
+        self.assertEqual(0, self.manager.reap_stale())
+        self.assertEqual(1, len(rmtree.mock_calls))
+
+    def test_reap_marker_is_private(self):
+        self.manager.create()
+        marker_path = self.manager._reap_marker_path()
+        self.assertEqual([], [name for name in os.listdir(self.base_dir)
+                              if not name.startswith(tmp.TMP_DIR_PREFIX)])
+        self.assertEqual(0o600, os.stat(marker_path).st_mode & 0o777)
+        self.assertNotEqual(
+            marker_path,
+            tmp.WorkspaceManager(self.base_dir + '2')._reap_marker_path())
+
+    def test_create_reaps_periodically(self):
+        dead = self._dead_workspace()
+        self.manager.create()
+        self.assertFalse(path.exists(dead))
+
+        # the next reap happens after REAP_INTERVAL
+        dead = self._dead_workspace()
+        self.manager.create()
+        self.assertTrue(path.exists(dead))
+        old = time.time() - tmp.REAP_INTERVAL - 1
+        os.utime(self.manager._reap_marker_path(), (old, old))
+        self.manager.create()
+        self.assertFalse(path.exists(dead))
+
+    def test_quota(self):
+        self.manager.quota_bytes = 1000
+        workspace = self.manager.create()
+        with open(path.join(workspace, 'disk'), 'w') as disk:
+            disk.write('x' * 1000)
+
+        self.assertRaises(RuntimeError, self.manager.create)
+
+        self.manager.remove(workspace)
+        self.manager.create()
+
+    def test_quota_from_env(self):
+        with mock.patch.dict(os.environ, {tmp.QUOTA_ENV: '2'}):
+            self.assertEqual(2 * 1024 ** 2,
+                             tmp.WorkspaceManager().quota_bytes)
+
+    def test_default_manager_base_dir_from_env(self):
+        with mock.patch.dict(os.environ, {tmp.BASE_DIR_ENV: self.base_dir}):
+            workspace = tmp.create_dir()
+        self.assertEqual(self.base_dir, path.dirname(workspace))
+        tmp.remove_dir(workspace)
+        self.assertFalse(path.exists(workspace))
+
+
+class TmpTest(tutils.TestCase):
+
+    def test_remove_dir_after_exit(self):
+        tmp_dir = tmp.create_dir()
+        self.addCleanup(subprocess.call, ['rm', '-rf', tmp_dir])
+        open(path.join(tmp_dir, 'ifcfg-eth0'), 'w').close()
+        process = subprocess.Popen(['sleep', '1'])
+
+        tmp.remove_dir_after_exit(tmp_dir, process.pid)
+
+        self.assertTrue(path.exists(tmp_dir))
+        process.wait()
+        for _ in range(50):
+            if not path.exists(tmp_dir):
+                break
+            time.sleep(0.1)
+        self.assertFalse(path.exists(tmp_dir))
+
+    @mock.patch('subprocess.Popen')
+    def test_remove_dir_after_exit_bad_prefix(self, popen):
+        self.assertRaises(ValueError, tmp.remove_dir_after_exit, '/home',
+                          os.getpid())
+        self.assertEqual([], popen.mock_calls)
@@ -0,0 +1,97 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License. You may
+# obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+import json
+import os
+from os import path
+import pstats
+import shutil
+import tempfile
+
+import mock
+
+from rejviz import trace
+import rejviz.tests.utils as tutils
+
+
+class TraceTest(tutils.TestCase):
+
+    def setUp(self):
+        super(TraceTest, self).setUp()
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir)
+        self.trace_path = path.join(self.work_dir, 'trace.json')
+
+    def _read_trace(self):
+        with open(self.trace_path) as f:
+            return json.load(f)['traceEvents']
+
+    def test_span_disabled(self):
+        self.assertEqual(['--one'], trace.start(['--one']).args)
+        with trace.span('phase', a=1) as span_args:
+            span_args['b'] = 2
+        trace.finish()
+        self.assertFalse(path.exists(self.trace_path))
+
+    def test_spans_written(self):
+        args = trace.start(['--one', '--trace', self.trace_path, '--two'])
+        with trace.span('outer'):
+            with trace.span('inner', size=3) as span_args:
+                span_args['exit_code'] = 0
+        trace.finish()
+
+        self.assertEqual(['--one', '--two'], args.args)
+        events = self._read_trace()
+        self.assertEqual(['outer', 'inner'], [e['name'] for e in events])
+        self.assertEqual({'size': 3, 'exit_code': 0}, events[1]['args'])
+        self.assertEqual('X', events[1]['ph'])
+        self.assertTrue(events[0]['dur'] >= events[1]['dur'])
+
+    def test_span_records_error(self):
+        trace.start(['--trace=%s' % self.trace_path])
+
+        def fail():
+            with trace.span('failing'):
+                raise ValueError('broken')
+        self.assertRaises(ValueError, fail)
+        trace.finish()
+
+        self.assertEqual('broken', self._read_trace()[0]['args']['error'])
+
+    def test_events_of_worker_merged(self):
+        trace.start(['--trace', self.trace_path])
+        with trace.span('parent'):
+            pass
+        worker_events = [{'name': 'worker', 'ph': 'X', 'ts': 1, 'dur': 1,
+                          'pid': os.getpid() + 1, 'tid': 1, 'args': {}}]
+
+        # what a worker takes excludes the spans of the parent
+        self.assertEqual(['parent'],
+                         [e['name'] for e in trace.take_events()])
+        self.assertEqual([], trace.take_events())
+        trace.add_events(worker_events)
+        trace.finish()
+
+        self.assertEqual(['worker'],
+                         [e['name'] for e in self._read_trace()])
+
+    def test_start_from_environment(self):
+        profile_path = path.join(self.work_dir, 'profile')
+        with mock.patch.dict(os.environ, {trace.TRACE_ENV: self.trace_path,
+                                          trace.PROFILE_ENV: profile_path}):
+            trace.start([])
+        with trace.span('phase'):
+            pass
+        trace.finish()
+
+        self.assertEqual(['phase'], [e['name'] for e in self._read_trace()])
+        pstats.Stats(profile_path)
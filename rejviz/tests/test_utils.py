@@ -44,3 +44,36 @@ class UtilsTest(tutils.TestCase):
                          utils.extract_image_args_from_disks(args2))
         self.assertRaises(ValueError,
                           utils.extract_domain_or_image_args, args3)
+
+    def test_extract_image_args_from_first_disk(self):
+        args = ['--disk=path=/boot-image', '--disk', '/data-image']
+
+        self.assertEqual(['-a', '/boot-image'],
+                         utils.extract_image_args_from_disks(args))
+
+    def test_ipv4_conversions(self):
+        self.assertEqual(3232266753, utils.ipv4_to_int('192.168.122.1'))
+        self.assertEqual('192.168.122.1', utils.int_to_ipv4(3232266753))
+
+    def test_netmask_prefix_len(self):
+        self.assertEqual(24, utils.netmask_to_prefix_len('255.255.255.0'))
+        self.assertEqual(0, utils.netmask_to_prefix_len('0.0.0.0'))
+        self.assertEqual(32,
+                         utils.netmask_to_prefix_len('255.255.255.255'))
+        self.assertRaises(ValueError,
+                          utils.netmask_to_prefix_len, '255.0.255.0')
+        self.assertEqual('255.255.255.192', utils.prefix_len_to_netmask(26))
+
+    def test_bitmap(self):
+        bitmap = utils.Bitmap(100)
+        bitmap.add(0)
+        bitmap.add_range(2, 97)
+
+        self.assertIn(0, bitmap)
+        self.assertNotIn(1, bitmap)
+        self.assertEqual(1, bitmap.first_free())
+        self.assertEqual(98, bitmap.first_free(2))
+        bitmap.add_range(98, 200)
+        self.assertIsNone(bitmap.first_free(2))
+        self.assertEqual(list(range(2, 100)),
+                         [i for i in range(2, 100) if i in bitmap])
@@ -10,8 +10,48 @@
 # implied. See the License for the specific language governing
 # permissions and limitations under the License.
 
+import os
+import shutil
+import tempfile
+
+import mock
 import testtools
 
+from rejviz import admission
+from rejviz import daemon
+from rejviz import render
+from rejviz import tmp
+from rejviz import trace
+
 
 class TestCase(testtools.TestCase):
-    pass
+
+    def setUp(self):
+        super(TestCase, self).setUp()
+        # keep caches and state written by the tested code out of $HOME
+        xdg_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, xdg_dir)
+        os.mkdir(os.path.join(xdg_dir, 'run'), 0o700)
+        environ_patcher = mock.patch.dict(os.environ, {
+            'XDG_CACHE_HOME': os.path.join(xdg_dir, 'cache'),
+            'XDG_DATA_HOME': os.path.join(xdg_dir, 'data'),
+            'XDG_RUNTIME_DIR': os.path.join(xdg_dir, 'run'),
+            tmp.BASE_DIR_ENV: xdg_dir,
+            admission.DIR_ENV: os.path.join(xdg_dir, 'admission'),
+            # no rejvizd, unless a test starts one
+            daemon.SOCKET_ENV: '',
+        })
+        os.environ.pop(trace.TRACE_ENV, None)
+        os.environ.pop(trace.PROFILE_ENV, None)
+        os.environ.pop(admission.MIN_FREE_ENV, None)
+        environ_patcher.start()
+        self.addCleanup(environ_patcher.stop)
+        os.environ.pop(tmp.QUOTA_ENV, None)
+        tmp._default_manager = None
+        self.addCleanup(setattr, tmp, '_default_manager', None)
+        os.environ.pop(admission.MAX_LAUNCHES_ENV, None)
+        admission._default_controller = None
+        self.addCleanup(setattr, admission, '_default_controller', None)
+        render._environment = None
+        self.addCleanup(setattr, render, '_environment', None)
+        self.addCleanup(setattr, trace, '_tracer', None)
@@ -10,32 +10,225 @@
 # implied. See the License for the specific language governing
 # permissions and limitations under the License.
 
+import fcntl
+import hashlib
+import logging
 import os
 from os import path
-import random
 import shutil
+import subprocess
+import tempfile
+import threading
+import time
 
+from rejviz import utils
 
-TMP_DIR_BASE = '/tmp/rejviz-builder-'
+
+LOG = logging.getLogger(__file__)
+BASE_DIR_ENV = 'REJVIZ_TMP_DIR'
+QUOTA_ENV = 'REJVIZ_TMP_QUOTA_MB'
+TMP_DIR_PREFIX = 'rejviz-builder-'
+LOCK_FILE = '.lock'
+REAP_MARKER_PREFIX = 'reaped-'
+REAP_INTERVAL = 300
+# workspaces without a lock file are either being created right now, or
+# their creator died before locking them
+LOCKLESS_GRACE = 3600
+# waits for process $1 to exit, then removes directory $2
+WATCHER_SCRIPT = ('while kill -0 "$1" 2>/dev/null; do sleep 1; done; '
+                  'rm -rf -- "$2"')
+
+_default_manager = None
+_default_manager_lock = threading.Lock()
 
 
 def create_dir():
-    tmp_dir = _random_dir_name()
-    while (path.exists(tmp_dir)):
-        tmp_dir = _random_dir_name()
-    os.mkdir(tmp_dir, 0o0700)
-    return tmp_dir
+    return default_manager().create()
 
 
 def remove_dir(tmp_dir):
-    if tmp_dir.find(TMP_DIR_BASE) == 0:
-        shutil.rmtree(tmp_dir)
-    else:
-        raise ValueError(
-            "Wanted to remove \'%(to_remove)s\' but only directories"
-            "beginning with \'%(prefix)s\' can be removed."
-            % {'to_remove': tmp_dir, 'prefix': TMP_DIR_BASE})
+    default_manager().remove(tmp_dir)
+
+
+def remove_dir_after_exit(tmp_dir, pid=None):
+    """Remove `tmp_dir` once process `pid` (default: this one) exits.
+
+    Meant to be called right before exec'ing into another program. The
+    workspace lock is handed over to the program, and a watcher removes
+    the directory when it exits. The watcher is a shell loop in its own
+    session, so that it isn't hit by signals sent to the program's
+    process group.
+    """
+    manager = default_manager()
+    manager.check_removable(tmp_dir)
+    manager.keep_locked_across_exec(tmp_dir)
+    with open(os.devnull, 'r+') as devnull:
+        subprocess.Popen(
+            ['sh', '-c', WATCHER_SCRIPT, 'rejviz-tmp-watcher',
+             str(pid or os.getpid()), tmp_dir],
+            stdin=devnull, stdout=devnull, stderr=devnull,
+            close_fds=True, preexec_fn=os.setsid)
+
+
+def default_manager():
+    global _default_manager
+    with _default_manager_lock:
+        if _default_manager is None:
+            _default_manager = WorkspaceManager()
+        return _default_manager
+
+
+class WorkspaceManager(object):
+    """Creates, removes and reaps tmp workspaces of rejviz processes.
+
+    Workspaces are created atomically (mkdtemp) under `base_dir`, which
+    can be pointed at a tmpfs like /dev/shm. Each holds a lock file,
+    locked for as long as its owner process lives, so workspaces left
+    behind by dead processes are recognized reliably and reaped in bulk,
+    at most once per REAP_INTERVAL across all processes of the user
+    (tracked in the user's runtime dir, as `base_dir` may be shared). With
+    `quota_bytes`, creating a workspace fails while the live workspaces
+    take more space than that.
+    """
+
+    def __init__(self, base_dir=None, quota_bytes=None):
+        self.base_dir = path.abspath(base_dir or
+                                     os.environ.get(BASE_DIR_ENV) or
+                                     tempfile.gettempdir())
+        if quota_bytes is None and os.environ.get(QUOTA_ENV):
+            quota_bytes = int(os.environ[QUOTA_ENV]) * 1024 ** 2
+        self.quota_bytes = quota_bytes
+        self._lock_fds = {}
+
+    def create(self):
+        self._reap_periodically()
+        if self.quota_bytes is not None:
+            self._check_quota()
+
+        workspace = tempfile.mkdtemp(prefix=TMP_DIR_PREFIX,
+                                     dir=self.base_dir)
+        # the lock file appears already locked, until then the workspace
+        # is lockless and left alone by reapers for LOCKLESS_GRACE
+        new_lock_path = path.join(workspace, LOCK_FILE + '.new')
+        lock_fd = os.open(new_lock_path,
+                          os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        os.write(lock_fd, ('%d\n' % os.getpid()).encode('ascii'))
+        os.rename(new_lock_path, path.join(workspace, LOCK_FILE))
+        self._lock_fds[workspace] = lock_fd
+        LOG.debug('Created workspace %s', workspace)
+        return workspace
+
+    def remove(self, workspace):
+        self.check_removable(workspace)
+        shutil.rmtree(workspace)
+        lock_fd = self._lock_fds.pop(workspace, None)
+        if lock_fd is not None:
+            os.close(lock_fd)
+
+    def keep_locked_across_exec(self, workspace):
+        lock_fd = self._lock_fds.get(workspace)
+        # Python 2 fds are always inherited
+        if lock_fd is not None and hasattr(os, 'set_inheritable'):
+            os.set_inheritable(lock_fd, True)
+
+    def check_removable(self, workspace):
+        if path.dirname(path.abspath(workspace)) != self.base_dir or \
+                not path.basename(workspace).startswith(TMP_DIR_PREFIX):
+            raise ValueError(
+                "Wanted to remove '%(to_remove)s' but only directories "
+                "beginning with '%(prefix)s' can be removed."
+                % {'to_remove': workspace,
+                   'prefix': path.join(self.base_dir, TMP_DIR_PREFIX)})
+
+    def reap_stale(self):
+        """Remove workspaces of dead processes, returns their count."""
+        reaped = 0
+        for workspace in self._workspaces():
+            if self._is_stale(workspace):
+                shutil.rmtree(workspace, ignore_errors=True)
+                # workspaces of other users can't be removed
+                if not path.lexists(workspace):
+                    reaped += 1
+        if reaped:
+            LOG.info('Reaped %d stale workspaces in %s', reaped,
+                     self.base_dir)
+        return reaped
+
+    def usage(self):
+        """Bytes taken by the live workspaces."""
+        total = 0
+        for workspace in self._workspaces():
+            for root, _, files in os.walk(workspace):
+                for file_name in files:
+                    try:
+                        total += os.lstat(path.join(root, file_name)).st_size
+                    except OSError:
+                        pass
+        return total
+
+    def _workspaces(self):
+        try:
+            names = os.listdir(self.base_dir)
+        except OSError:
+            return []
+        return [path.join(self.base_dir, name) for name in names
+                if name.startswith(TMP_DIR_PREFIX) and
+                path.isdir(path.join(self.base_dir, name))]
+
+    def _is_stale(self, workspace):
+        if workspace in self._lock_fds:
+            return False
+        try:
+            lock_fd = os.open(path.join(workspace, LOCK_FILE), os.O_RDONLY)
+        except OSError:
+            try:
+                return time.time() - os.stat(workspace).st_mtime > \
+                    LOCKLESS_GRACE
+            except OSError:
+                return False
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except (IOError, OSError):
+            # the owner is alive
+            return False
+        finally:
+            os.close(lock_fd)
+
+    def _reap_marker_path(self):
+        base_dir_hash = hashlib.sha1(self.base_dir.encode('utf-8'))
+        return path.join(utils.runtime_dir('tmp'),
+                         REAP_MARKER_PREFIX + base_dir_hash.hexdigest())
 
+    def _reap_periodically(self):
+        try:
+            marker_fd = os.open(self._reap_marker_path(),
+                                os.O_WRONLY | os.O_CREAT | os.O_NOFOLLOW,
+                                0o600)
+        except (OSError, RuntimeError) as e:
+            LOG.debug('Not reaping workspaces: %s', e)
+            return
+        try:
+            # only one process reaps, the others go on
+            fcntl.flock(marker_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            if time.time() - os.fstat(marker_fd).st_mtime < REAP_INTERVAL \
+                    and os.fstat(marker_fd).st_size:
+                return
+            self.reap_stale()
+            os.ftruncate(marker_fd, 0)
+            os.write(marker_fd, ('%d\n' % time.time()).encode('ascii'))
+        except (IOError, OSError):
+            return
+        finally:
+            os.close(marker_fd)
 
-def _random_dir_name():
-    return TMP_DIR_BASE + str(random.randint(1, 999999))
+    def _check_quota(self):
+        if self.usage() < self.quota_bytes:
+            return
+        self.reap_stale()
+        usage = self.usage()
+        if usage >= self.quota_bytes:
+            raise RuntimeError(
+                'Workspaces in %s take %d bytes, over the quota of %d bytes.'
+                % (self.base_dir, usage, self.quota_bytes))
@@ -0,0 +1,143 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License. You may
+# obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+from rejviz import arguments
+from rejviz import utils
+
+
+LOG = logging.getLogger(__file__)
+TRACE_ENV = 'REJVIZ_TRACE'
+PROFILE_ENV = 'REJVIZ_PROFILE'
+
+_tracer = None
+_profiler = None
+_profile_path = None
+
+
+def start(args):
+    """Enable tracing and profiling as requested by args or environment.
+
+    `--trace FILE` (or $REJVIZ_TRACE) writes spans in Chrome trace
+    format, `--profile FILE` (or $REJVIZ_PROFILE) writes cProfile
+    stats. Returns the tokenized `args` (an arguments.ArgList) without
+    these options.
+    """
+    global _tracer, _profiler, _profile_path
+    args = arguments.tokenize(args)
+    trace_path = args.last('--trace', os.environ.get(TRACE_ENV))
+    profile_path = args.last('--profile', os.environ.get(PROFILE_ENV))
+    if trace_path:
+        _tracer = Tracer(trace_path)
+    if profile_path:
+        import cProfile
+        _profile_path = profile_path
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+    return args.without('--trace', '--profile')
+
+
+def finish():
+    global _tracer, _profiler
+    if _profiler:
+        _profiler.disable()
+        _profiler.dump_stats(_profile_path)
+        LOG.info('Profile written to %s', _profile_path)
+        _profiler = None
+    if _tracer:
+        _tracer.write()
+        LOG.info('Trace written to %s', _tracer.trace_path)
+        _tracer = None
+
+
+def take_events():
+    """Remove and return the spans recorded by this process.
+
+    Worker processes forked by a traced process inherit its tracer, but
+    their trace is never written; they pass these events to the parent,
+    which merges them with add_events.
+    """
+    if _tracer is None:
+        return []
+    return _tracer.take_events(os.getpid())
+
+
+def add_events(events):
+    if _tracer is not None and events:
+        _tracer.add_events(events)
+
+
+@contextlib.contextmanager
+def span(name, **span_args):
+    """Record the duration of the `with` block as a span.
+
+    Yields a dict of span args, which the block can extend with results
+    (exit codes, sizes...). Does nothing when tracing is not enabled.
+    """
+    tracer = _tracer
+    if tracer is None:
+        yield span_args
+        return
+
+    started = time.time()
+    try:
+        yield span_args
+    except Exception as e:
+        span_args['error'] = str(e)
+        raise
+    finally:
+        tracer.add(name, started, time.time(), span_args)
+
+
+class Tracer(object):
+
+    def __init__(self, trace_path):
+        self.trace_path = trace_path
+        self.events = []
+        self._lock = threading.Lock()
+
+    def add(self, name, started, finished, span_args):
+        event = {
+            'name': name,
+            'ph': 'X',
+            'ts': int(started * 1e6),
+            'dur': int((finished - started) * 1e6),
+            'pid': os.getpid(),
+            'tid': threading.current_thread().ident,
+            'args': dict(span_args),
+        }
+        with self._lock:
+            self.events.append(event)
+
+    def take_events(self, pid):
+        with self._lock:
+            taken = [e for e in self.events if e['pid'] == pid]
+            self.events = [e for e in self.events if e['pid'] != pid]
+        return taken
+
+    def add_events(self, events):
+        with self._lock:
+            self.events.extend(events)
+
+    def write(self):
+        with self._lock:
+            events = sorted(self.events, key=lambda e: e['ts'])
+        utils.write_file_atomic(
+            self.trace_path,
+            json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'},
+                       default=str, indent=1))
@@ -10,7 +10,22 @@
 # implied. See the License for the specific language governing
 # permissions and limitations under the License.
 
-from six.moves import reduce
+import contextlib
+import errno
+import fcntl
+import functools
+import os
+from os import path
+import re
+import socket
+import stat
+import struct
+import tempfile
+
+from rejviz import arguments
+
+
+FREE_BYTE_RE = re.compile(b'[^\xff]')
 
 
 def parse_keyvals(keyvals_string, item_separator=',', kv_separator='='):
@@ -21,16 +36,15 @@ def parse_keyvals(keyvals_string, item_separator=',', kv_separator='='):
         keyvals[key] = value
         return keyvals
 
-    return reduce(keyvals_to_hash, keyvals_raw, {})
+    return functools.reduce(keyvals_to_hash, keyvals_raw, {})
 
 
 def extract_domain_or_image_args(args):
-    if '-d' in args:
-        return ['-d', args[args.index('-d') + 1]]
-    elif '-a' in args:
-        return ['-a', args[args.index('-a') + 1]]
-    else:
-        raise ValueError("No -d or -a found in arguments.")
+    args = arguments.ArgList(args, value_options=arguments.IMAGE_OPTIONS)
+    for option in ('-d', '-a'):
+        if args.has(option):
+            return [option, args.first(option)]
+    raise ValueError("No -d or -a found in arguments.")
 
 
 def extract_image_args_from_disks(args):
@@ -50,7 +64,157 @@ def extract_image_args_from_disks(args):
         raise ValueError("Disk options '%s' do not contain an image path."
                          % raw_opts)
 
-    if '--disk' in args:
-        return ['-a', image_from_disk_opts(args[args.index('--disk') + 1])]
-    else:
+    # the first disk is the one the guest boots from
+    disk = arguments.tokenize(args).first('--disk')
+    if disk is None:
         raise ValueError("No --disk found in arguments.")
+    return ['-a', image_from_disk_opts(disk)]
+
+
+def ipv4_to_int(ipaddr):
+    return struct.unpack('!I', socket.inet_aton(ipaddr))[0]
+
+
+def int_to_ipv4(value):
+    return socket.inet_ntoa(struct.pack('!I', value))
+
+
+def netmask_to_prefix_len(netmask):
+    mask = ipv4_to_int(netmask)
+    prefix_len = bin(mask).count('1')
+    if mask != prefix_len_to_mask(prefix_len):
+        raise ValueError("Netmask '%s' is not contiguous." % netmask)
+    return prefix_len
+
+
+def prefix_len_to_netmask(prefix_len):
+    return int_to_ipv4(prefix_len_to_mask(prefix_len))
+
+
+def prefix_len_to_mask(prefix_len):
+    return (0xffffffff << (32 - prefix_len)) & 0xffffffff
+
+
+class Bitmap(object):
+    """Fixed-size set of small integers, one bit per member."""
+
+    def __init__(self, size):
+        self.size = size
+        self._bits = bytearray((size + 7) // 8)
+
+    def __contains__(self, index):
+        return bool(self._bits[index >> 3] & (1 << (index & 7)))
+
+    def add(self, index):
+        self._bits[index >> 3] |= 1 << (index & 7)
+
+    def add_range(self, first, last):
+        """Add all members from `first` to `last` inclusive."""
+        first = max(first, 0)
+        last = min(last, self.size - 1)
+        # whole bytes in the middle are filled in one go
+        while first <= last and first & 7:
+            self.add(first)
+            first += 1
+        while last >= first and (last + 1) & 7:
+            self.add(last)
+            last -= 1
+        if first <= last:
+            self._bits[first >> 3:(last >> 3) + 1] = \
+                b'\xff' * ((last - first + 1) >> 3)
+
+    def first_free(self, start=0):
+        """Lowest index >= `start` that is not a member, or None."""
+        byte_index = start >> 3
+        while True:
+            match = FREE_BYTE_RE.search(self._bits, byte_index)
+            if not match:
+                return None
+            for bit in range(8):
+                index = match.start() * 8 + bit
+                if index >= self.size:
+                    return None
+                if index >= start and index not in self:
+                    return index
+            byte_index = match.start() + 1
+
+
+def cache_dir(*subdirs):
+    base = os.environ.get('XDG_CACHE_HOME') or path.expanduser('~/.cache')
+    return _ensure_dir(path.join(base, 'rejviz', *subdirs))
+
+
+def state_dir(*subdirs):
+    base = (os.environ.get('XDG_DATA_HOME') or
+            path.expanduser('~/.local/share'))
+    return _ensure_dir(path.join(base, 'rejviz', *subdirs))
+
+
+def runtime_dir(*subdirs):
+    """The user's private dir for sockets and locks, created if missing.
+
+    Raises RuntimeError if the dir (or any of `subdirs`) exists but is
+    a symlink, isn't owned by the user or is accessible to others.
+    """
+    base = os.environ.get('XDG_RUNTIME_DIR')
+    if base:
+        dir_path = path.join(base, 'rejviz')
+    else:
+        dir_path = path.join(tempfile.gettempdir(), 'rejviz-%d' % os.getuid())
+    _ensure_private_dir(dir_path)
+    for subdir in subdirs:
+        dir_path = path.join(dir_path, subdir)
+        _ensure_private_dir(dir_path)
+    return dir_path
+
+
+def check_private_dir(dir_path):
+    """Raise RuntimeError unless `dir_path` is private to the user."""
+    dir_stat = os.lstat(dir_path)
+    if (not stat.S_ISDIR(dir_stat.st_mode) or
+            dir_stat.st_uid != os.getuid() or dir_stat.st_mode & 0o077):
+        raise RuntimeError("'%s' must be a directory owned by uid %d and "
+                           "accessible only to it." % (dir_path, os.getuid()))
+
+
+@contextlib.contextmanager
+def locked(lock_path):
+    """Hold an exclusive flock on `lock_path` (created if missing)."""
+    lock_fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(lock_fd)
+
+
+def write_file_atomic(file_path, contents):
+    dir_path, file_name = path.split(file_path)
+    fd, tmp_path = tempfile.mkstemp(dir=dir_path, prefix='.' + file_name)
+    try:
+        with os.fdopen(fd, 'w') as tmp_file:
+            tmp_file.write(contents)
+        os.rename(tmp_path, file_path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def _ensure_dir(dir_path):
+    if not path.isdir(dir_path):
+        try:
+            os.makedirs(dir_path, 0o700)
+        except OSError:
+            # created concurrently by another process
+            if not path.isdir(dir_path):
+                raise
+    return dir_path
+
+
+def _ensure_private_dir(dir_path):
+    try:
+        os.mkdir(dir_path, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    check_private_dir(dir_path)